@@ -0,0 +1,11 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis
+~~~~~
+
+Run the server with `python -m pedis`, or execute the commands in
+process with `Embedded`.
+"""
+
+from .embedded import Embedded, ReplyError
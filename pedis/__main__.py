@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.__main__
+~~~~~~~~~~~~~~
+
+Run the server::
+
+    python -m pedis
+"""
+
+from .pedis import server
+
+
+server.run()
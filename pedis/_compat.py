@@ -8,13 +8,37 @@ Compatibility for Python2 and Python3.
 """
 
 import sys
+import time
 try:
     import cPickle as pickle
 except ImportError:
     import pickle
 
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
 
 if sys.version_info[0] == 3:
-    pass
+    integer_types = (int,)
+
+    # Sockets read and write bytes, the server works with str, latin-1
+    # maps every byte to the character of the same code.
+    def tobytes(s):
+        return s.encode('latin-1')
+
+    def tostr(b):
+        return b.decode('latin-1')
+
+    perf_counter = time.perf_counter
 else:
-    pass
+    integer_types = (int, long)
+
+    def tobytes(s):
+        return s
+
+    def tostr(b):
+        return b
+
+    perf_counter = time.time
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.aio
+~~~~~~~~~
+
+Serve the clients with an asyncio eventloop instead of the pedis
+eventloop, on uvloop if asked and installed::
+
+    asyncio loop
+    |
+    +-> PedisProtocol.data_received -> processInputBuffer -> addReply
+    |                                                           |
+    +-> beforeSleep -> handleClientsWithPendingWrites <---------+
+    |
+    +-> processTimeEvents -> serverCron, block timeouts, ...
+
+The commands, beforeSleep and the time events of the pedis eventloop
+are reused as is, the replies of a loop iteration are written to the
+transports in beforeSleep.
+
+To embed pedis in an asyncio application, await `start()` in the
+application's loop::
+
+    frontend = AsyncioFrontend(loop)
+    await frontend.start()
+
+Python 3 only.
+"""
+
+import time
+import errno
+import socket
+import asyncio
+from .server import server, debug, wain, parseQueryBuffer, \
+    CLIENT_CLOSED, FRONTEND_UVLOOP
+from ._compat import tostr
+
+
+__all__ = ['AsyncioFrontend', 'newEventLoop']
+
+
+def newEventLoop(name):
+    """Create the asyncio eventloop, on uvloop if name is `uvloop` and
+    it is installed.
+    """
+    if name == FRONTEND_UVLOOP:
+        try:
+            import uvloop
+        except ImportError:
+            wain('# uvloop is not installed, serving with asyncio')
+        else:
+            return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+class TransportConnection(object):
+
+    """The connection object of a client, writes to the transport of
+    the client like a socket.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        #: The transport buffer is over its high water mark
+        self.paused = 0
+
+    def __repr__(self):
+        return '<TransportConnection peer={}>'.format(self.getpeername())
+
+    def sendall(self, data):
+        if self.transport.is_closing():
+            raise socket.error('Connection closed')
+        self.transport.write(data)
+
+    def send(self, data, flags=0):
+        # Like a full socket buffer, the replies are kept by the client
+        # until the transport is resumed.
+        if self.paused:
+            raise socket.error(errno.EAGAIN, 'Transport paused')
+        self.sendall(data)
+        return len(data)
+
+    def getpeername(self):
+        return self.transport.get_extra_info('peername')
+
+    def close(self):
+        self.transport.close()
+
+
+class PedisProtocol(asyncio.Protocol):
+
+    """Connection of a client."""
+
+    def __init__(self, frontend):
+        self.frontend = frontend
+        self.conn = None
+        self.client = None
+
+    def connection_made(self, transport):
+        conn = self.conn = TransportConnection(transport)
+        if server.clients.length >= server.maxclients:
+            server.stat_rejected_conn += 1
+            transport.write(b'-ERR max number of clients reached\r\n')
+            transport.close()
+            return
+        server.stat_numconnections += 1
+        server.stat_numconnections_total += 1
+        debug('. Accepted: {}:{}'.format(*conn.getpeername()[:2]))
+        self.client = server.createClient(conn)
+
+    def data_received(self, data):
+        client = self.client
+        if client is None or client.flag & CLIENT_CLOSED:
+            return
+        client.querybuf += tostr(data)
+        server.stat_net_input_bytes += len(data)
+        server.touchClient(client)
+        parseQueryBuffer(client)
+        server.processInputBuffer(client)
+        self.frontend.scheduleBeforeSleep()
+
+    def pause_writing(self):
+        self.conn.paused = 1
+
+    def resume_writing(self):
+        self.conn.paused = 0
+        client = self.client
+        if client is not None and client.reply.length and \
+           not client.flag & CLIENT_CLOSED:
+            server.clients_pending_write.append(client)
+            self.frontend.scheduleBeforeSleep()
+
+    def connection_lost(self, exc):
+        # The connection may have been rejected.
+        if self.client is not None and \
+           not self.client.flag & CLIENT_CLOSED:
+            server.freeClient(self.client)
+            debug('. Client closed connection')
+
+
+class AsyncioFrontend(object):
+
+    """Drive the server with the asyncio loop."""
+
+    def __init__(self, loop):
+        self.loop = loop
+        #: beforeSleep is scheduled for the next loop iteration
+        self.beforesleep_scheduled = 0
+        #: Timer firing the nearest time event of the pedis eventloop
+        self.timer = None
+
+    def __repr__(self):
+        return '<AsyncioFrontend loop={}>'.format(type(self.loop).__name__)
+
+    def start(self):
+        """Start serving on the server socket.
+
+        Returns:
+            coroutine creating the asyncio server.
+        """
+        self.scheduleTimeEvents()
+        return self.loop.create_server(lambda: PedisProtocol(self),
+                                       sock=server.sobj)
+
+    def run(self):
+        """Serve forever."""
+        self.loop.run_until_complete(self.start())
+        self.loop.run_forever()
+
+    def scheduleBeforeSleep(self):
+        """Call beforeSleep once the callbacks ready in this iteration
+        are done, so the replies they added are written together.
+        """
+        if not self.beforesleep_scheduled:
+            self.beforesleep_scheduled = 1
+            self.loop.call_soon(self.beforeSleep)
+
+    def beforeSleep(self):
+        self.beforesleep_scheduled = 0
+        server.beforeSleep()
+        # Replies left by the writes of this iteration.
+        if server.clients_pending_write:
+            self.scheduleBeforeSleep()
+        # The commands may have created earlier time events, like the
+        # timeouts of blocking commands.
+        self.scheduleTimeEvents()
+
+    def scheduleTimeEvents(self):
+        """Set the timer to the nearest time event."""
+        te = server.el._searchNearestTimer()
+        if te is None:
+            return
+        when = self.loop.time() + max(te.when - time.time(), 0)
+        if self.timer is not None:
+            if self.timer.when() <= when:
+                return
+            self.timer.cancel()
+        self.timer = self.loop.call_at(when, self.processTimeEvents)
+
+    def processTimeEvents(self):
+        self.timer = None
+        server.el.processTimeEvents()
+        self.beforeSleep()
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.backlog
+~~~~~~~~~~~~~
+
+A fixed size circular buffer keeping the latest bytes written.
+"""
+
+
+from ._compat import tobytes, tostr
+
+
+__all__ = ['Backlog']
+
+
+class Backlog(object):
+
+    """Circular buffer of the latest `size` bytes fed.
+
+    >>> b = Backlog(8)
+    >>> b.feed('abc')
+    >>> b.histlen
+    3
+    >>> b.read(2)
+    'bc'
+    >>> b.feed('defghij')
+
+    Backlog -> [ijcdefgh], the oldest byte is 'c'.
+
+    >>> b.histlen
+    8
+    >>> b.read(8)
+    'cdefghij'
+    >>> b.read(3)
+    'hij'
+    >>> b.feed('0123456789')
+    >>> b.read(8)
+    '23456789'
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.buf = bytearray(size)
+        #: Where the next byte is written
+        self.idx = 0
+        #: Number of valid bytes in the buffer
+        self.histlen = 0
+
+    def __repr__(self):
+        return '<Backlog size={} histlen={}>'.format(self.size, self.histlen)
+
+    def __len__(self):
+        return self.histlen
+
+    def feed(self, data):
+        data = tobytes(data)
+        n = len(data)
+        if n > self.size:
+            data = data[-self.size:]
+
+        while data:
+            thislen = min(self.size - self.idx, len(data))
+            self.buf[self.idx:self.idx + thislen] = data[:thislen]
+            self.idx = (self.idx + thislen) % self.size
+            data = data[thislen:]
+
+        self.histlen = min(self.histlen + n, self.size)
+
+    def read(self, n):
+        """Return the latest n bytes."""
+        if n > self.histlen:
+            raise ValueError('Only {} bytes in backlog'.format(self.histlen))
+
+        start = (self.idx - n) % self.size
+        if start + n <= self.size:
+            return tostr(bytes(self.buf[start:start + n]))
+        return tostr(bytes(self.buf[start:]) + bytes(self.buf[:self.idx]))
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.benchmark
+~~~~~~~~~~~~~~~
+
+Benchmark a pedis server like redis-benchmark, clients are driven by
+a pedis eventloop::
+
+    python -m pedis.benchmark -c 50 -n 100000 -P 16 -t set,get
+    python -m pedis.benchmark --start-server --frontend asyncio --json
+
+Every test sends `requests` commands with `clients` connections, each
+connection sends `pipeline` commands at once and waits for all their
+replies. The latency of a command is the time from sending its
+pipeline to reading its reply.
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+from .event import EventLoop, READABLE
+from .utils import multibulk
+from ._compat import tobytes, tostr
+
+
+#: Tests in the default order, name -> function(bench) returning argv
+TESTS = [
+    ('ping', lambda b: ['ping']),
+    ('set', lambda b: ['set', b.randomKey('key:'), b.value]),
+    ('get', lambda b: ['get', b.randomKey('key:')]),
+    ('incr', lambda b: ['incr', b.randomKey('counter:')]),
+    ('lpush', lambda b: ['lpush', 'mylist', b.value]),
+    ('lpop', lambda b: ['lpop', 'mylist']),
+    ('sadd', lambda b: ['sadd', 'myset', b.randomKey('element:')]),
+    ('lrange', lambda b: ['lrange', 'mylist', '0', '100']),
+]
+
+#: Commands run before a test, name -> function(bench) returning argvs
+SETUPS = {
+    'lrange': lambda b: [['lpush', 'mylist', b.value] for i in range(100)],
+}
+
+IOBUF_LEN = 1024 * 16
+
+
+def replyEnd(buf, pos=0):
+    """Return where the reply starting at pos ends, -1 if the reply is
+    not complete.
+
+    >>> replyEnd('+OK\\r\\n')
+    5
+    >>> replyEnd('*2\\r\\n$1\\r\\na\\r\\n$-1\\r\\n')
+    16
+    >>> replyEnd('$3\\r\\nfo')
+    -1
+    """
+    eol = buf.find('\r\n', pos)
+    if eol == -1:
+        return -1
+    end = eol + 2
+
+    if buf[pos] == '$':
+        bulklen = int(buf[pos + 1:eol])
+        if bulklen < 0:
+            return end
+        end += bulklen + 2
+        return end if end <= len(buf) else -1
+
+    if buf[pos] == '*':
+        for i in range(int(buf[pos + 1:eol])):
+            end = replyEnd(buf, end)
+            if end == -1:
+                return -1
+
+    return end
+
+
+def percentile(latencies, p):
+    """Return the p percentile of the sorted latencies, by nearest
+    rank.
+
+    >>> percentile([1, 2, 3, 4], 50)
+    2
+    >>> percentile(list(range(1, 1001)), 99.9)
+    999
+    """
+    if not latencies:
+        return 0
+    idx = int(math.ceil(len(latencies) * p / 100.0)) - 1
+    return latencies[min(max(idx, 0), len(latencies) - 1)]
+
+
+class BenchClient(object):
+
+    def __init__(self, sobj):
+        self.sobj = sobj
+        self.readbuf = ''
+        #: Replies still expected for the pipeline sent
+        self.pending = 0
+        #: Time the pipeline was sent
+        self.start = 0
+
+
+class Benchmark(object):
+
+    """Run a test with the options parsed from the command line."""
+
+    def __init__(self, opts):
+        self.opts = opts
+        self.value = 'x' * opts.datasize
+        self.el = EventLoop()
+        self.clients = []
+        self.issued = 0
+        self.finished = 0
+        self.errors = 0
+        #: Latency of every request, in seconds
+        self.latencies = []
+        self.genArgv = None
+        self.name = None
+        self.start = 0
+
+    def randomKey(self, prefix):
+        if not self.opts.keyspacelen:
+            return prefix + '__rand_int__'
+        return '{}{:012d}'.format(prefix,
+                                  random.randrange(self.opts.keyspacelen))
+
+    def connect(self):
+        return socket.create_connection((self.opts.host, self.opts.port))
+
+    def runCommands(self, commands):
+        """Send commands on a new connection and wait for the replies."""
+        sobj = self.connect()
+        sobj.sendall(tobytes(''.join(multibulk(argv) for argv in commands)))
+        buf, pos, n = '', 0, 0
+        while n < len(commands):
+            data = sobj.recv(IOBUF_LEN)
+            if not data:
+                break
+            buf += tostr(data)
+            while n < len(commands):
+                end = replyEnd(buf, pos)
+                if end == -1:
+                    break
+                pos, n = end, n + 1
+        sobj.close()
+
+    def sendPipeline(self, client):
+        n = min(self.opts.pipeline, self.opts.requests - self.issued)
+        self.issued += n
+        client.pending = n
+        client.start = time.time()
+        client.sobj.sendall(tobytes(''.join(
+            multibulk(self.genArgv(self)) for i in range(n))))
+
+    def readHandler(self, sobj, client):
+        data = sobj.recv(IOBUF_LEN)
+        if not data:
+            raise IOError('Server closed the connection')
+        client.readbuf += tostr(data)
+
+        buf, pos = client.readbuf, 0
+        now = time.time()
+        while client.pending:
+            end = replyEnd(buf, pos)
+            if end == -1:
+                break
+            if buf[pos] == '-':
+                self.errors += 1
+            self.latencies.append(now - client.start)
+            client.pending -= 1
+            self.finished += 1
+            pos = end
+        client.readbuf = buf[pos:]
+
+        if client.pending:
+            return
+        if self.issued < self.opts.requests:
+            self.sendPipeline(client)
+        elif self.finished == self.opts.requests:
+            self.el.stop()
+
+    def showThroughput(self, id_, clientData):
+        elapsed = time.time() - self.start
+        if elapsed > 0:
+            sys.stderr.write('{}: {:.2f}\r'.format(
+                self.name.upper(), self.finished / elapsed))
+            sys.stderr.flush()
+        return 250
+
+    def run(self, name, genArgv):
+        """Run the test name.
+
+        Returns:
+            dict of the results.
+        """
+        opts = self.opts
+        if name in SETUPS:
+            self.runCommands(SETUPS[name](self))
+
+        self.name, self.genArgv = name, genArgv
+        self.issued = self.finished = self.errors = 0
+        self.latencies = []
+        self.el = EventLoop()
+        self.clients = [BenchClient(self.connect())
+                        for i in range(opts.clients)]
+        if not opts.quiet and not opts.json:
+            self.el.createTimeEvent(250, self.showThroughput, None)
+
+        self.start = time.time()
+        for client in self.clients:
+            self.el.createFileEvent(client.sobj, READABLE,
+                                    self.readHandler, client)
+            if self.issued < opts.requests:
+                self.sendPipeline(client)
+        self.el.main()
+        elapsed = time.time() - self.start
+
+        for client in self.clients:
+            client.sobj.close()
+
+        latencies = sorted(self.latencies)
+        return {
+            'test': name,
+            'requests': self.finished,
+            'errors': self.errors,
+            'seconds': round(elapsed, 6),
+            'rps': round(self.finished / elapsed, 2) if elapsed else 0,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+            'p999_ms': round(percentile(latencies, 99.9) * 1000, 3),
+        }
+
+
+def startServer(opts):
+    """Start a server for the benchmark, with an empty db in a
+    temporary dir.
+
+    Returns:
+        (process, dir), the server process and its temporary dir, the
+        caller removes the dir.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='pedis-benchmark-')
+    conf = os.path.join(tmpdir, 'pedis.conf')
+    with open(conf, 'w') as f:
+        f.write('port {}\n'.format(opts.port))
+        f.write('loglevel critical\n')
+        f.write('dbfilename {}\n'.format(os.path.join(tmpdir, 'dump.pdb')))
+        f.write('frontend {}\n'.format(opts.frontend))
+        f.write('io-threads {}\n'.format(opts.io_threads))
+
+    env = dict(os.environ, PEDIS_CONFIG_FILE=conf)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc = subprocess.Popen([sys.executable, '-m', 'pedis'], cwd=root,
+                            env=env)
+
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection((opts.host, opts.port)).close()
+            return proc, tmpdir
+        except socket.error:
+            if proc.poll() is not None or time.time() > deadline:
+                proc.kill()
+                proc.wait()
+                shutil.rmtree(tmpdir)
+                raise RuntimeError('Failed to start the server')
+            time.sleep(0.05)
+
+
+def parseOptions(argv):
+    parser = argparse.ArgumentParser(prog='python -m pedis.benchmark',
+                                     description=__doc__.split('::')[0],
+                                     add_help=False)
+    parser.add_argument('--help', action='help')
+    parser.add_argument('-h', dest='host', default='127.0.0.1',
+                        help='server hostname (default 127.0.0.1)')
+    parser.add_argument('-p', dest='port', type=int, default=6379,
+                        help='server port (default 6379)')
+    parser.add_argument('-c', dest='clients', type=int, default=50,
+                        help='number of parallel connections (default 50)')
+    parser.add_argument('-n', dest='requests', type=int, default=100000,
+                        help='total number of requests (default 100000)')
+    parser.add_argument('-d', dest='datasize', type=int, default=3,
+                        help='bytes of SET/LPUSH values (default 3)')
+    parser.add_argument('-P', dest='pipeline', type=int, default=1,
+                        help='pipeline <numreq> requests (default 1)')
+    parser.add_argument('-r', dest='keyspacelen', type=int, default=0,
+                        help='use random keys out of <keyspacelen> keys, '
+                             'instead of a single key')
+    parser.add_argument('-t', dest='tests',
+                        default=','.join(name for name, _ in TESTS),
+                        help='comma separated tests to run, '
+                             'default all: %(default)s')
+    parser.add_argument('-q', dest='quiet', action='store_true',
+                        help='quiet, just show the results')
+    parser.add_argument('--json', action='store_true',
+                        help='output the results as JSON')
+    parser.add_argument('--start-server', action='store_true',
+                        help='start a server on the port for the benchmark')
+    parser.add_argument('--frontend', default='pedis',
+                        choices=['pedis', 'asyncio', 'uvloop'],
+                        help='frontend of the started server')
+    parser.add_argument('--io-threads', type=int, default=1,
+                        help='io threads of the started server')
+
+    opts = parser.parse_args(argv)
+    tests = dict(TESTS)
+    opts.tests = [name.strip().lower() for name in opts.tests.split(',')]
+    for name in opts.tests:
+        if name not in tests:
+            parser.error('unknown test: {}'.format(name))
+    return opts
+
+
+def main(argv=None):
+    opts = parseOptions(sys.argv[1:] if argv is None else argv)
+    tests = dict(TESTS)
+
+    proc, tmpdir = startServer(opts) if opts.start_server else (None, None)
+    try:
+        bench = Benchmark(opts)
+        results = []
+        for name in opts.tests:
+            result = bench.run(name, tests[name])
+            results.append(result)
+            if not opts.json:
+                print('{name}: {rps:.2f} requests per second, '
+                      'p50={p50_ms:.3f} ms p99={p99_ms:.3f} ms '
+                      'p999={p999_ms:.3f} ms, {errors} errors'.format(
+                          name=name.upper(), **result))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+            shutil.rmtree(tmpdir)
+
+    if opts.json:
+        print(json.dumps({
+            'time': int(time.time()),
+            'python': platform.python_version(),
+            'config': {
+                'clients': opts.clients,
+                'requests': opts.requests,
+                'datasize': opts.datasize,
+                'pipeline': opts.pipeline,
+                'keyspacelen': opts.keyspacelen,
+                'frontend': opts.frontend if opts.start_server else None,
+            },
+            'results': results,
+        }, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,12 @@ port = 6379
 
 s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 s.connect((host, port))
-args = ' '.join(argv[1:])
+args = ' '.join(argv[1:]) + '\r\n'
+# The socket takes and returns bytes on Python 3.
+if not isinstance(args, bytes):
+    args = args.encode('latin-1')
 s.sendall(args)
 data = s.recv(1024)
+if not isinstance(data, str):
+    data = data.decode('latin-1')
 print(data.rstrip('\r\n'))
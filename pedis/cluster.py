@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.cluster
+~~~~~~~~~~~~~
+
+The keyspace is split in 16384 hash slots, every slot is served by one
+node, a node is named by the address clients connect to::
+
+    slot = CRC16(key) mod 16384
+
+If key contains a non empty `{hashtag}`, only the hashtag is hashed, so
+keys with the same hashtag are in the same slot.
+
+A node replies `-MOVED slot host:port` to the commands of keys in slots
+served by other nodes. While a slot is migrated to another node, the
+source node serves the keys still there, and replies `-ASK slot
+host:port` to the commands of the keys already migrated, the client
+sends ASKING then the command to the target node. The keys sent to the
+target and not acked yet are read only, their writes are replied
+`-TRYAGAIN`.
+"""
+
+
+from ._compat import tobytes
+
+
+__all__ = ['CLUSTER_SLOTS', 'crc16', 'keyHashSlot', 'ClusterState',
+           'SlotDict', 'SlotMigration']
+
+
+CLUSTER_SLOTS = 16384
+
+
+def _crc16Table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for j in range(8):
+            if crc & 0x8000:
+                crc = (crc << 1) ^ 0x1021
+            else:
+                crc <<= 1
+        table.append(crc & 0xffff)
+    return table
+
+
+_CRC16_TABLE = _crc16Table()
+
+
+def crc16(data):
+    """CRC16 XMODEM of data.
+
+    >>> hex(crc16(b'123456789'))
+    '0x31c3'
+    """
+    if not isinstance(data, bytes):
+        data = tobytes(data)
+    crc = 0
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ byte]
+    return crc
+
+
+def keyHashSlot(key):
+    """Return the hash slot of key.
+
+    >>> keyHashSlot('foo')
+    12182
+
+    A key is hashed as the bytes it was received as:
+
+    >>> keyHashSlot('\\xe9t\\xe9')
+    5690
+    >>> keyHashSlot('{user1000}.following') == keyHashSlot('user1000')
+    True
+    >>> keyHashSlot('foo{}{bar}') == keyHashSlot('bar')
+    False
+    """
+    start = key.find('{')
+    if start != -1:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    return crc16(key) & (CLUSTER_SLOTS - 1)
+
+
+class ClusterState(object):
+
+    """Which node serves every slot.
+
+    >>> cs = ClusterState('127.0.0.1:7000')
+    >>> cs.addSlots('127.0.0.1:7000', 0, 8191)
+    >>> cs.addSlots('127.0.0.1:7001', 8192, 16383)
+    >>> cs.slots[keyHashSlot('foo')]
+    '127.0.0.1:7001'
+    >>> cs.slotRanges()
+    [(0, 8191, '127.0.0.1:7000'), (8192, 16383, '127.0.0.1:7001')]
+    """
+
+    def __init__(self, myself):
+        #: Name of this node
+        self.myself = myself
+        #: slot -> name of the node serving it
+        self.slots = [None] * CLUSTER_SLOTS
+        #: slot -> node the slot is migrating to
+        self.migrating_slots_to = {}
+        #: slot -> node the slot is importing from
+        self.importing_slots_from = {}
+
+    def __repr__(self):
+        return '<ClusterState myself={}>'.format(self.myself)
+
+    def addSlots(self, node, start, end):
+        """Let node serve the slots from start to end, inclusive."""
+        for slot in range(start, end + 1):
+            self.slots[slot] = node
+
+    def slotRanges(self):
+        """Return the ranges of continuous slots served by the same
+        node, list of (start, end, node).
+        """
+        ranges = []
+        for slot, node in enumerate(self.slots):
+            if ranges and ranges[-1][2] == node and \
+               ranges[-1][1] == slot - 1:
+                ranges[-1] = (ranges[-1][0], slot, node)
+            elif node is not None:
+                ranges.append((slot, slot, node))
+        return ranges
+
+
+class SlotDict(dict):
+
+    """A db of a cluster node, which also indexes its keys by slot, so
+    the keys of a slot are found without scanning the db. The slot of a
+    key is hashed only when the key is added.
+
+    >>> d = SlotDict({'foo': 'v'})
+    >>> d['{foo}.bar'] = 'w'
+    >>> sorted(d.slotKeys(keyHashSlot('foo')))
+    ['foo', '{foo}.bar']
+    >>> d.pop('foo')
+    'v'
+    >>> d.countKeysInSlot(keyHashSlot('foo'))
+    1
+    """
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self)
+        #: slot -> keys in the slot
+        self.slots_to_keys = {}
+        self.update(*args, **kwargs)
+
+    def __reduce__(self):
+        # Dumped as a plain dict, the index is rebuilt when loaded.
+        return (dict, (), None, None, iter(self.items()))
+
+    def _addKey(self, key):
+        slot = keyHashSlot(key)
+        keys = self.slots_to_keys.get(slot)
+        if keys is None:
+            keys = self.slots_to_keys[slot] = set()
+        keys.add(key)
+
+    def _removeKey(self, key):
+        slot = keyHashSlot(key)
+        keys = self.slots_to_keys[slot]
+        keys.discard(key)
+        if not keys:
+            del(self.slots_to_keys[slot])
+
+    def __setitem__(self, key, val):
+        if key not in self:
+            self._addKey(key)
+        dict.__setitem__(self, key, val)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self._removeKey(key)
+
+    def pop(self, key, *default):
+        if key not in self:
+            return dict.pop(self, key, *default)
+        self._removeKey(key)
+        return dict.pop(self, key)
+
+    def popitem(self):
+        key, val = dict.popitem(self)
+        self._removeKey(key)
+        return key, val
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
+
+    def clear(self):
+        dict.clear(self)
+        self.slots_to_keys.clear()
+
+    def slotKeys(self, slot):
+        """Return the keys in slot, the set must not be changed."""
+        return self.slots_to_keys.get(slot, ())
+
+    def countKeysInSlot(self, slot):
+        return len(self.slots_to_keys.get(slot, ()))
+
+
+class SlotMigration(object):
+
+    """Progress of migrating the keys of a slot to another node."""
+
+    def __init__(self, slot, target, sobj):
+        self.slot = slot
+        #: Name of the target node
+        self.target = target
+        #: Connection to the target node
+        self.sobj = sobj
+        self.readbuf = ''
+        #: Commands not written yet
+        self.writebuf = b''
+        #: Replies still expected, and when they time out
+        self.pending = 0
+        self.deadline = 0
+        #: Db migrated, and the keys sent in it not acked yet
+        self.dictid = 0
+        self.inflight = set()
+        #: Db selected on the target connection
+        self.seldb = 0
+        #: Number of keys migrated
+        self.migrated = 0
+        #: Slot assigned to the target, the last reply is its ack
+        self.done = 0
+
+    def __repr__(self):
+        return '<SlotMigration slot={} target={}>'.format(self.slot,
+                                                          self.target)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.embedded
+~~~~~~~~~~~~~~
+
+Execute commands in process, without socket, eventloop and reply
+encoding. The commands run on the same keyspace as the server, the
+replies are Python values::
+
+    status     'OK'
+    integer    1
+    bulk       'value'
+    nil        None
+    multibulk  ['a', 'b']
+    error      raises ReplyError
+
+Blocking commands don't block, they reply nil like on timeout. The
+messages published to the channels a client subscribed are kept in
+its `messages` list.
+"""
+
+from .pedis import server
+from .server import PedisClient, CLIENT_NATIVE, CLIENT_CLOSED
+from .linklist import LinkList
+from .utils import ReplyError
+from ._compat import tostr
+
+
+__all__ = ['Embedded', 'ReplyError']
+
+
+def _encodeArg(arg):
+    if isinstance(arg, bytes):
+        return tostr(arg)
+    return str(arg)
+
+
+class Embedded(object):
+
+    """A native client of the server.
+
+    >>> db = Embedded()
+    >>> db.execute('SET', 'embedded:k', 'v')
+    'OK'
+    >>> db.execute('GET', 'embedded:k')
+    'v'
+    >>> db.execute('RPUSH', 'embedded:l', 1)
+    'OK'
+    >>> db.execute('LRANGE', 'embedded:l', 0, 1)
+    ['1']
+    >>> db.execute('DEL', 'embedded:k', 'embedded:l')
+    2
+    >>> db.execute('GET', 'embedded:k') is None
+    True
+    >>> db.execute('INCR', 'a', 'b')  # doctest: +IGNORE_EXCEPTION_DETAIL
+    Traceback (most recent call last):
+    ...
+    ReplyError: ERR wrong number of arguments
+    >>> sub = Embedded()
+    >>> sub.execute('SUBSCRIBE', 'embedded:ch')
+    ['subscribe', 'embedded:ch', 1]
+    >>> db.execute('PUBLISH', 'embedded:ch', 'hi')
+    1
+    >>> sub.execute('UNSUBSCRIBE')
+    ['unsubscribe', 'embedded:ch', 0]
+    >>> sub.messages
+    [['message', 'embedded:ch', 'hi']]
+    """
+
+    def __init__(self, dictid=0):
+        client = PedisClient()
+        client.flag |= CLIENT_NATIVE
+        client.addr = 'embedded'
+        client.dictid = dictid
+        client.querybuf = ''
+        client.reply = LinkList()
+        self.client = client
+        #: Messages received by the subscribed client, oldest first
+        self.messages = []
+
+    def __repr__(self):
+        return '<Embedded db={}>'.format(self.client.dictid)
+
+    def execute(self, name, *args):
+        """Execute a command, arguments are converted to str.
+
+        Returns:
+            the reply, a list if the command replied more than once,
+            like SUBSCRIBE of several channels.
+
+        Raises:
+            ReplyError: the command replied an error.
+        """
+        c = self.client
+        if c.flag & CLIENT_CLOSED:
+            raise ReplyError('ERR client is closed')
+
+        # Replies added between the commands are published messages.
+        while c.reply.length:
+            node = c.reply.head
+            self.messages.append(node.val)
+            c.reply.delNode(node)
+
+        c.argv = [_encodeArg(name).lower()] + [_encodeArg(a) for a in args]
+        c.argc = len(c.argv)
+        server.processCommand(c)
+
+        replies = []
+        while c.reply.length:
+            node = c.reply.head
+            replies.append(node.val)
+            c.reply.delNode(node)
+
+        for rv in replies:
+            if isinstance(rv, ReplyError):
+                raise rv
+        if len(replies) == 1:
+            return replies[0]
+        return replies or None
+
+    def close(self):
+        """Unsubscribe, unwatch and close the client."""
+        if not self.client.flag & CLIENT_CLOSED:
+            server.freeClient(self.client)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
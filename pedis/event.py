@@ -52,12 +52,14 @@ class TimeEvent(object):
     def __init__(self, id_, miliseconds, timeProc, clientData):
         """Time event structure.
 
-        :param fd: client fd.
-        :param mask: event type.
-        :param fileProc: callback to process time event.
+        :param id_: time event id.
+        :param miliseconds: fire the event after miliseconds.
+        :param timeProc: callback to process time event, called with
+                         the event id and clientData, returns the
+                         miliseconds to fire again or NOMORE.
         """
         self.id_ = id_
-        self.when = time.time() + miliseconds / 1000
+        self.when = time.time() + miliseconds / 1000.0
         self.timeProc = timeProc
         self.clientData = clientData
         self.nextEvent = None
@@ -78,10 +80,27 @@ class EventLoop(object):
         self.timeEventHead = None
         self.timeEventNextId = 0
         self.stopFlag = 0
+        self.beforeSleep = None
+        self.afterSleep = None
+        self.timeProcDone = None
 
     def stop(self):
         self.stopFlag = 1
 
+    def setBeforeSleepProc(self, beforeSleep):
+        """Set a proc called before every events processing."""
+        self.beforeSleep = beforeSleep
+
+    def setAfterSleepProc(self, afterSleep):
+        """Set a proc called when the wait for events returned."""
+        self.afterSleep = afterSleep
+
+    def setTimeProcDoneProc(self, timeProcDone):
+        """Set a proc called with the time event and the seconds its
+        timeProc took, after every time event fired.
+        """
+        self.timeProcDone = timeProcDone
+
     def createFileEvent(self, fd, mask, fileProc, clientData):
         fe = FileEvent(fd, mask, fileProc, clientData)
         fe.nextEvent = self.fileEventHead
@@ -95,7 +114,8 @@ class EventLoop(object):
                     self.fileEventHead = fe.nextEvent
                 else:
                     prev.nextEvent = fe.nextEvent
-            prev = fe
+            else:
+                prev = fe
             fe = fe.nextEvent
         del(fe)
 
@@ -105,28 +125,30 @@ class EventLoop(object):
         te = TimeEvent(id_, miliseconds, timeProc, clientData)
         te.nextEvent = self.timeEventHead
         self.timeEventHead = te
+        return id_
 
     def deleteTimeEvent(self, id_):
         te, prev = self.timeEventHead, None
         while te:
             if te.id_ == id_:
                 if prev is None:
-                    self.timeEventHead = te
+                    self.timeEventHead = te.nextEvent
                 else:
                     prev.nextEvent = te.nextEvent
+                return 1
             prev = te
             te = te.nextEvent
-        del(te)
+        return 0
 
     def _searchNearestTimer(self):
         te = self.timeEventHead
         nearest = None
 
         while te is not None:
-            if not nearest or te.when < nearest:
+            if not nearest or te.when < nearest.when:
                 nearest = te
             te = te.nextEvent
-            return nearest
+        return nearest
 
     def processEvents(self, flags):
 
@@ -154,16 +176,22 @@ class EventLoop(object):
                 numfd += 1
                 fe = fe.nextEvent
 
+        readyrfds, readywfds, readyefds = [], [], []
         if numfd or ((flags & TIME_EVENTS) and not (flags & DONT_WAIT)):
+            shortest = None
             if flags & TIME_EVENTS and not flags & DONT_WAIT:
                 shortest = self._searchNearestTimer()
             if shortest:
                 now = time.time()
-                timeout = shortest.when - now
-            else:
+                timeout = max(shortest.when - now, 0)
+            elif flags & DONT_WAIT:
                 timeout = 0
+            # Else no timer, wait for the file events.
 
-        readyrfds, readywfds, readyefds = select(rfds, wfds, efds, timeout)
+            readyrfds, readywfds, readyefds = select(rfds, wfds, efds,
+                                                     timeout)
+            if self.afterSleep is not None:
+                self.afterSleep()
         if len(readyrfds) + len(readywfds) + len(readyefds) > 0:
             fe = self.fileEventHead
             while fe is not None:
@@ -199,27 +227,42 @@ class EventLoop(object):
                     fe = fe.nextEvent
 
         if flags & TIME_EVENTS:
-            te = self.timeEventHead
-            maxid = self.timeEventNextId - 1
-            while te:
-                if te.id_ > maxid:
-                    te = te.nextEvent
-                    continue
-                now = time.time()
-                if now >= te.when:
-                    rv = te.timeProc()
-                    if rv != NOMORE:
-                        te.when += rv / 1000
-                    else:
-                        self.deleteTimeEvent(te.ID)
-                    te = self.timeEventHead
-                else:
-                    te = te.nextEvent
+            processed += self.processTimeEvents()
 
         return processed
 
+    def processTimeEvents(self):
+        """Fire the time events due.
+
+        Returns:
+            number of time events fired.
+        """
+        processed = 0
+        te = self.timeEventHead
+        maxid = self.timeEventNextId - 1
+        while te:
+            if te.id_ > maxid:
+                te = te.nextEvent
+                continue
+            now = time.time()
+            if now >= te.when:
+                rv = te.timeProc(te.id_, te.clientData)
+                if self.timeProcDone is not None:
+                    self.timeProcDone(te, time.time() - now)
+                processed += 1
+                if rv != NOMORE:
+                    te.when = now + rv / 1000.0
+                else:
+                    self.deleteTimeEvent(te.id_)
+                te = self.timeEventHead
+            else:
+                te = te.nextEvent
+        return processed
+
     def main(self):
         while not self.stopFlag:
+            if self.beforeSleep is not None:
+                self.beforeSleep()
             self.processEvents(ALL_EVENTS)
 
 # Singleton
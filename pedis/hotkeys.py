@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.hotkeys
+~~~~~~~~~~~~~
+
+Find the hot keys and the big keys.
+
+Hot keys: 1 in `hotkeys-sample-rate` commands, on average, is sampled,
+its keys are counted in a Count-Min sketch, and the keys counted the
+most are kept in a top-K list with the bytes of the replies and the
+commands accessing them. The counts are halved every
+HOTKEYS_DECAY_PERIOD seconds, so the top keys are the ones hot lately.
+
+Big keys: the keys of the dbs are iterated by batches in a time event,
+the biggest string, list and set of every db are kept.
+"""
+
+import random
+import binascii
+from itertools import islice
+from ._compat import tobytes
+
+
+__all__ = ['CountMinSketch', 'TopK', 'HotKeys', 'BigKeysScan', 'replySize']
+
+
+#: Counters per row and rows of the Count-Min sketch
+CMS_WIDTH = 2048
+CMS_DEPTH = 4
+
+#: Keys kept by the top-K list
+HOTKEYS_TOPK = 32
+
+#: Seconds between two halvings of the counts
+HOTKEYS_DECAY_PERIOD = 60
+
+#: Keys looked at per BIGKEYS batch, a batch every milisecond
+BIGKEYS_BATCH = 1000
+
+
+class CountMinSketch(object):
+
+    """Approximate counts of the keys in CMS_DEPTH rows of CMS_WIDTH
+    counters, a count is never underestimated.
+
+    >>> cms = CountMinSketch(width=64, depth=3)
+    >>> for i in range(5):
+    ...     n = cms.add('hot')
+    >>> cms.add('cold')
+    1
+    >>> cms.count('hot')
+    5
+    >>> cms.decay()
+    >>> cms.count('hot')
+    2
+    """
+
+    def __init__(self, width=CMS_WIDTH, depth=CMS_DEPTH):
+        self.width = width
+        self.rows = [[0] * width for i in range(depth)]
+
+    def __repr__(self):
+        return '<CountMinSketch {}x{}>'.format(len(self.rows), self.width)
+
+    def _indexes(self, key):
+        data = tobytes(key)
+        return [(binascii.crc32(data, seed) & 0xffffffff) % self.width
+                for seed in range(len(self.rows))]
+
+    def add(self, key):
+        """Count key once.
+
+        Returns:
+            the estimated count of key.
+        """
+        rv = None
+        for row, idx in zip(self.rows, self._indexes(key)):
+            row[idx] += 1
+            if rv is None or row[idx] < rv:
+                rv = row[idx]
+        return rv
+
+    def count(self, key):
+        return min(row[idx] for row, idx in zip(self.rows,
+                                                 self._indexes(key)))
+
+    def decay(self):
+        """Halve the counts."""
+        for row in self.rows:
+            for i in range(self.width):
+                row[i] >>= 1
+
+
+class TopK(object):
+
+    """The k keys of the highest estimated counts, key -> [count, reply
+    bytes, {command: samples}].
+
+    >>> top = TopK(2)
+    >>> top.update('a', 5, 10, 'get')
+    >>> top.update('b', 3, 10, 'get')
+    >>> top.update('c', 1, 10, 'get')
+    >>> top.update('c', 4, 10, 'incr')
+    >>> top.update('c', 5, 10, 'incr')
+    >>> top.items()
+    [('a', 5, 10, 'get'), ('c', 5, 20, 'incr')]
+    """
+
+    def __init__(self, k=HOTKEYS_TOPK):
+        self.k = k
+        self.keys = {}
+
+    def __repr__(self):
+        return '<TopK k={}>'.format(self.k)
+
+    def update(self, key, count, nbytes, command):
+        """Set the estimated count of key, sampled in command with a
+        reply of nbytes, the key of the lowest count is evicted if key
+        is new and counted more.
+        """
+        entry = self.keys.get(key)
+        if entry is None:
+            if len(self.keys) >= self.k:
+                coldest = min(self.keys, key=lambda k: self.keys[k][0])
+                if self.keys[coldest][0] >= count:
+                    return
+                del self.keys[coldest]
+            entry = self.keys[key] = [count, 0, {}]
+
+        entry[0] = count
+        entry[1] += nbytes
+        commands = entry[2]
+        commands[command] = commands.get(command, 0) + 1
+
+    def items(self):
+        """Return (key, count, reply bytes, command sampled the most),
+        hottest first.
+        """
+        return sorted(((key, count, nbytes,
+                        max(sorted(commands), key=commands.get))
+                       for key, (count, nbytes, commands) in
+                       self.keys.items()),
+                      key=lambda item: (-item[1], item[0]))
+
+    def decay(self):
+        for key in list(self.keys):
+            entry = self.keys[key]
+            entry[0] >>= 1
+            if not entry[0]:
+                del self.keys[key]
+
+
+class HotKeys(object):
+
+    """Sample the commands and count their keys.
+
+    >>> hotkeys = HotKeys(rate=1)
+    >>> for i in range(3):
+    ...     if hotkeys.sample():
+    ...         hotkeys.record(0, ['k'], 'get', 5)
+    >>> hotkeys.items()
+    [(0, 'k', 3, 15, 'get')]
+    """
+
+    def __init__(self, rate=0):
+        #: Sample 1 in rate commands on average, 0 samples nothing
+        self.rate = rate
+        self.countdown = self._nextCountdown()
+        self.sketch = CountMinSketch()
+        self.top = TopK()
+
+    def __repr__(self):
+        return '<HotKeys rate={}>'.format(self.rate)
+
+    def _nextCountdown(self):
+        # Random intervals of rate commands on average, not to miss
+        # the keys accessed periodically.
+        return random.randint(1, max(self.rate * 2 - 1, 1))
+
+    def sample(self):
+        """Return if the current command is sampled."""
+        self.countdown -= 1
+        if self.countdown > 0:
+            return 0
+        self.countdown = self._nextCountdown()
+        return 1
+
+    def record(self, dictid, keys, command, nbytes):
+        """Count the keys of db dictid of a sampled command which
+        replied nbytes.
+        """
+        for key in keys:
+            name = '{}:{}'.format(dictid, key)
+            self.top.update((dictid, key), self.sketch.add(name), nbytes,
+                            command)
+
+    def items(self):
+        """Return (dictid, key, estimated count, reply bytes, command
+        sampled the most), the counts and bytes are of the samples.
+        """
+        return [(dictid, key, count, nbytes, command)
+                for (dictid, key), count, nbytes, command in
+                self.top.items()]
+
+    def decay(self):
+        self.sketch.decay()
+        self.top.decay()
+
+    def reset(self):
+        self.sketch = CountMinSketch()
+        self.top = TopK()
+
+
+def replySize(reply, tail):
+    """Return the bytes of the replies added to the reply list after
+    the node tail, tail is None if the list was empty. The replies of
+    the native clients are not counted.
+    """
+    node = reply.head if tail is None else tail.next
+    nbytes = 0
+    while node is not None:
+        if isinstance(node.val, str):
+            nbytes += len(node.val)
+        node = node.next
+    return nbytes
+
+
+#: Types of the values reported by BIGKEYS, and their size unit
+BIGKEYS_TYPES = [(str, 'string', 'bytes'), (list, 'list', 'items'),
+                 (set, 'set', 'members')]
+
+
+class BigKeysScan(object):
+
+    """Progress of a scan for the biggest keys.
+
+    The keys are iterated in place, not copied. A db changing size
+    between two batches invalidates its iterator, the iteration then
+    restarts past the keys already looked at: like SCAN, the keys added
+    or deleted meanwhile may be missed or looked at twice.
+
+    >>> dicts = [{'s': 'abc', 'l': [1, 2], 'm': [1]}, {}]
+    >>> scan = BigKeysScan(dicts)
+    >>> while not scan.done:
+    ...     scan.step(dicts, 2)
+    >>> scan.scanned
+    3
+    >>> scan.results()
+    [[0, 'list', 'l', 2, 'items'], [0, 'string', 's', 3, 'bytes']]
+    """
+
+    def __init__(self, dicts):
+        #: Db scanned, the iterator of its keys and the keys looked at
+        #: in it
+        self.dictid = 0
+        self.dict_ = None
+        self.it = None
+        self.pos = 0
+        self.scanned = 0
+        self.done = not dicts
+        #: (dictid, type name) -> (key, size)
+        self.biggest = {}
+
+    def __repr__(self):
+        return '<BigKeysScan db={} scanned={}>'.format(self.dictid,
+                                                       self.scanned)
+
+    def _nextKeys(self, dict_, count):
+        """Return the next count keys of dict_, dict_ is the db now, it
+        may have been changed or flushed since the previous batch.
+        """
+        if dict_ is self.dict_:
+            try:
+                return list(islice(self.it, count))
+            except RuntimeError:
+                pass
+        self.dict_ = dict_
+        self.it = islice(iter(dict_), self.pos, None)
+        return list(islice(self.it, count))
+
+    def step(self, dicts, count=BIGKEYS_BATCH):
+        """Look at the next count keys, dicts are the dbs now."""
+        dict_ = dicts[self.dictid]
+        keys = self._nextKeys(dict_, count)
+        for key in keys:
+            val = dict_[key]
+            for type_, name, unit in BIGKEYS_TYPES:
+                if isinstance(val, type_):
+                    size = len(val)
+                    best = self.biggest.get((self.dictid, name))
+                    if best is None or size > best[1]:
+                        self.biggest[(self.dictid, name)] = (key, size)
+                    break
+        self.scanned += len(keys)
+        self.pos += len(keys)
+
+        if len(keys) < count:
+            self.dict_ = self.it = None
+            self.pos = 0
+            self.dictid += 1
+            if self.dictid == len(dicts):
+                self.done = 1
+
+    def results(self):
+        """Return [dictid, type, key, size, unit] of the biggest keys."""
+        units = dict((name, unit) for _, name, unit in BIGKEYS_TYPES)
+        return [[dictid, name, key, size, units[name]]
+                for (dictid, name), (key, size) in sorted(
+                    self.biggest.items())]
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.latency
+~~~~~~~~~~~~~
+
+Latency statistics and slow log of the commands, and the latency
+monitor of the server.
+
+The latencies of the commands are counted in a histogram of power of
+two buckets of microseconds, like a HDR histogram with one significant
+bit: bucket i counts the latencies in [2^(i-1), 2^i), bucket 0 counts
+0. Recording a latency only increments preallocated counters.
+
+The latency monitor keeps the stalls of the server longer than a
+threshold, per event::
+
+    eventloop    an eventloop cycle, from waking up to sleeping again
+    time-event   the proc of a time event, like serverCron
+    fork         the fork of the background saving
+"""
+
+import time
+from collections import deque, namedtuple
+
+
+__all__ = ['HISTOGRAM_BUCKETS', 'LatencyHistogram', 'CommandStats',
+           'SlowLog', 'slowlogEntry', 'LatencyMonitor']
+
+
+#: Buckets of a histogram, the last one counts all the latencies of
+#: more than 2^(HISTOGRAM_BUCKETS-2) microseconds, about 39 hours
+HISTOGRAM_BUCKETS = 48
+
+#: Arguments and characters of an argument kept by a slow log entry
+SLOWLOG_ENTRY_MAX_ARGC = 32
+SLOWLOG_ENTRY_MAX_STRING = 128
+
+#: Samples kept per latency monitor event, one per second at most
+LATENCY_TS_LEN = 160
+
+
+class LatencyHistogram(object):
+
+    """Power of two buckets of latencies in microseconds.
+
+    >>> h = LatencyHistogram()
+    >>> for usec in (0, 1, 3, 3, 900):
+    ...     h.record(usec)
+    >>> h.count
+    5
+    >>> h.cumulative()
+    [(1, 1), (2, 2), (4, 4), (8, 4), (16, 4), (32, 4), (64, 4), (128, 4), (256, 4), (512, 4), (1024, 5)]
+    >>> h.percentile(50)
+    4
+    >>> h.percentile(99)
+    1024
+    """
+
+    __slots__ = ('counts', 'count')
+
+    def __init__(self):
+        self.counts = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+
+    def __repr__(self):
+        return '<LatencyHistogram count={}>'.format(self.count)
+
+    def record(self, usec):
+        """Count a latency of usec microseconds."""
+        self.counts[min(usec.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+
+    def cumulative(self):
+        """Return (bucket upper bound, number of latencies lower than
+        it) for the buckets up to the last one not empty.
+        """
+        rv = []
+        total = 0
+        for i, n in enumerate(self.counts):
+            if total == self.count:
+                break
+            total += n
+            rv.append((1 << i, total))
+        return rv
+
+    def percentile(self, p):
+        """Return the upper bound of the bucket of the p percentile."""
+        rank = self.count * p / 100.0
+        total = 0
+        for i, n in enumerate(self.counts):
+            total += n
+            if n and total >= rank:
+                return 1 << i
+        return 0
+
+    def reset(self):
+        for i in range(HISTOGRAM_BUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+
+
+class CommandStats(object):
+
+    """Calls and latencies of a command.
+
+    >>> stats = CommandStats()
+    >>> stats.record(10)
+    >>> stats.record(30)
+    >>> stats.calls, stats.usec, stats.max_usec
+    (2, 40, 30)
+    """
+
+    __slots__ = ('calls', 'usec', 'max_usec', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        #: Total and max microseconds of the calls
+        self.usec = 0
+        self.max_usec = 0
+        self.histogram = LatencyHistogram()
+
+    def __repr__(self):
+        return '<CommandStats calls={}>'.format(self.calls)
+
+    def record(self, usec):
+        self.calls += 1
+        self.usec += usec
+        if usec > self.max_usec:
+            self.max_usec = usec
+        self.histogram.record(usec)
+
+    def reset(self):
+        self.calls = self.usec = self.max_usec = 0
+        self.histogram.reset()
+
+
+#: id: unique, increasing id of the entry
+#: time: unix time the command was called
+#: usec: duration of the command
+#: argv: truncated arguments of the command
+#: addr: `host:port` of the client, empty for the native clients
+slowlogEntry = namedtuple('slowlogEntry', ['id', 'time', 'usec', 'argv',
+                                           'addr'])
+
+
+class SlowLog(object):
+
+    """The latest commands slower than a threshold, newest first.
+
+    >>> slowlog = SlowLog(maxlen=2)
+    >>> slowlog.push(['set', 'k', 'x' * 200], 12000, '127.0.0.1:5000')
+    >>> slowlog.entries[0].argv[2][-22:]
+    'xxx... (72 more bytes)'
+    >>> slowlog.push(['get', 'k'], 15000, '')
+    >>> slowlog.push(['keys', '*'], 90000, '')
+    >>> [(e.id, e.argv[0]) for e in slowlog.entries]
+    [(2, 'keys'), (1, 'get')]
+    >>> slowlog.reset()
+    >>> len(slowlog.entries)
+    0
+    """
+
+    def __init__(self, maxlen=128):
+        self.entries = deque(maxlen=maxlen)
+        #: Id of the next entry, not reset by reset()
+        self.nextid = 0
+
+    def __repr__(self):
+        return '<SlowLog len={}>'.format(len(self.entries))
+
+    def push(self, argv, usec, addr):
+        """Log a command called with argv that took usec microseconds,
+        the oldest entry is dropped if the log is full.
+        """
+        if len(argv) > SLOWLOG_ENTRY_MAX_ARGC:
+            more = len(argv) - SLOWLOG_ENTRY_MAX_ARGC + 1
+            argv = argv[:SLOWLOG_ENTRY_MAX_ARGC - 1] + \
+                ['... ({} more arguments)'.format(more)]
+        argv = [arg if len(arg) <= SLOWLOG_ENTRY_MAX_STRING else
+                '{}... ({} more bytes)'.format(
+                    arg[:SLOWLOG_ENTRY_MAX_STRING],
+                    len(arg) - SLOWLOG_ENTRY_MAX_STRING)
+                for arg in argv]
+        self.entries.appendleft(slowlogEntry(self.nextid, int(time.time()),
+                                             usec, argv, addr))
+        self.nextid += 1
+
+    def resize(self, maxlen):
+        self.entries = deque(self.entries, maxlen=maxlen)
+
+    def reset(self):
+        self.entries.clear()
+
+
+class LatencySeries(object):
+
+    """Latest samples of an event, [unix time, miliseconds], oldest
+    first, and the max latency seen.
+    """
+
+    __slots__ = ('samples', 'max')
+
+    def __init__(self):
+        self.samples = deque(maxlen=LATENCY_TS_LEN)
+        self.max = 0
+
+    def __repr__(self):
+        return '<LatencySeries len={}>'.format(len(self.samples))
+
+
+class LatencyMonitor(object):
+
+    """Stalls longer than threshold miliseconds per event, the samples
+    of the same second are merged keeping the max.
+
+    >>> monitor = LatencyMonitor(threshold=100)
+    >>> monitor.addSampleIfNeeded('eventloop', 20)
+    >>> monitor.addSampleIfNeeded('eventloop', 150)
+    >>> monitor.addSampleIfNeeded('eventloop', 300)
+    >>> monitor.addSampleIfNeeded('fork', 120)
+    >>> sorted(monitor.events)
+    ['eventloop', 'fork']
+    >>> [ms for t, ms in monitor.events['eventloop'].samples]
+    [300]
+    >>> monitor.reset(['fork', 'nosuchevent'])
+    1
+    >>> sorted(monitor.events)
+    ['eventloop']
+    """
+
+    def __init__(self, threshold=0):
+        #: Miliseconds, 0 disables the monitor
+        self.threshold = threshold
+        #: event -> LatencySeries
+        self.events = {}
+
+    def __repr__(self):
+        return '<LatencyMonitor threshold={}>'.format(self.threshold)
+
+    def addSampleIfNeeded(self, event, ms):
+        if self.threshold and ms >= self.threshold:
+            self.addSample(event, int(ms))
+
+    def addSample(self, event, ms):
+        series = self.events.get(event)
+        if series is None:
+            series = self.events[event] = LatencySeries()
+        if ms > series.max:
+            series.max = ms
+
+        now = int(time.time())
+        samples = series.samples
+        if samples and samples[-1][0] == now:
+            samples[-1][1] = max(samples[-1][1], ms)
+        else:
+            samples.append([now, ms])
+
+    def reset(self, events=None):
+        """Reset the events, all if events is None.
+
+        Returns:
+            number of events reset.
+        """
+        if events is None:
+            events = list(self.events)
+        return sum(1 for event in events
+                   if self.events.pop(event, None) is not None)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.lazyfree
+~~~~~~~~~~~~~~
+
+Free large values in a background thread.
+
+Python frees an object when its last reference is dropped, in the
+thread dropping it and holding the GIL, so dropping a container of
+millions of elements stalls the eventloop. The eventloop hands such
+values to the lazy free thread instead, which empties them by chunks,
+the GIL is switched to the eventloop between chunks.
+"""
+
+import threading
+from ._compat import queue
+
+
+__all__ = ['LazyFree', 'freeEffort']
+
+
+#: Elements freed at once
+LAZYFREE_CHUNK = 1024
+
+
+def freeEffort(val):
+    """Return the number of allocations to free val."""
+    if isinstance(val, (list, set, dict)):
+        return len(val)
+    return 1
+
+
+def _freeByChunks(obj):
+    """Empty obj by chunks of LAZYFREE_CHUNK elements.
+
+    >>> db = {'l': list(range(3000)), 's': set(range(3000))}
+    >>> _freeByChunks(db)
+    >>> db
+    {}
+    """
+    if isinstance(obj, list):
+        while obj:
+            del(obj[-LAZYFREE_CHUNK:])
+    elif isinstance(obj, set):
+        while obj:
+            for i in range(min(LAZYFREE_CHUNK, len(obj))):
+                obj.pop()
+    elif isinstance(obj, dict):
+        # A db, its values may be large too.
+        while obj:
+            for i in range(min(LAZYFREE_CHUNK, len(obj))):
+                key, val = obj.popitem()
+                if freeEffort(val) > LAZYFREE_CHUNK:
+                    _freeByChunks(val)
+
+
+class LazyFree(object):
+
+    """The lazy free thread and its queue of values to free."""
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def __repr__(self):
+        return '<LazyFree pending={}>'.format(self.pending())
+
+    def free(self, obj):
+        """Free obj in the lazy free thread, the caller must drop all
+        its references to obj.
+        """
+        # Threads don't survive fork, start one in every process.
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(obj)
+
+    def pending(self):
+        """Return the number of values waiting to be freed."""
+        return self.queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            obj = self.queue.get()
+            _freeByChunks(obj)
+            del(obj)
+            self.queue.task_done()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -37,15 +37,15 @@ class LinkList(object):
     True
     >>> l.length == 0
     True
-    >>> l.addNodeHead(42)
+    >>> node = l.addNodeHead(42)
     >>> l.head.val
     42
     >>> l.tail.val
     42
     >>> l.length
     1
-    >>> l.addNodeHead('foo')
-    >>> l.addNodeTail('bar')
+    >>> node = l.addNodeHead('foo')
+    >>> node = l.addNodeTail('bar')
 
     List -> foo <-> 42 <-> bar -> None
 
@@ -74,6 +74,9 @@ class LinkList(object):
     bar
     42
     foo
+    >>> l.moveNodeTail(l.head)
+    >>> [n.val for n in l]
+    [42, 'bar', 'foo']
     """
 
     def __init__(self):
@@ -92,14 +95,12 @@ class LinkList(object):
         while curr:
             yield curr
             curr = curr.next
-        raise StopIteration
 
     def __reversed__(self):
         curr = self.tail
         while curr:
             yield curr
             curr = curr.prev
-        raise StopIteration
 
     def addNodeHead(self, val):
         node = Node()
@@ -114,8 +115,8 @@ class LinkList(object):
             node.next = self.head
             self.head.prev = node
             self.head = node
-        del(node)
         self.length += 1
+        return node
 
     def addNodeTail(self, val):
         node = Node()
@@ -131,10 +132,11 @@ class LinkList(object):
             self.tail.next = node
             self.tail = node
         self.length += 1
+        return node
 
     def delNode(self, node):
         if node.prev:
-            nove.prev.next = node.next
+            node.prev.next = node.next
         else:
             self.head = node.next
         if node.next:
@@ -143,6 +145,22 @@ class LinkList(object):
             self.tail = node.prev
         self.length -= 1
 
+    def moveNodeTail(self, node):
+        """Move node of this list to the tail, the node is relinked,
+        not reallocated.
+        """
+        if node is self.tail:
+            return
+        if node.prev:
+            node.prev.next = node.next
+        else:
+            self.head = node.next
+        node.next.prev = node.prev
+        node.prev = self.tail
+        node.next = None
+        self.tail.next = node
+        self.tail = node
+
     def index(self, idx):
         """Return the node at the specified index.
 
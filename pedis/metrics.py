@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.metrics
+~~~~~~~~~~~~~
+
+Serve the counters of the server to Prometheus, in the text exposition
+format, on the `metrics-port`::
+
+    curl http://127.0.0.1:9121/metrics
+
+The listener and its connections are file events of the server's
+eventloop, a scrape is served between two commands like a client. The
+metrics are read from the counters of the server and the sizes of the
+dbs, the keys are never scanned, and the response is written without
+blocking, a slow scraper only delays itself.
+"""
+
+import time
+import errno
+import socket
+from . import event
+from .server import server, debug, wain
+from .latency import HISTOGRAM_BUCKETS
+from .utils import memoryRss, memoryPeak
+from ._compat import tobytes, tostr
+
+
+__all__ = ['startMetricsServer', 'generateMetrics']
+
+
+#: Max bytes of the request headers, the connection is closed if they
+#: are longer
+METRICS_MAX_REQUEST = 1024 * 8
+
+#: Buckets of the command latency histograms, up to 2^23 microseconds,
+#: the latencies more than 8s are only counted by the +Inf bucket
+METRICS_HISTOGRAM_BUCKETS = min(24, HISTOGRAM_BUCKETS)
+
+IOBUF_LEN = 1024 * 16
+
+
+class MetricsConnection(object):
+
+    """An http connection of a scraper."""
+
+    def __init__(self, sobj):
+        self.sobj = sobj
+        self.querybuf = b''
+        #: Response not written yet
+        self.response = b''
+
+    def __repr__(self):
+        return '<MetricsConnection sobj={}>'.format(self.sobj)
+
+
+def _escapeLabel(val):
+    """Escape a label value.
+
+    >>> print(_escapeLabel('say "hi"'))
+    say \\"hi\\"
+    """
+    return val.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class _Exposition(object):
+
+    """Lines of the text exposition, the HELP and TYPE lines are added
+    before the first sample of a metric.
+
+    >>> e = _Exposition()
+    >>> e.add('pedis_up', 'gauge', 'Server is up.', 1)
+    >>> e.add('pedis_db_keys', 'gauge', 'Keys in the db.', 3, db='0')
+    >>> print(e.text().strip())
+    # HELP pedis_up Server is up.
+    # TYPE pedis_up gauge
+    pedis_up 1
+    # HELP pedis_db_keys Keys in the db.
+    # TYPE pedis_db_keys gauge
+    pedis_db_keys{db="0"} 3
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.declared = set()
+
+    def add(self, name, type_, help_, value, **labels):
+        family = name
+        for suffix in ('_bucket', '_sum', '_count'):
+            if type_ == 'histogram' and name.endswith(suffix):
+                family = name[:-len(suffix)]
+        if family not in self.declared:
+            self.declared.add(family)
+            self.lines.append('# HELP {} {}'.format(family, help_))
+            self.lines.append('# TYPE {} {}'.format(family, type_))
+        if labels:
+            name += '{' + ','.join(
+                '{}="{}"'.format(k, _escapeLabel(str(v)))
+                for k, v in sorted(labels.items())) + '}'
+        self.lines.append('{} {}'.format(name, value))
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def _commandMetrics(e):
+    # The samples of a metric are listed together.
+    called = [(name, server.commands[name].stats)
+              for name in sorted(server.commands)
+              if server.commands[name].stats.calls]
+    for name, stats in called:
+        e.add('pedis_commands_total', 'counter',
+              'Calls of the command.', stats.calls, cmd=name)
+
+    help_ = 'Latency of the command calls in seconds.'
+    for name, stats in called:
+        counts = stats.histogram.counts
+        total = 0
+        for i in range(METRICS_HISTOGRAM_BUCKETS):
+            total += counts[i]
+            e.add('pedis_command_latency_seconds_bucket', 'histogram', help_,
+                  total, cmd=name, le=repr((1 << i) / 1e6))
+        e.add('pedis_command_latency_seconds_bucket', 'histogram', help_,
+              stats.calls, cmd=name, le='+Inf')
+        e.add('pedis_command_latency_seconds_sum', 'histogram', help_,
+              repr(stats.usec / 1e6), cmd=name)
+        e.add('pedis_command_latency_seconds_count', 'histogram', help_,
+              stats.calls, cmd=name)
+
+
+def generateMetrics():
+    """Return the metrics of the server in the text exposition format."""
+    e = _Exposition()
+
+    e.add('pedis_uptime_in_seconds', 'gauge',
+          'Seconds since the server started.',
+          int(time.time() - server.stat_starttime))
+
+    e.add('pedis_connected_clients', 'gauge', 'Connected clients.',
+          server.stat_numconnections)
+    e.add('pedis_blocked_clients', 'gauge',
+          'Clients blocked by BLPOP, BRPOPLPUSH or WAIT.',
+          server.stat_blocked_clients)
+    e.add('pedis_connections_received_total', 'counter',
+          'Connections accepted.', server.stat_numconnections_total)
+    e.add('pedis_rejected_connections_total', 'counter',
+          'Connections rejected.', server.stat_rejected_conn)
+
+    e.add('pedis_memory_rss_bytes', 'gauge',
+          'Resident set size of the process.', memoryRss())
+    e.add('pedis_memory_peak_bytes', 'gauge',
+          'Peak resident set size of the process.', memoryPeak())
+    e.add('pedis_lazyfree_pending_objects', 'gauge',
+          'Values waiting to be freed in background.',
+          server.lazyfree.pending())
+
+    e.add('pedis_commands_processed_total', 'counter',
+          'Commands processed.', server.stat_numcommands)
+    e.add('pedis_net_input_bytes_total', 'counter',
+          'Bytes read from the clients.', server.stat_net_input_bytes)
+    e.add('pedis_net_output_bytes_total', 'counter',
+          'Bytes written to the clients.', server.stat_net_output_bytes)
+    e.add('pedis_keyspace_hits_total', 'counter',
+          'Keys found by the read only commands.', server.stat_keyspace_hits)
+    e.add('pedis_keyspace_misses_total', 'counter',
+          'Keys not found by the read only commands.',
+          server.stat_keyspace_misses)
+    e.add('pedis_eventloop_cycles_total', 'counter',
+          'Eventloop cycles.', server.stat_eventloop_cycles)
+    e.add('pedis_eventloop_duration_seconds_total', 'counter',
+          'Time of the eventloop cycles, from waking up to sleeping.',
+          repr(server.stat_eventloop_duration_sum))
+    _commandMetrics(e)
+
+    e.add('pedis_rdb_changes_since_last_save', 'gauge',
+          'Changes to the keyspace since the last save.',
+          server.dirty - server.dirty_lastsave)
+    e.add('pedis_rdb_bgsave_in_progress', 'gauge',
+          'A background saving is in progress.', server.bgsaveinprogress)
+    e.add('pedis_rdb_last_save_timestamp_seconds', 'gauge',
+          'Unix time of the last successful save.', server.lastsave or 0)
+    e.add('pedis_rdb_last_bgsave_status', 'gauge',
+          'The last background saving succeeded.', server.lastbgsave_status)
+    e.add('pedis_latest_fork_seconds', 'gauge',
+          'Time the latest fork took.', repr(server.stat_fork_time / 1e6))
+
+    e.add('pedis_connected_slaves', 'gauge', 'Connected replicas.',
+          server.slaves.length)
+    e.add('pedis_master_repl_offset', 'gauge',
+          'Offset of the replication stream.', server.master_repl_offset)
+
+    for i, dict_ in enumerate(server.dicts):
+        if dict_:
+            e.add('pedis_db_keys', 'gauge', 'Keys in the db.', len(dict_),
+                  db=str(i))
+    return e.text()
+
+
+def _httpResponse(status, body, contentType='text/plain; charset=utf-8'):
+    return tobytes('HTTP/1.0 {}\r\nContent-Type: {}\r\n'
+                   'Content-Length: {}\r\nConnection: close\r\n\r\n{}'
+                   .format(status, contentType, len(body), body))
+
+
+def _handleRequest(request):
+    """Return the response to the request line."""
+    parts = request.split()
+    if len(parts) < 2 or parts[0] not in ('GET', 'HEAD'):
+        return _httpResponse('405 Method Not Allowed', '')
+    path = parts[1].split('?', 1)[0]
+    if path not in ('/', '/metrics'):
+        return _httpResponse('404 Not Found', '')
+    body = generateMetrics() if parts[0] == 'GET' else ''
+    return _httpResponse('200 OK', body,
+                         'text/plain; version=0.0.4; charset=utf-8')
+
+
+def _closeConnection(conn, mask):
+    server.el.deleteFileEvent(conn.sobj, mask)
+    conn.sobj.close()
+
+
+def readFromScraper(sobj, conn):
+    try:
+        data = sobj.recv(IOBUF_LEN)
+    except socket.error as e:
+        debug('. Metrics: read error: {}'.format(e))
+        _closeConnection(conn, event.READABLE)
+        return
+    if not data:
+        _closeConnection(conn, event.READABLE)
+        return
+
+    conn.querybuf += data
+    if b'\r\n\r\n' not in conn.querybuf and b'\n\n' not in conn.querybuf:
+        if len(conn.querybuf) > METRICS_MAX_REQUEST:
+            _closeConnection(conn, event.READABLE)
+        return
+
+    request = tostr(conn.querybuf.split(b'\n', 1)[0])
+    conn.response = _handleRequest(request)
+    server.el.deleteFileEvent(sobj, event.READABLE)
+    server.el.createFileEvent(sobj, event.WRITABLE, writeToScraper, conn)
+
+
+def writeToScraper(sobj, conn):
+    try:
+        nwritten = sobj.send(conn.response)
+    except socket.error as e:
+        if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+            return
+        debug('. Metrics: write error: {}'.format(e))
+        _closeConnection(conn, event.WRITABLE)
+        return
+    conn.response = conn.response[nwritten:]
+    if not conn.response:
+        _closeConnection(conn, event.WRITABLE)
+
+
+def acceptScraper(sobj, clientData):
+    try:
+        cobj, addr = sobj.accept()
+    except socket.error:
+        return
+    cobj.setblocking(False)
+    server.el.createFileEvent(cobj, event.READABLE, readFromScraper,
+                              MetricsConnection(cobj))
+
+
+def startMetricsServer(port):
+    """Listen for the scrapers on port, in the eventloop of the server.
+
+    Returns:
+        the listening socket, None if it can't be bound.
+    """
+    sobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sobj.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        sobj.bind((server.host, port))
+    except socket.error as e:
+        wain('# Can\'t serve the metrics on port {}: {}'.format(port, e))
+        sobj.close()
+        return None
+    sobj.listen(32)
+    sobj.setblocking(False)
+    server.el.createFileEvent(sobj, event.READABLE, acceptScraper, None)
+    return sobj
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.microbench
+~~~~~~~~~~~~~~~~
+
+Microbenchmarks of the hot paths of the server::
+
+    python -m pedis.microbench
+    python -m pedis.microbench --baseline microbench.json
+    python -m pedis.microbench --baseline microbench.json --save
+    python -m pedis.microbench -b linklist,eventloop --keys 100000
+
+Every benchmark runs its operations `repeat` times and keeps the
+fastest run, the result is the time per operation. With a baseline
+file, the results are compared to it and a benchmark slower than the
+baseline by more than `threshold` is a regression, the exit status is
+1. The results are saved to a baseline file not existing yet, or with
+--save.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager
+from .embedded import Embedded
+from .server import server, PedisClient
+from .linklist import LinkList
+from .event import EventLoop, READABLE, FILE_EVENTS, DONT_WAIT
+
+
+#: Registered benchmarks, (name, function(opts) returning a context
+#: manager of (run, number of operations per run))
+BENCHMARKS = []
+
+
+def benchmark(name):
+    """Register a benchmark, the decorated function sets up the data
+    and yields (run, ops), the code after yield cleans up.
+    """
+    def decorator(f):
+        BENCHMARKS.append((name, contextmanager(f)))
+        return f
+    return decorator
+
+
+def _withSetup(run, setup):
+    """Call setup before run, setup time is not measured."""
+    run.setup = setup
+    return run
+
+
+#------------------------------- LinkList -------------------------------------
+
+@benchmark('linklist.addNodeTail')
+def _linklistAdd(opts):
+    def run():
+        l = LinkList()
+        for i in range(opts.size):
+            l.addNodeTail(i)
+    yield run, opts.size
+
+
+@benchmark('linklist.delNode')
+def _linklistDel(opts):
+    lists = []
+
+    def run():
+        l = lists.pop()
+        while l.length:
+            l.delNode(l.head)
+
+    def setup():
+        l = LinkList()
+        for i in range(opts.size):
+            l.addNodeTail(i)
+        lists.append(l)
+
+    yield _withSetup(run, setup), opts.size
+
+
+@benchmark('linklist.iterate')
+def _linklistIterate(opts):
+    l = LinkList()
+    for i in range(opts.size):
+        l.addNodeTail(i)
+
+    def run():
+        for node in l:
+            pass
+    yield run, opts.size
+
+
+@benchmark('linklist.index')
+def _linklistIndex(opts):
+    l = LinkList()
+    for i in range(opts.size):
+        l.addNodeTail(i)
+
+    def run():
+        for i in range(10):
+            l.index(opts.size // 2)
+    yield run, 10
+
+
+#------------------------------ EventLoop -------------------------------------
+
+def _socketpairs(n):
+    pairs = [socket.socketpair() for i in range(n)]
+    for r, w in pairs:
+        r.setblocking(False)
+    return pairs
+
+
+def _closePairs(pairs):
+    for r, w in pairs:
+        r.close()
+        w.close()
+
+
+@benchmark('eventloop.createDeleteFileEvent')
+def _eventloopCreateDelete(opts):
+    pairs = _socketpairs(opts.fds + 1)
+    el = EventLoop()
+    for r, w in pairs[1:]:
+        el.createFileEvent(r, READABLE, None, None)
+    sobj = pairs[0][0]
+
+    def run():
+        for i in range(100):
+            el.createFileEvent(sobj, READABLE, None, None)
+            el.deleteFileEvent(sobj, READABLE)
+    try:
+        yield run, 100
+    finally:
+        _closePairs(pairs)
+
+
+@benchmark('eventloop.processEvents')
+def _eventloopProcess(opts):
+    pairs = _socketpairs(opts.fds)
+    el = EventLoop()
+
+    def readProc(sobj, clientData):
+        sobj.recv(16)
+
+    for r, w in pairs:
+        el.createFileEvent(r, READABLE, readProc, None)
+    # The first registered fd is the last one the loop scans.
+    writer = pairs[0][1]
+
+    def run():
+        for i in range(100):
+            writer.send(b'x')
+            el.processEvents(FILE_EVENTS | DONT_WAIT)
+    try:
+        yield run, 100
+    finally:
+        _closePairs(pairs)
+
+
+#-------------------------------- Replies -------------------------------------
+
+def _replyClient():
+    """A client with a reply pending, so addReply doesn't install the
+    write event, the replies are dropped after every run.
+    """
+    client = PedisClient()
+    client.dictid = 0
+    client.reply = LinkList()
+    client.reply.addNodeTail('')
+    return client
+
+
+def _dropReplies(client):
+    while client.reply.length > 1:
+        client.reply.delNode(client.reply.tail)
+    # Not to run the output buffer limits check on every reply.
+    client.reply_bytes = 0
+
+
+@benchmark('reply.addReply')
+def _replyStatus(opts):
+    client = _replyClient()
+
+    def run():
+        for i in range(opts.size):
+            server.addReply(client, '+OK\r\n')
+        _dropReplies(client)
+    yield run, opts.size
+
+
+@benchmark('reply.addReplyBulk')
+def _replyBulk(opts):
+    client = _replyClient()
+    val = 'x' * 64
+
+    def run():
+        for i in range(opts.size):
+            server.addReplyBulk(client, val)
+        _dropReplies(client)
+    yield run, opts.size
+
+
+@benchmark('reply.addReplyMultiBulk')
+def _replyMultiBulk(opts):
+    client = _replyClient()
+    items = ['item:{}'.format(i) for i in range(10)] + [None]
+
+    def run():
+        for i in range(opts.size // 10):
+            server.addReplyMultiBulk(client, items)
+        _dropReplies(client)
+    yield run, opts.size // 10
+
+
+#------------------------------- Keyspace -------------------------------------
+
+@contextmanager
+def _keyspace(opts):
+    """Replace the dbs with opts.keys keys in db 0 for the benchmark."""
+    dicts = server.dicts
+    server.dicts = [{} for i in range(server.dbnum)]
+    server.dicts[0] = dict(('key:{}'.format(i), 'value:{}'.format(i))
+                           for i in range(opts.keys))
+    try:
+        yield
+    finally:
+        server.dicts = dicts
+
+
+@benchmark('snapshot.save')
+def _snapshotSave(opts):
+    tmpdir = tempfile.mkdtemp(prefix='pedis-microbench-')
+    filepath = os.path.join(tmpdir, 'dump.pdb')
+    with _keyspace(opts):
+        try:
+            yield lambda: server.saveDb(filepath), opts.keys
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+@benchmark('snapshot.load')
+def _snapshotLoad(opts):
+    tmpdir = tempfile.mkdtemp(prefix='pedis-microbench-')
+    filepath = os.path.join(tmpdir, 'dump.pdb')
+    lazy = server.lazyfree_lazy_server_del
+    with _keyspace(opts):
+        server.saveDb(filepath)
+        # Free the replaced keys in the run, not in the background.
+        server.lazyfree_lazy_server_del = 0
+        try:
+            yield lambda: server.loadDb(filepath), opts.keys
+        finally:
+            server.lazyfree_lazy_server_del = lazy
+            shutil.rmtree(tmpdir)
+
+
+@benchmark('keys.pattern')
+def _keysPattern(opts):
+    db = Embedded()
+    with _keyspace(opts):
+        yield lambda: db.execute('KEYS', 'key:1*'), opts.keys
+
+
+#-------------------------------- Harness -------------------------------------
+
+def timeBenchmark(f, opts):
+    """Run the benchmark f.
+
+    Returns:
+        seconds per operation of the fastest run.
+    """
+    with f(opts) as (run, ops):
+        best = None
+        for i in range(opts.repeat):
+            if hasattr(run, 'setup'):
+                run.setup()
+            start = time.time()
+            run()
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+    return best / ops
+
+
+def compareResults(results, baseline, threshold):
+    """Compare the results to the baseline.
+
+    Returns:
+        names of the regressed benchmarks.
+
+    >>> compareResults({'a': 1.3, 'b': 1.0}, {'a': 1.0, 'b': 1.0}, 0.2)
+    ['a']
+    """
+    return sorted(name for name, secs in results.items()
+                  if name in baseline and
+                  secs > baseline[name] * (1 + threshold))
+
+
+def parseOptions(argv):
+    parser = argparse.ArgumentParser(prog='python -m pedis.microbench',
+                                     description=__doc__.split('::')[0])
+    parser.add_argument('-b', dest='benchmarks', default='',
+                        help='comma separated prefixes of the benchmarks '
+                             'to run, default all')
+    parser.add_argument('--size', type=int, default=100000,
+                        help='operations of the list and reply benchmarks '
+                             '(default 100000)')
+    parser.add_argument('--fds', type=int, default=256,
+                        help='fds registered in the eventloop (default 256)')
+    parser.add_argument('--keys', type=int, default=1000000,
+                        help='keys of the snapshot and keys benchmarks '
+                             '(default 1000000)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of every benchmark (default 5)')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='baseline results to compare to')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='slowdown ratio over the baseline failing a '
+                             'benchmark (default 0.2)')
+    parser.add_argument('--save', action='store_true',
+                        help='save the results to the baseline file')
+    opts = parser.parse_args(argv)
+    opts.benchmarks = [p for p in opts.benchmarks.split(',') if p]
+    return opts
+
+
+def main(argv=None):
+    opts = parseOptions(sys.argv[1:] if argv is None else argv)
+    # Keep the output for the results.
+    logging.disable(logging.INFO)
+
+    baseline = {}
+    if opts.baseline and os.path.exists(opts.baseline):
+        with open(opts.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    for name, f in BENCHMARKS:
+        if opts.benchmarks and \
+           not any(name.startswith(p) for p in opts.benchmarks):
+            continue
+        results[name] = secs = timeBenchmark(f, opts)
+        line = '{:<34} {:>12.1f} ns/op'.format(name, secs * 1e9)
+        if name in baseline:
+            line += '  {:>12.1f} ns/op baseline {:>+7.1f}%'.format(
+                baseline[name] * 1e9,
+                (secs / baseline[name] - 1) * 100)
+        print(line)
+
+    regressions = compareResults(results, baseline, opts.threshold)
+    for name in regressions:
+        print('# Regression: {} is more than {:.0f}% slower than the '
+              'baseline'.format(name, opts.threshold * 100))
+
+    if opts.baseline and (opts.save or not baseline):
+        with open(opts.baseline, 'w') as f:
+            json.dump({
+                'time': int(time.time()),
+                'python': platform.python_version(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        print('- Results saved to {}'.format(opts.baseline))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
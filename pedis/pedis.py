@@ -12,18 +12,29 @@ The actual server and all commands here.
     This is Redis protocal. Check out Redis docs.
 """
 
+import os
 import random
+import itertools
 from fnmatch import fnmatch
-from server import server
-from utils import shared
-from _compat import pickle
-
-
-CMD_INLINE  = 1
-CMD_BULK = 2
-
-
-@server.command(1, CMD_INLINE)
+import time
+import socket
+import platform
+from .server import server, debug, wain, LIST_HEAD, LIST_TAIL, \
+    CMD_INLINE, CMD_BULK, CMD_NOPROPAGATE, CMD_WRITE, CMD_READONLY, \
+    CMD_DENYOOM, CMD_FAST, CMD_FLAG_NAMES, CLIENT_MULTI, \
+    CLIENT_DIRTY_CAS, CLIENT_DIRTY_EXEC, CLIENT_NATIVE, CLIENT_SLAVE, \
+    CLIENT_MASTER, CLIENT_ASKING, CLIENT_MONITOR, CLIENT_BLOCKED, \
+    CLIENT_CLOSE_ASAP, SLAVE_STATE_SEND_BULK, \
+    SLAVE_STATE_ONLINE, REPL_STATE_TRANSFER, REPL_STATE_CONNECTED, \
+    FRONTEND_PEDIS
+from .cluster import CLUSTER_SLOTS, keyHashSlot
+from .utils import shared, StatusReply, dumpValue, loadValue, bytesToHuman, \
+    memoryRss, memoryPeak
+from .scripting import ScriptError, compileScript, evalScript, sha1hex
+from ._compat import integer_types
+
+
+@server.command(1, CMD_INLINE | CMD_FAST)
 def ping(c):
     """Test connection, return PONG.
 
@@ -33,16 +44,14 @@ def ping(c):
     server.addReply(c, shared.pong)
 
 
-@server.command(2, CMD_BULK)
+@server.command(2, CMD_BULK | CMD_FAST)
 def echo(c):
     """Return what you send.
 
     ::
         ECHO val
     """
-    server.addReply(c, '${}\r\n'.format(len(c.argv[1])))
-    server.addReply(c, c.argv[1])
-    server.addReply(c, shared.crlf)
+    server.addReplyBulk(c, c.argv[1])
 
 
 def _setGeneric(c, nx):
@@ -52,14 +61,20 @@ def _setGeneric(c, nx):
     if nx and (key in c.dict_):
         server.addReply(c, shared.one)
         return
+    old = c.dict_.get(key)
     c.dict_[key] = val
+    if old is not None and server.lazyfree_lazy_server_del:
+        server.freeObjectAsync(old)
+        del(old)
+    server.signalModifiedKey(c.dictid, key)
     if nx:
         server.addReply(c, shared.one)
     else:
         server.addReply(c, shared.ok)
 
 
-@server.command(3, CMD_BULK, cmd_name='set')
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                cmd_name='set', keys=(1, 1, 1))
 def set_(c):
     """Set a key to a string value.
 
@@ -69,7 +84,8 @@ def set_(c):
     _setGeneric(c, 0)
 
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def setnx(c):
     """Set a key to a string value if the key does not exist.
 
@@ -79,44 +95,108 @@ def setnx(c):
     _setGeneric(c, 1)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_READONLY | CMD_FAST, keys=(1, 1, 1))
 def get(c):
     """Return the string value of the key.
 
     ::
         GET key
     """
-    key = c.argv[1]
+    val = server.lookupKeyRead(c, c.argv[1])
 
-    if key not in c.dict_:
+    if val is None:
         server.addReply(c, shared.nil)
+    elif not isinstance(val, str):
+        server.addReply(c, shared.wrongtypeerr)
     else:
-        val = c.dict_[key]
-        server.addReply(c, '${}\r\n'.format(len(val)))
-        server.addReply(c, repr(val))
-        server.addReply(c, shared.crlf)
+        server.addReplyBulk(c, val)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(-2, CMD_INLINE | CMD_READONLY | CMD_FAST, keys=(1, -1, 1))
 def exists(c):
-    """Test if a key exists.
+    """Test if keys exist.
 
     Replys:
-        1: exists
-        0: not exists
+        number of the given keys that exist.
 
     ::
-        EXISTS key
+        EXISTS key1 key2 ... keyN
     """
-    key = c.argv[1]
+    n = 0
+
+    for key in c.argv[1:]:
+        if server.lookupKeyRead(c, key) is not None:
+            n += 1
+    server.addReplyLongLong(c, n)
+
+
+@server.command(-2, CMD_INLINE | CMD_READONLY, keys=(1, -1, 1))
+def mget(c):
+    """Return the string values of all the given keys, nil for the
+        keys not exist or not holding a string value.
+
+    ::
+        MGET key1 key2 ... keyN
+    """
+    rv = []
 
-    if key in c.dict_:
+    for key in c.argv[1:]:
+        val = server.lookupKeyRead(c, key)
+        if not isinstance(val, str):
+            val = None
+        rv.append(val)
+    server.addReplyMultiBulk(c, rv)
+
+
+def _msetGeneric(c, nx):
+    """For mset and msetnx."""
+    if c.argc % 2 == 0:
+        server.addReply(c, '-ERR wrong number of arguments\r\n')
+        return
+
+    pairs = c.argv[1:]
+
+    if nx:
+        for key in pairs[::2]:
+            if key in c.dict_:
+                server.addReply(c, shared.zero)
+                return
+
+    for i in range(0, len(pairs), 2):
+        c.dict_[pairs[i]] = pairs[i + 1]
+        server.signalModifiedKey(c.dictid, pairs[i])
+    if nx:
         server.addReply(c, shared.one)
     else:
-        server.addReply(c, shared.zero)
+        server.addReply(c, shared.ok)
+
+
+@server.command(-3, CMD_BULK | CMD_WRITE | CMD_DENYOOM, keys=(1, -1, 2))
+def mset(c):
+    """Set multiple keys to multiple values.
+
+    ::
+        MSET key1 val1 key2 val2 ... keyN valN
+    """
+    _msetGeneric(c, 0)
+
+
+@server.command(-3, CMD_BULK | CMD_WRITE | CMD_DENYOOM, keys=(1, -1, 2))
+def msetnx(c):
+    """Set multiple keys to multiple values, only if none of the
+        keys exist.
 
+    Replys:
+        1: all the keys were set
+        0: no key was set
+
+    ::
+        MSETNX key1 val1 key2 val2 ... keyN valN
+    """
+    _msetGeneric(c, 1)
 
-@server.command(2, CMD_INLINE)
+
+@server.command(2, CMD_INLINE | CMD_READONLY)
 def keys(c):
     """Return all the keys matching a given pattern.
 
@@ -130,31 +210,46 @@ def keys(c):
     for key in keys:
         if fnmatch(key, pattern):
             rv.append(key)
-    if rv:
-        rv = ' '.join(rv) + '\r\n'
-    else:
-        rv = shared.zero
-    server.addReply(c, rv)
+    server.addReplyMultiBulk(c, rv)
 
 
-@server.command(2, CMD_INLINE, cmd_name='del')
+@server.command(-2, CMD_INLINE | CMD_WRITE, cmd_name='del', keys=(1, -1, 1))
 def del_(c):
-    """Delete a key.
+    """Delete keys, large values are freed in background like UNLINK
+        if lazyfree-lazy-user-del is yes.
 
     Replys:
-        1: del ok
-        0: key not exists
+        number of keys deleted.
 
     ::
-        DEL key
+        DEL key1 key2 ... keyN
     """
-    key = c.argv[1]
+    _delGeneric(c, server.lazyfree_lazy_user_del)
 
-    try:
-        del(c.dict_[key])
-        server.addReply(c, shared.one)
-    except KeyError:
-        server.addReply(c, shared.zero)
+
+@server.command(-2, CMD_INLINE | CMD_WRITE, keys=(1, -1, 1))
+def unlink(c):
+    """Delete keys, the values of more than lazyfree-threshold
+        elements are freed in background, not blocking the server.
+
+    Replys:
+        number of keys deleted.
+
+    ::
+        UNLINK key1 key2 ... keyN
+    """
+    _delGeneric(c, 1)
+
+
+def _delGeneric(c, lazy):
+    """For del and unlink."""
+    n = 0
+
+    for key in c.argv[1:]:
+        if server.dbDelete(c.dictid, key, lazy):
+            server.signalModifiedKey(c.dictid, key)
+            n += 1
+    server.addReplyLongLong(c, n)
 
 
 def _incrDecr(c, x):
@@ -162,25 +257,23 @@ def _incrDecr(c, x):
 
     Returns:
         0: key is not integer.
-        val: current val of the key.
+        val: current val of the key, a key not exists is 0.
     """
     key = c.argv[1]
 
     try:
-        val = c.dict_[key]
-        try:
-            val = int(val)
-            val += x
-            rv = val
-            c.dict_[key] = str(val)
-        except ValueError:
-            rv = 0
-    except KeyError:
+        val = int(c.dict_.get(key, 0))
+        val += x
+        rv = val
+        c.dict_[key] = str(val)
+        server.signalModifiedKey(c.dictid, key)
+    except (TypeError, ValueError):
         rv = 0
-    server.addReply(c, repr(rv) + '\r\n')
+    server.addReplyLongLong(c, rv)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def incr(c):
     """Increment the integer value of key.
 
@@ -190,7 +283,8 @@ def incr(c):
     _incrDecr(c, 1)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def decr(c):
     """Decrement the integer value of key.
 
@@ -200,7 +294,8 @@ def decr(c):
     _incrDecr(c, -1)
 
 
-@server.command(3, CMD_INLINE)
+@server.command(3, CMD_INLINE | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def incrby(c):
     """Increment the integer value of key by integer.
 
@@ -214,7 +309,8 @@ def incrby(c):
     _incrDecr(c, x)
 
 
-@server.command(3, CMD_INLINE)
+@server.command(3, CMD_INLINE | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def decrby(c):
     """Decrement the integer value of key by integer.
 
@@ -228,7 +324,7 @@ def decrby(c):
     _incrDecr(c, -x)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_FAST)
 def select(c):
     """Select the DB having the specified index.
 
@@ -240,7 +336,7 @@ def select(c):
     try:
         id_ = int(c.argv[1])
     except ValueError:
-        has_err = 1
+        id_ = -1
 
     if id_ not in range(server.dbnum):
         has_err = 1
@@ -249,37 +345,44 @@ def select(c):
         server.addReply(c, '-ERR invalid DB index\r\n')
     else:
         debug('. Select DB: {}'.format(id_))
-        c.dict_ = server.dicts[id_]
         c.dictid = id_
         server.addReply(c, shared.ok)
 
 
-@server.command(1, CMD_INLINE)
+@server.command(1, CMD_INLINE | CMD_READONLY | CMD_FAST)
 def dbsize(c):
     """Return the number of keys in the current db.
 
     ::
         DBSIZE
     """
-    server.addReply(c, repr(size) + '\r\n')
+    server.addReplyLongLong(c, len(c.dict_))
 
 
 def _renameGeneric(c, nx):
+    """For rename and renamenx."""
     oldname, newname = c.argv[1:]
+    dict_ = c.dict_
 
-    if nx and newname in c.dict_:
-        server.addReply(c, shared.one)
+    if oldname not in dict_:
+        server.addReply(c, '-ERR no such key\r\n')
+        return
+    if nx and newname in dict_:
+        server.addReply(c, shared.zero)
         return
-    try:
-        val = c.dict_.pop(oldname)
-        c.dict_[newname] = val
-        rv = shared.ok
-    except KeyError:
-        rv = shared.zero
 
-    server.addReply(c, rv)
+    if newname != oldname:
+        old = dict_.get(newname)
+        dict_[newname] = dict_.pop(oldname)
+        if old is not None and server.lazyfree_lazy_server_del:
+            server.freeObjectAsync(old)
+            del(old)
+        server.signalModifiedKey(c.dictid, oldname)
+        server.signalModifiedKey(c.dictid, newname)
+    server.addReply(c, shared.one if nx else shared.ok)
 
 
+@server.command(3, CMD_INLINE | CMD_WRITE | CMD_FAST, keys=(1, 2, 1))
 def rename(c):
     """Rename the old key in the new one, destroing the newname key
         if it already exists.
@@ -287,9 +390,10 @@ def rename(c):
     ::
         RENAME oldname newname
     """
-    self._renameGeneric(c, 0)
+    _renameGeneric(c, 0)
 
 
+@server.command(3, CMD_INLINE | CMD_WRITE | CMD_FAST, keys=(1, 2, 1))
 def renamenx(c):
     """Rename the old key in the new one, if the newname key does
         not already exists.
@@ -297,74 +401,125 @@ def renamenx(c):
     ::
         RENAMENX oldname newname
     """
-    self._renameGeneric(c, 1)
+    _renameGeneric(c, 1)
 
 
 #------------------------------ List operations ------------------------------
 
-def _pushGeneric(c, where):
-    key, item = c.argv[1:]
+def _serveClientBlockedOnKey(dictid, key, item):
+    """Hand the item over to the first client blocked on key.
 
-    if key not in c.dict_:
-        _l = []
-    else:
-        _l = c.dict_[key]
-        if not isinstance(_l, list):
-            server.addReply(c, shared.wrongtypeerr)
-            return
+    Returns:
+        1: the item is consumed by a blocked client.
+        0: no client is waiting for the item.
+    """
+    waiters = server.blockingkeys[dictid].get(key)
+
+    while waiters:
+        receiver = waiters.head.val
+        target = receiver.blockingtarget
+        server.unblockClient(receiver)
+
+        # Replicas see the push followed by the pop of the receiver.
+        if target is None:
+            server.signalModifiedKey(dictid, key)
+            server.alsoPropagate(dictid, ['lpop', key])
+            server.addReplyMultiBulk(receiver, [key, item])
+            return 1
+
+        # BRPOPLPUSH, the target may be changed to other type.
+        _t = server.dicts[dictid].get(target)
+        if _t is not None and not isinstance(_t, list):
+            server.addReply(receiver, shared.wrongtypeerr)
+            waiters = server.blockingkeys[dictid].get(key)
+            continue
+        server.signalModifiedKey(dictid, key)
+        server.alsoPropagate(dictid, ['rpop', key])
+        server.alsoPropagate(dictid, ['lpush', target, item])
+        _listPush(dictid, target, item, LIST_HEAD)
+        server.addReplyBulk(receiver, item)
+        return 1
+
+    return 0
+
+
+def _listPush(dictid, key, item, where):
+    """Push item to the List at key, or to the client blocked on it.
+
+    Returns:
+        1: pushed.
+        0: key is holding other type of value.
+    """
+    dict_ = server.dicts[dictid]
+    _l = dict_.get(key)
 
+    if _l is not None and not isinstance(_l, list):
+        return 0
+
+    if _serveClientBlockedOnKey(dictid, key, item):
+        return 1
+
+    if _l is None:
+        _l = dict_[key] = []
     if where == LIST_HEAD:
         _l.insert(0, item)
     else:
         _l.append(item)
+    server.signalModifiedKey(dictid, key)
+    return 1
 
-    c.dict_[key] = _l
-    server.addReply(c, shared.ok)
+
+def _pushGeneric(c, where):
+    key, item = c.argv[1:]
+
+    if _listPush(c.dictid, key, item, where):
+        server.addReply(c, shared.ok)
+    else:
+        server.addReply(c, shared.wrongtypeerr)
 
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def rpush(c):
     """Append an element to the tail of the List value at key.
 
     ::
         RPUSH key val
     """
-    self._pushGeneric(c, LIST_TAIL)
+    _pushGeneric(c, LIST_TAIL)
 
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def lpush(c):
     """Append an element to the head of the List value at key.
 
     ::
         LPUSH key val
     """
-    self._pushGeneric(c, LIST_HEAD)
+    _pushGeneric(c, LIST_HEAD)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_READONLY | CMD_FAST, keys=(1, 1, 1))
 def llen(c):
     """Return the length of the List value at key.
 
     ::
         LLEN key
     """
-    key = c.argv[1]
+    _l = server.lookupKeyRead(c, c.argv[1])
 
-    if key not in c.dict_:
-        rv = shared.nil
+    if _l is None:
+        server.addReply(c, shared.zero)
         return
 
-    _l = c.dict_[key]
     if not isinstance(_l, list):
-        rv = shared.minus2
+        server.addReply(c, shared.wrongtypeerr)
     else:
-        rv = repr(len(_l)) + '\r\n'
-
-    server.addReply(c, rv)
+        server.addReplyLongLong(c, len(_l))
 
 
-@server.command(4, CMD_INLINE)
+@server.command(4, CMD_INLINE | CMD_READONLY, keys=(1, 1, 1))
 def lrange(c):
     """Return a range of elements from the List at key.
 
@@ -372,12 +527,12 @@ def lrange(c):
         LRANGE key start end
     """
     key, start, end = c.argv[1:]
+    _l = server.lookupKeyRead(c, key)
 
-    if key not in c.dict_:
+    if _l is None:
         server.addReply(c, shared.nil)
         return
 
-    _l = c.dict_[key]
     if not isinstance(_l, list):
         server.addReply(c, shared.wrongtypeerr)
         return
@@ -390,10 +545,10 @@ def lrange(c):
         return
 
     _range = _l[start:end]
-    server.addReply(c, repr(_range) + '\r\n')
+    server.addReplyMultiBulk(c, _range)
 
 
-@server.command(4, CMD_BULK)
+@server.command(4, CMD_BULK | CMD_WRITE, keys=(1, 1, 1))
 def ltrim(c):
     """Trim the list at key to the specified range of elements.
 
@@ -418,11 +573,12 @@ def ltrim(c):
         server.addReply(c, shared.nil)
         return
 
-    del l[start:end]
-    server.addReply(s, shared.ok)
+    del _l[start:end]
+    server.signalModifiedKey(c.dictid, key)
+    server.addReply(c, shared.ok)
 
 
-@server.command(3, CMD_INLINE)
+@server.command(3, CMD_INLINE | CMD_READONLY, keys=(1, 1, 1))
 def lindex(c):
     """Return the element at index position from the List at key.
 
@@ -430,12 +586,12 @@ def lindex(c):
         LINDEX key index
     """
     key, index, = c.argv[1:]
+    _l = server.lookupKeyRead(c, key)
 
-    if key not in c.dict_:
+    if _l is None:
         server.addReply(c, shared.nil)
         return
 
-    _l = c.dict_[key]
     if not isinstance(_l, list):
         server.addReply(c, shared.wrongtypeerr)
         return
@@ -448,12 +604,12 @@ def lindex(c):
 
     try:
         item = _l[index]
-        server.addReply(c, repr(item) + '\r\n')
+        server.addReplyBulk(c, item)
     except IndexError:
         server.addReply(c, shared.nil)
 
 
-@server.command(4, CMD_BULK)
+@server.command(4, CMD_BULK | CMD_WRITE | CMD_DENYOOM, keys=(1, 1, 1))
 def lset(c):
     """Set a new value as the element at index position of the
         List at key.
@@ -480,12 +636,13 @@ def lset(c):
 
     try:
         _l[index] = val
+        server.signalModifiedKey(c.dictid, key)
         server.addReply(c, shared.ok)
     except IndexError:
         server.addReply(c, "-ERR index out of range\r\n")
 
 
-@server.command(4, CMD_BULK)
+@server.command(4, CMD_BULK | CMD_WRITE, keys=(1, 1, 1))
 def lrem(c):
     """Remove the first-N, last-N, or all the elements matching
         value from the List at key.
@@ -507,47 +664,74 @@ def lrem(c):
     try:
         toremove = int(count)
     except ValueError:
-        server.addReply(c, shared.minus1)
+        server.addReply(c, '-ERR value is not an integer\r\n')
+        return
 
+    # Count 0 removes all the matching elements, a negative count
+    # removes from the tail.
+    limit = abs(toremove)
+    kept = []
     removed = 0
-    if toremove >= 0:
-        for x in _l:
-            if toremove and _l[x] == value:
-                _l.remove(x)
-                toremove -= 1
-                removed += 1
-    else:
-        for i, x in enumerate(reversed(_l)):
-            if toremove and _l[x] == value:
-                _i = -i - 1
-                _l.pop(_i)
-                toremove += 1
-                removed += 1
+    for x in (reversed(_l) if toremove < 0 else _l):
+        if x == value and (not limit or removed < limit):
+            removed += 1
+        else:
+            kept.append(x)
 
-    server.addReply(c, repr(removed) + '\r\n')
+    if removed:
+        if toremove < 0:
+            kept.reverse()
+        _l[:] = kept
+        if not _l:
+            del(c.dict_[key])
+        server.signalModifiedKey(c.dictid, key)
 
+    server.addReplyLongLong(c, removed)
 
-def _popGeneric(c, where):
-    key = c.argv[1]
 
-    if key not in c.dict_:
-        server.addReply(c, shared.nil)
-    else:
-        _l = c.dict_[key]
-        if not isinstance(_l, list):
-            server.addReply(c, shared.wrongtypeerr)
-            return
+def _listPop(c, key, where):
+    """Pop an item from the List at key, deleting the key when the
+        List gets empty.
+
+    Returns:
+        None if the List is empty.
+    """
+    _l = c.dict_[key]
+
     try:
         if where == LIST_HEAD:
             item = _l.pop(0)
         else:
             item = _l.pop()
-        server.addReply(c, repr(item) + '\r\n')
     except IndexError:
+        item = None
+
+    if not _l:
+        del(c.dict_[key])
+    if item is not None:
+        server.signalModifiedKey(c.dictid, key)
+    return item
+
+
+def _popGeneric(c, where):
+    key = c.argv[1]
+
+    if key not in c.dict_:
+        server.addReply(c, shared.nil)
+        return
+
+    if not isinstance(c.dict_[key], list):
+        server.addReply(c, shared.wrongtypeerr)
+        return
+
+    item = _listPop(c, key, where)
+    if item is None:
         server.addReply(c, shared.nil)
+    else:
+        server.addReplyBulk(c, item)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_WRITE | CMD_FAST, keys=(1, 1, 1))
 def lpop(c):
     """Return and remove (atomically) the first element of the
         List at key.
@@ -555,10 +739,10 @@ def lpop(c):
     ::
         LPOP key
     """
-    self._popGeneric(c, LIST_HEAD)
+    _popGeneric(c, LIST_HEAD)
 
 
-@server.command(2, CMD_INLINE)
+@server.command(2, CMD_INLINE | CMD_WRITE | CMD_FAST, keys=(1, 1, 1))
 def rpop(c):
     """Return and remove (atomically) the last element of the
         List at key.
@@ -566,12 +750,117 @@ def rpop(c):
     ::
         RPOP key
     """
-    self._popGeneric(c, LIST_TAIL)
+    _popGeneric(c, LIST_TAIL)
+
+
+def _getTimeout(c, timeout):
+    """Parse the timeout of blocking commands.
+
+    Returns:
+        -1: timeout is invalid, error is replied.
+    """
+    try:
+        timeout = int(timeout)
+    except ValueError:
+        timeout = -1
+
+    if timeout < 0:
+        server.addReply(c, '-ERR timeout is not an integer '
+                           'or out of range\r\n')
+        return -1
+    return timeout
+
+
+def _bpopGeneric(c, where):
+    """For blpop and brpop."""
+    keys = c.argv[1:-1]
+    timeout = _getTimeout(c, c.argv[-1])
+
+    if timeout == -1:
+        return
+
+    for key in keys:
+        if key not in c.dict_:
+            continue
+        if not isinstance(c.dict_[key], list):
+            server.addReply(c, shared.wrongtypeerr)
+            return
+        item = _listPop(c, key, where)
+        if item is not None:
+            server.addReplyMultiBulk(c, [key, item])
+            return
+
+    # None of the Lists has elements, wait for a push. A transaction,
+    # the master or a native client can't block, just like timeout.
+    if c.flag & (CLIENT_MULTI | CLIENT_MASTER | CLIENT_NATIVE):
+        server.addReply(c, shared.nullmultibulk)
+        return
+    server.blockForKeys(c, keys, timeout)
+
+
+@server.command(-3, CMD_INLINE | CMD_WRITE, keys=(1, -2, 1))
+def blpop(c):
+    """Blocking LPOP, pop from the first non empty List of the keys,
+        or block until another client pushes to one of them.
+
+    Replys:
+        key and popped element, nil multibulk on timeout.
+
+    ::
+        BLPOP key1 key2 ... keyN timeout
+    """
+    _bpopGeneric(c, LIST_HEAD)
+
+
+@server.command(-3, CMD_INLINE | CMD_WRITE, keys=(1, -2, 1))
+def brpop(c):
+    """Blocking RPOP, pop from the first non empty List of the keys,
+        or block until another client pushes to one of them.
+
+    Replys:
+        key and popped element, nil multibulk on timeout.
+
+    ::
+        BRPOP key1 key2 ... keyN timeout
+    """
+    _bpopGeneric(c, LIST_TAIL)
+
+
+@server.command(4, CMD_INLINE | CMD_WRITE | CMD_DENYOOM, keys=(1, 2, 1))
+def brpoplpush(c):
+    """Pop the last element of the List at srckey and push it to the
+        head of the List at dstkey, block if srckey is empty.
+
+    ::
+        BRPOPLPUSH srckey dstkey timeout
+    """
+    srckey, dstkey = c.argv[1:3]
+    timeout = _getTimeout(c, c.argv[3])
+
+    if timeout == -1:
+        return
+
+    for key in (srckey, dstkey):
+        if key in c.dict_ and not isinstance(c.dict_[key], list):
+            server.addReply(c, shared.wrongtypeerr)
+            return
+
+    if not c.dict_.get(srckey):
+        if c.flag & (CLIENT_MULTI | CLIENT_MASTER | CLIENT_NATIVE):
+            server.addReply(c, shared.nullmultibulk)
+            return
+        server.blockForKeys(c, [srckey], timeout, target=dstkey)
+        return
+
+    item = _listPop(c, srckey, LIST_TAIL)
+    _listPush(c.dictid, dstkey, item, LIST_HEAD)
+    server.addReplyBulk(c, item)
 
 
 #------------------------------ Set operations -------------------------------
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_DENYOOM | CMD_FAST,
+                keys=(1, 1, 1))
 def sadd(c):
     """Add the specified member to the Set value at key.
 
@@ -585,15 +874,16 @@ def sadd(c):
     else:
         _s = c.dict_[key]
         if not isinstance(_s, set):
-            server.addReply(c, shared.minus2)
+            server.addReply(c, shared.wrongtypeerr)
             return
 
     _s.add(val)
     c.dict_[key] = _s
+    server.signalModifiedKey(c.dictid, key)
     server.addReply(c, shared.one)
 
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_WRITE | CMD_FAST, keys=(1, 1, 1))
 def srem(c):
     """Remove the specified member from the Set value at key.
 
@@ -604,14 +894,16 @@ def srem(c):
 
     if key not in c.dict_:
         server.addReply(c, shared.zero)
+        return
     else:
         _s = c.dict_[key]
         if not isinstance(_s, set):
-            server.addReply(c, shared.minus2)
+            server.addReply(c, shared.wrongtypeerr)
             return
 
     try:
         _s.remove(val)
+        server.signalModifiedKey(c.dictid, key)
         rv = shared.one
     except KeyError:
         rv = shared.zero
@@ -619,6 +911,7 @@ def srem(c):
     server.addReply(c, rv)
 
 
+@server.command(2, CMD_INLINE | CMD_READONLY | CMD_FAST, keys=(1, 1, 1))
 def scard(c):
     """Return the number of elements (the cardinality) of the
         Set at key.
@@ -626,42 +919,31 @@ def scard(c):
     ::
         SCARD key
     """
-    key = c.argv[1]
+    _s = server.lookupKeyRead(c, c.argv[1])
 
-    if key not in c.dict_:
+    if _s is None:
         server.addReply(c, shared.zero)
+    elif not isinstance(_s, set):
+        server.addReply(c, shared.wrongtypeerr)
     else:
-        _s = c.dict_[key]
-        if not isinstance(_s, set):
-            server.addReply(c, shared.minus2)
-            return
-
-    server.addReply(c, repr(len(_s)) + '\r\n')
+        server.addReplyLongLong(c, len(_s))
 
 
-@server.command(3, CMD_BULK)
+@server.command(3, CMD_BULK | CMD_READONLY | CMD_FAST, keys=(1, 1, 1))
 def sismember(c):
     """Test if the specified value is a member of the Set at key.
 
     ::
         SISMEMBER key member
     """
-    key, member = c.argv[1], c.argv[2]
+    _s = server.lookupKeyRead(c, c.argv[1])
 
-    if key not in c.dict_:
+    if _s is None:
         server.addReply(c, shared.zero)
+    elif not isinstance(_s, set):
+        server.addReply(c, shared.wrongtypeerr)
     else:
-        _s = c.dict_[key]
-        if not isinstance(_s, set):
-            server.addReply(c, shared.minus2)
-            return
-
-    if member in _s:
-        rv = shared.one
-    else:
-        rv = shared.zero
-
-    server.addReply(c, rv)
+        server.addReply(c, shared.one if c.argv[2] in _s else shared.zero)
 
 
 def _sinterGeneric(c, keys, dstkey):
@@ -669,31 +951,40 @@ def _sinterGeneric(c, keys, dstkey):
         key2, ..., keyN. If dst key is not none, set the result
         to this key.
     """
-    inter = None
+    sets = []
 
     for key in keys:
-        if key not in c.dict_:
-            server.addReply(c, 'Key {!r} not exists\r\n'.format(key))
-            return
-
-        _s = c.dict_[key]
-
+        _s = server.lookupKeyRead(c, key)
+        if _s is None:
+            # A key not exists is an empty Set.
+            sets = [set()]
+            continue
         if not isinstance(_s, set):
             server.addReply(c, shared.wrongtypeerr)
             return
+        sets.append(_s)
 
-        if inter is None:
-            inter = _s
-        else:
-            inter &= _s
+    # Starting from the smallest Set, the others are not copied.
+    sets.sort(key=len)
+    inter = sets[0].intersection(*sets[1:])
 
-    if dstkey:
-        self.set_(dstkey, inter)
-        server.addReply(c, shared.ok)
-    else:
-        server.addReply(c, repr(inter) + '\r\n')
+    if dstkey is None:
+        server.addReplyMultiBulk(c, list(inter))
+        return
 
+    if inter:
+        old = c.dict_.get(dstkey)
+        c.dict_[dstkey] = inter
+        if old is not None and server.lazyfree_lazy_server_del:
+            server.freeObjectAsync(old)
+            del(old)
+        server.signalModifiedKey(c.dictid, dstkey)
+    elif server.dbDelete(c.dictid, dstkey, server.lazyfree_lazy_server_del):
+        server.signalModifiedKey(c.dictid, dstkey)
+    server.addReplyLongLong(c, len(inter))
 
+
+@server.command(-2, CMD_INLINE | CMD_READONLY, keys=(1, -1, 1))
 def sinter(c):
     """Return the intersection between the Sets stored at key1,
         key2, ..., keyN.
@@ -701,95 +992,460 @@ def sinter(c):
     ::
         SINTER key1 key2 ... keyN
     """
-    self._sinterGeneric(c, s.argv[1:], None)
+    _sinterGeneric(c, c.argv[1:], None)
 
 
+@server.command(-3, CMD_BULK | CMD_WRITE | CMD_DENYOOM, keys=(1, -1, 1))
 def sinterstore(c):
     """Compute the intersection between the Sets stored at key1,
         key2, ..., keyN, and store the resulting Set at dstkey.
 
     ::
         SINTERSTORE dstKey key1 key2 ... keyN
-    """
 
-    self._sinterGeneric(c, s.argv[2:], s.argv[1])
+    Replys:
+        number of members of the resulting Set, an empty Set deletes
+        dstkey.
+    """
+    _sinterGeneric(c, c.argv[2:], c.argv[1])
 
 
+@server.command(2, CMD_INLINE | CMD_READONLY, keys=(1, 1, 1))
 def smembers(c):
     """Return all the members of the Set value at key.
 
     ::
         SMEMBERS key
     """
-    pass
+    _s = server.lookupKeyRead(c, c.argv[1])
+
+    if _s is None:
+        server.addReplyMultiBulk(c, [])
+    elif not isinstance(_s, set):
+        server.addReply(c, shared.wrongtypeerr)
+    else:
+        server.addReplyMultiBulk(c, list(_s))
 
 
-@server.command(1, CMD_INLINE)
+@server.command(1, CMD_INLINE | CMD_READONLY | CMD_FAST)
 def randomkey(c):
     """Return a random key from the key space."""
     keys = list(c.dict_.keys())
 
     try:
         rk = random.choice(keys)
-        server.addReply(c, repr(rk) + '\r\n')
+        server.addReplyBulk(c, rk)
     except IndexError:
         server.addReply(c, shared.nil)
 
 
+@server.command(3, CMD_INLINE | CMD_WRITE | CMD_FAST, keys=(1, 1, 1))
 def move(c):
     """Move the key from the currently selected DB to the DB
         having as index dbindex.
 
     ::
         MOVE key dbindex
+
+    Replys:
+        1 if the key is moved, 0 if it does not exist or already
+        exists in the target DB.
     """
-    pass
+    key = c.argv[1]
 
+    try:
+        dstid = int(c.argv[2])
+    except ValueError:
+        dstid = -1
+    if dstid not in range(server.dbnum):
+        server.addReply(c, '-ERR invalid DB index\r\n')
+        return
+    if dstid == c.dictid:
+        server.addReply(c, '-ERR source and destination objects are '
+                           'the same\r\n')
+        return
 
-@server.command(1, CMD_INLINE)
+    dst = server.dicts[dstid]
+    if key not in c.dict_ or key in dst:
+        server.addReply(c, shared.zero)
+        return
+    dst[key] = c.dict_.pop(key)
+    server.signalModifiedKey(c.dictid, key)
+    server.signalModifiedKey(dstid, key)
+    server.addReply(c, shared.one)
+
+
+def _getFlushMode(c):
+    """Parse the optional ASYNC or SYNC argument of FLUSHDB and FLUSHALL.
+
+    Returns:
+        1 for ASYNC, 0 for SYNC, -1 on error, error is replied.
+    """
+    if c.argc == 1:
+        return 0
+    mode = c.argv[1].lower()
+    if c.argc == 2 and mode in ('async', 'sync'):
+        return int(mode == 'async')
+    server.addReply(c, shared.syntaxerr)
+    return -1
+
+
+@server.command(-1, CMD_INLINE | CMD_WRITE)
 def flushdb(c):
-    """Remove all the keys of the currently selected DB.
+    """Remove all the keys of the currently selected DB, with ASYNC
+        the DB is replaced by an empty one at once and the keys are
+        freed in background.
 
     ::
-        FLUSHDB
+        FLUSHDB [ASYNC|SYNC]
     """
-    c.dict_.clear()
-    server.addReply(c, shared.ok)
+    lazy = _getFlushMode(c)
+
+    if lazy != -1:
+        server.emptyDb(c.dictid, lazy)
+        server.addReply(c, shared.ok)
 
 
-@server.command(1, CMD_INLINE)
+@server.command(-1, CMD_INLINE | CMD_WRITE)
 def flushall(c):
-    """Remove all the keys from all the databases.
+    """Remove all the keys from all the databases, with ASYNC the
+        databases are replaced by empty ones at once and the keys are
+        freed in background.
 
     ::
-        FLUSHALL
+        FLUSHALL [ASYNC|SYNC]
     """
-    for i in range(server.dbnum):
-        server.dicts[i].clear()
-    server.addReply(c, shared.ok)
+    lazy = _getFlushMode(c)
 
+    if lazy != -1:
+        server.emptyDb(-1, lazy)
+        server.addReply(c, shared.ok)
 
-#------------------------- Persistence control commands ----------------------
 
-def _saveDb(where):
-    filepath = os.path.join(os.path.dirname(__file__), where)
+#------------------------------ Transactions ---------------------------------
 
-    try:
-        with open(filepath, 'wb') as f:
-            pickle.dump(server.dicts, f)
-    except IOError as e:
-        warn('# Failed saving the DB: {}'.format(e))
-        return 0
+def _discardTransaction(c):
+    c.mstate = []
+    c.flag &= ~(CLIENT_MULTI | CLIENT_DIRTY_CAS | CLIENT_DIRTY_EXEC)
+    server.unwatchAllKeys(c)
 
-    debug(". DB saved on disk.")
-    return 1
 
+@server.command(1, CMD_INLINE | CMD_FAST)
+def multi(c):
+    """Mark the start of a transaction, the following commands are
+        queued until EXEC.
 
-@server.command(1, CMD_INLINE)
-def save(c):
-    """Synchronously save the DB on disk."""
-    if self._saveDb(server.dbfilename):
-        server.addReply(c, shared.ok)
+    ::
+        MULTI
+    """
+    if c.flag & CLIENT_MULTI:
+        server.addReply(c, '-ERR MULTI calls can not be nested\r\n')
+        return
+
+    c.flag |= CLIENT_MULTI
+    server.addReply(c, shared.ok)
+
+
+@server.command(1, CMD_INLINE | CMD_FAST)
+def discard(c):
+    """Discard the commands queued since MULTI.
+
+    ::
+        DISCARD
+    """
+    if not c.flag & CLIENT_MULTI:
+        server.addReply(c, '-ERR DISCARD without MULTI\r\n')
+        return
+
+    _discardTransaction(c)
+    server.addReply(c, shared.ok)
+
+
+@server.command(1, CMD_INLINE | CMD_NOPROPAGATE, cmd_name='exec')
+def exec_(c):
+    """Execute the commands queued since MULTI.
+
+    Replys:
+        replies of the queued commands in one multibulk, nil multibulk
+        if one of the watched keys was modified, an EXECABORT error if
+        one of the commands could not be queued.
+
+    ::
+        EXEC
+    """
+    if not c.flag & CLIENT_MULTI:
+        server.addReply(c, '-ERR EXEC without MULTI\r\n')
+        return
+
+    if c.flag & CLIENT_DIRTY_EXEC:
+        _discardTransaction(c)
+        server.addReply(c, shared.execaborterr)
+        return
+    if c.flag & CLIENT_DIRTY_CAS:
+        _discardTransaction(c)
+        server.addReply(c, shared.nullmultibulk)
+        return
+
+    # Unwatch first, the transaction itself can modify the watched keys.
+    server.unwatchAllKeys(c)
+
+    start = c.reply.length
+    for cmd, argv in c.mstate:
+        c.argc = len(argv)
+        c.argv = argv
+        server.call(c, cmd)
+
+    # Merge the replies of the queued commands into one frame.
+    replies = []
+    first = node = c.reply.index(start)
+    while node:
+        replies.append(node.val)
+        next_ = node.next
+        if node is not first:
+            c.reply.delNode(node)
+        node = next_
+
+    if first is None:
+        server.addReplyMultiBulk(c, [])
+    elif c.flag & CLIENT_NATIVE:
+        first.val = replies
+    else:
+        header = '*{}\r\n'.format(len(c.mstate))
+        first.val = header + ''.join(replies)
+        c.reply_bytes += len(header)
+
+    _discardTransaction(c)
+
+
+@server.command(-2, CMD_INLINE | CMD_FAST, keys=(1, -1, 1))
+def watch(c):
+    """Watch the keys, EXEC fails if any of them is modified.
+
+    ::
+        WATCH key1 key2 ... keyN
+    """
+    if c.flag & CLIENT_MULTI:
+        server.addReply(c, '-ERR WATCH inside MULTI is not allowed\r\n')
+        return
+
+    for key in c.argv[1:]:
+        server.watchKey(c, key)
+    server.addReply(c, shared.ok)
+
+
+@server.command(1, CMD_INLINE | CMD_FAST)
+def unwatch(c):
+    """Forget all the watched keys.
+
+    ::
+        UNWATCH
+    """
+    server.unwatchAllKeys(c)
+    server.addReply(c, shared.ok)
+
+
+#------------------------------ Scripting ------------------------------------
+
+def _loadScript(c, body):
+    """Compile and cache the script body.
+
+    Returns:
+        sha1 of the script, None if it can't compile.
+    """
+    sha = sha1hex(body)
+
+    if sha not in server.scripts:
+        try:
+            server.scripts[sha] = compileScript(body)
+        except ScriptError as e:
+            server.addReply(c, '-ERR {}\r\n'.format(e))
+            return None
+    return sha
+
+
+def _addReplyScriptResult(c, rv):
+    if rv is None:
+        server.addReply(c, shared.nil)
+    elif isinstance(rv, StatusReply):
+        server.addReply(c, '+{}\r\n'.format(rv))
+    elif isinstance(rv, bool):
+        server.addReplyLongLong(c, int(rv))
+    elif isinstance(rv, integer_types):
+        server.addReplyLongLong(c, rv)
+    elif isinstance(rv, (list, tuple)):
+        server.addReplyMultiBulk(c, [
+            x if x is None or isinstance(x, integer_types) else str(x)
+            for x in rv
+        ])
+    else:
+        server.addReplyBulk(c, str(rv))
+
+
+def _evalGeneric(c, code):
+    try:
+        numkeys = int(c.argv[2])
+    except ValueError:
+        numkeys = -1
+
+    if numkeys < 0 or numkeys > c.argc - 3:
+        server.addReply(c, '-ERR Number of keys can\'t be negative or '
+                           'greater than number of args\r\n')
+        return
+
+    keys = c.argv[3:3 + numkeys]
+    args = c.argv[3 + numkeys:]
+
+    try:
+        rv = evalScript(c, code, keys, args)
+    except ScriptError as e:
+        server.addReply(c, '-ERR {}\r\n'.format(e))
+        return
+    _addReplyScriptResult(c, rv)
+
+
+def _evalGetKeys(argv):
+    """The keys of EVAL and EVALSHA, given after numkeys."""
+    try:
+        numkeys = int(argv[2])
+    except ValueError:
+        return []
+    return argv[3:3 + max(numkeys, 0)]
+
+
+@server.command(-3, CMD_BULK | CMD_NOPROPAGATE, cmd_name='eval',
+                getkeys=_evalGetKeys)
+def eval_(c):
+    """Run a server side script, the script is cached as SCRIPT LOAD.
+
+    ::
+        EVAL script numkeys key1 ... keyN arg1 ... argN
+    """
+    sha = _loadScript(c, c.argv[1])
+
+    if sha is not None:
+        _evalGeneric(c, server.scripts[sha])
+
+
+@server.command(-3, CMD_BULK | CMD_NOPROPAGATE, getkeys=_evalGetKeys)
+def evalsha(c):
+    """Run a server side script cached by its sha1.
+
+    ::
+        EVALSHA sha1 numkeys key1 ... keyN arg1 ... argN
+    """
+    code = server.scripts.get(c.argv[1].lower())
+
+    if code is None:
+        server.addReply(c, '-NOSCRIPT No matching script. '
+                           'Please use EVAL.\r\n')
+        return
+    _evalGeneric(c, code)
+
+
+@server.command(-2, CMD_BULK)
+def script(c):
+    """Manage the script cache.
+
+    ::
+        SCRIPT LOAD script
+        SCRIPT EXISTS sha1 ... sha1N
+        SCRIPT FLUSH
+    """
+    sub = c.argv[1].lower()
+
+    if sub == 'load' and c.argc == 3:
+        sha = _loadScript(c, c.argv[2])
+        if sha is not None:
+            server.addReplyBulk(c, sha)
+    elif sub == 'exists' and c.argc > 2:
+        server.addReplyMultiBulk(c, [
+            int(sha.lower() in server.scripts) for sha in c.argv[2:]
+        ])
+    elif sub == 'flush' and c.argc == 2:
+        server.scripts.clear()
+        server.addReply(c, shared.ok)
+    else:
+        server.addReply(c, '-ERR unknown SCRIPT subcommand '
+                           'or wrong number of arguments\r\n')
+
+
+#------------------------------ Pub/Sub --------------------------------------
+
+@server.command(-2, CMD_INLINE)
+def subscribe(c):
+    """Subscribe to the given channels.
+
+    ::
+        SUBSCRIBE channel1 channel2 ... channelN
+    """
+    for channel in c.argv[1:]:
+        server.pubsubSubscribeChannel(c, channel)
+
+
+@server.command(-1, CMD_INLINE)
+def unsubscribe(c):
+    """Unsubscribe from the given channels, or from all the channels
+        if none is given.
+
+    ::
+        UNSUBSCRIBE [channel1 channel2 ... channelN]
+    """
+    if c.argc == 1:
+        server.pubsubUnsubscribeAllChannels(c, 1)
+        return
+
+    for channel in c.argv[1:]:
+        server.pubsubUnsubscribeChannel(c, channel, 1)
+
+
+@server.command(-2, CMD_INLINE)
+def psubscribe(c):
+    """Subscribe to the channels matching the given glob patterns.
+
+    ::
+        PSUBSCRIBE pattern1 pattern2 ... patternN
+    """
+    for pattern in c.argv[1:]:
+        server.pubsubSubscribePattern(c, pattern)
+
+
+@server.command(-1, CMD_INLINE)
+def punsubscribe(c):
+    """Unsubscribe from the given patterns, or from all the patterns
+        if none is given.
+
+    ::
+        PUNSUBSCRIBE [pattern1 pattern2 ... patternN]
+    """
+    if c.argc == 1:
+        server.pubsubUnsubscribeAllPatterns(c, 1)
+        return
+
+    for pattern in c.argv[1:]:
+        server.pubsubUnsubscribePattern(c, pattern, 1)
+
+
+@server.command(3, CMD_BULK | CMD_FAST)
+def publish(c):
+    """Post a message to the given channel.
+
+    Replys:
+        number of clients received the message.
+
+    ::
+        PUBLISH channel message
+    """
+    receivers = server.pubsubPublishMessage(c.argv[1], c.argv[2])
+    server.addReplyLongLong(c, receivers)
+
+
+#------------------------- Persistence control commands ----------------------
+
+@server.command(1, CMD_INLINE)
+def save(c):
+    """Synchronously save the DB on disk."""
+    if server.saveDb(server.dbfilename):
+        server.addReply(c, shared.ok)
     else:
         server.addReply(c, shared.err)
 
@@ -801,33 +1457,24 @@ def bgsave(c):
         server.addReply(c, '-ERR background save already in progress\r\n')
         return
 
-    pid = os.fork()
-
-    if pid == 0:
-        server.sobj.close()
-        ok = self._saveDb(server.dbfilename)
-        if ok:
-            exit(0)
-        else:
-            exit(1)
+    if server.saveDbBackground(server.dbfilename) == -1:
+        server.addReply(c, shared.err)
     else:
-        info('Background saving started by pid {}'.format(pid))
-        server.bgsaveinprogress = 1
         server.addReply(c, shared.ok)
 
 
-@server.command(1, CMD_INLINE)
+@server.command(1, CMD_INLINE | CMD_FAST)
 def lastsave(c):
     """Return the UNIX timestamp of the last successfully
        saving of the dataset on disk.
     """
-    server.addReply(c, repr(server.lastsave) + '\r\n')
+    server.addReplyLongLong(c, server.lastsave or 0)
 
 
 @server.command(1, CMD_INLINE)
 def shutdown(c):
     wain('# User requested shutdown, saving DB...')
-    ok = self._saveDb(server.dbfilename)
+    ok = server.saveDb(server.dbfilename)
     if ok:
         wain('# Server exit now, bye bye...')
         exit(1)
@@ -836,5 +1483,921 @@ def shutdown(c):
         server.addReply(c, '-ERR can\'t quit, problems saving the DB\r\n')
 
 
-if __name__ == '__main__':
-    server.run()
+
+#------------------------------ Replication ----------------------------------
+
+def _checkReplicationFrontend(c):
+    """Replication is served by the pedis eventloop only.
+
+    Returns:
+        0 if an error was replied.
+    """
+    if server.frontend != FRONTEND_PEDIS:
+        server.addReply(c, '-ERR replication is not supported with the '
+                           '{} frontend\r\n'.format(server.frontend))
+        return 0
+    return 1
+
+
+@server.command(3, CMD_INLINE)
+def psync(c):
+    """Called by a replica to get the replication stream since offset,
+        or a snapshot followed by the stream.
+
+    Replys:
+        +CONTINUE, then the stream since offset.
+        +FULLRESYNC replid offset, then $size, the snapshot and the
+        stream since offset.
+
+    ::
+        PSYNC replid offset
+    """
+    if c.flag & CLIENT_SLAVE or not _checkReplicationFrontend(c):
+        return
+
+    if server.masterhost is not None:
+        server.addReply(c, '-ERR chained replication is not supported\r\n')
+        return
+
+    try:
+        offset = int(c.argv[2])
+    except ValueError:
+        server.addReply(c, '-ERR value is not an integer or out of range\r\n')
+        return
+
+    server.syncWithSlave(c, c.argv[1], offset)
+
+
+@server.command(1, CMD_INLINE)
+def sync(c):
+    """Full resynchronization, the same as PSYNC ? -1.
+
+    ::
+        SYNC
+    """
+    if c.flag & CLIENT_SLAVE or not _checkReplicationFrontend(c):
+        return
+
+    if server.masterhost is not None:
+        server.addReply(c, '-ERR chained replication is not supported\r\n')
+        return
+
+    server.syncWithSlave(c, '?', -1)
+
+
+@server.command(3, CMD_INLINE)
+def slaveof(c):
+    """Make the server a replica of the master at host:port, or turn
+        the replica into a master.
+
+    ::
+        SLAVEOF host port
+        SLAVEOF NO ONE
+    """
+    host, port = c.argv[1:]
+
+    if not _checkReplicationFrontend(c):
+        return
+
+    if host.lower() == 'no' and port.lower() == 'one':
+        server.replicationUnsetMaster()
+        server.addReply(c, shared.ok)
+        return
+
+    try:
+        port = int(port)
+    except ValueError:
+        server.addReply(c, '-ERR value is not an integer or out of range\r\n')
+        return
+
+    if (host, port) != (server.masterhost, server.masterport):
+        server.replicationSetMaster(host, port)
+    server.addReply(c, shared.ok)
+
+
+@server.command(-3, CMD_INLINE)
+def replconf(c):
+    """Replication configuration, exchanged between the master and
+        its replicas. ACK is sent by replicas every second and on
+        GETACK, it is not replied.
+
+    ::
+        REPLCONF listening-port port
+        REPLCONF ACK offset
+        REPLCONF GETACK *
+    """
+    option, value = c.argv[1].lower(), c.argv[2]
+
+    if option == 'getack':
+        if c.flag & CLIENT_MASTER:
+            server.replicationSendAck()
+        return
+
+    try:
+        value = int(value)
+    except ValueError:
+        server.addReply(c, '-ERR value is not an integer or out of range\r\n')
+        return
+
+    if option == 'listening-port':
+        c.slave_listening_port = value
+        server.addReply(c, shared.ok)
+    elif option == 'ack':
+        if c.flag & CLIENT_SLAVE:
+            server.replicationAckFromSlave(c, value)
+    else:
+        server.addReply(c, '-ERR Unrecognized REPLCONF option: {}\r\n'
+                           .format(c.argv[1]))
+
+
+@server.command(3, CMD_INLINE)
+def wait(c):
+    """Block until the writes of the client are acknowledged by
+        numreplicas replicas, or timeout miliseconds passed, 0 means
+        wait forever.
+
+    Replys:
+        number of replicas acknowledged the writes.
+
+    ::
+        WAIT numreplicas timeout
+    """
+    if server.masterhost is not None:
+        server.addReply(c, '-ERR WAIT cannot be used with replica '
+                           'instances\r\n')
+        return
+
+    try:
+        numreplicas, timeout = int(c.argv[1]), int(c.argv[2])
+    except ValueError:
+        timeout = -1
+    if timeout < 0:
+        server.addReply(c, '-ERR timeout is not an integer '
+                           'or out of range\r\n')
+        return
+
+    acks = server.replicationCountAcksByOffset(c.woff)
+    if acks >= numreplicas or c.flag & CLIENT_MULTI:
+        server.addReplyLongLong(c, acks)
+        return
+    server.blockForReplication(c, timeout, c.woff, numreplicas)
+
+
+#------------------------------ Cluster --------------------------------------
+
+def _getSlot(c, slot):
+    """Parse the slot argument.
+
+    Returns:
+        -1: slot is invalid, error is replied.
+    """
+    try:
+        slot = int(slot)
+    except ValueError:
+        slot = -1
+
+    if not 0 <= slot < CLUSTER_SLOTS:
+        server.addReply(c, '-ERR Invalid or out of range slot\r\n')
+        return -1
+    return slot
+
+
+@server.command(-2, CMD_INLINE)
+def cluster(c):
+    """Cluster introspection and slots assignment.
+
+    ::
+        CLUSTER KEYSLOT key
+        CLUSTER SLOTS
+        CLUSTER COUNTKEYSINSLOT slot
+        CLUSTER GETKEYSINSLOT slot count
+        CLUSTER SETSLOT slot NODE|MIGRATING|IMPORTING host:port
+        CLUSTER SETSLOT slot STABLE
+    """
+    cs = server.cluster
+    if cs is None:
+        server.addReply(c, '-ERR This instance has cluster support '
+                           'disabled\r\n')
+        return
+
+    subcommand = c.argv[1].lower()
+
+    if subcommand == 'keyslot' and c.argc == 3:
+        server.addReplyLongLong(c, keyHashSlot(c.argv[2]))
+
+    elif subcommand == 'slots' and c.argc == 2:
+        ranges = []
+        for start, end, node in cs.slotRanges():
+            host, port = node.rsplit(':', 1)
+            ranges.append([start, end, [host, int(port)]])
+        server.addReplyMultiBulk(c, ranges)
+
+    elif subcommand == 'countkeysinslot' and c.argc == 3:
+        slot = _getSlot(c, c.argv[2])
+        if slot != -1:
+            server.addReplyLongLong(c, c.dict_.countKeysInSlot(slot))
+
+    elif subcommand == 'getkeysinslot' and c.argc == 4:
+        slot = _getSlot(c, c.argv[2])
+        if slot == -1:
+            return
+        try:
+            count = int(c.argv[3])
+        except ValueError:
+            count = -1
+        if count < 0:
+            server.addReply(c, '-ERR Invalid number of keys\r\n')
+            return
+        server.addReplyMultiBulk(
+            c, list(itertools.islice(c.dict_.slotKeys(slot), count)))
+
+    elif subcommand == 'setslot' and c.argc in (4, 5):
+        slot = _getSlot(c, c.argv[2])
+        if slot == -1:
+            return
+        action = c.argv[3].lower()
+
+        if action == 'stable' and c.argc == 4:
+            cs.migrating_slots_to.pop(slot, None)
+            cs.importing_slots_from.pop(slot, None)
+        elif action == 'node' and c.argc == 5:
+            node = c.argv[4]
+            if node == cs.myself:
+                cs.importing_slots_from.pop(slot, None)
+            else:
+                cs.migrating_slots_to.pop(slot, None)
+            cs.slots[slot] = node
+        elif action == 'migrating' and c.argc == 5:
+            if cs.slots[slot] != cs.myself:
+                server.addReply(c, '-ERR I\'m not the owner of hash slot '
+                                   '{}\r\n'.format(slot))
+                return
+            cs.migrating_slots_to[slot] = c.argv[4]
+        elif action == 'importing' and c.argc == 5:
+            if cs.slots[slot] == cs.myself:
+                server.addReply(c, '-ERR I\'m already the owner of hash '
+                                   'slot {}\r\n'.format(slot))
+                return
+            cs.importing_slots_from[slot] = c.argv[4]
+        else:
+            server.addReply(c, '-ERR Invalid CLUSTER SETSLOT action\r\n')
+            return
+        server.addReply(c, shared.ok)
+
+    else:
+        server.addReply(c, '-ERR Unknown subcommand or wrong number of '
+                           'arguments for CLUSTER {}\r\n'.format(c.argv[1]))
+
+
+@server.command(1, CMD_INLINE | CMD_FAST)
+def asking(c):
+    """Let the next command access a slot importing to this node, sent
+        after an -ASK redirect.
+
+    ::
+        ASKING
+    """
+    if server.cluster is None:
+        server.addReply(c, '-ERR This instance has cluster support '
+                           'disabled\r\n')
+        return
+
+    c.flag |= CLIENT_ASKING
+    server.addReply(c, shared.ok)
+
+
+@server.command(2, CMD_INLINE | CMD_READONLY, keys=(1, 1, 1))
+def dump(c):
+    """Return the serialized value of key, for RESTORE.
+
+    ::
+        DUMP key
+    """
+    val = server.lookupKeyRead(c, c.argv[1])
+
+    if val is None:
+        server.addReply(c, shared.nullbulk)
+    else:
+        server.addReplyBulk(c, dumpValue(val))
+
+
+@server.command(-3, CMD_BULK | CMD_WRITE | CMD_DENYOOM, keys=(1, 1, 1))
+def restore(c):
+    """Create key with the value serialized by DUMP.
+
+    ::
+        RESTORE key serialized-value [REPLACE]
+    """
+    key, payload = c.argv[1:3]
+    replace = c.argc == 4 and c.argv[3].lower() == 'replace'
+
+    if c.argc > 4 or (c.argc == 4 and not replace):
+        server.addReply(c, shared.syntaxerr)
+        return
+
+    if key in c.dict_ and not replace:
+        server.addReply(c, '-BUSYKEY Target key name already exists.\r\n')
+        return
+
+    try:
+        val = loadValue(payload)
+    except ValueError:
+        server.addReply(c, '-ERR Bad data format\r\n')
+        return
+    server.dbDelete(c.dictid, key, server.lazyfree_lazy_server_del)
+    c.dict_[key] = val
+    server.signalModifiedKey(c.dictid, key)
+    server.addReply(c, shared.ok)
+
+
+@server.command(4, CMD_INLINE)
+def migrate(c):
+    """Migrate the keys of slot, in all dbs, to the node at host:port.
+        Keys are moved by batches without blocking other clients, the
+        node at host:port serves slot when all the keys are moved.
+        MIGRATE a slot again to resume a failed migration.
+
+    ::
+        MIGRATE host port slot
+    """
+    cs = server.cluster
+    if cs is None:
+        server.addReply(c, '-ERR This instance has cluster support '
+                           'disabled\r\n')
+        return
+
+    slot = _getSlot(c, c.argv[3])
+    if slot == -1:
+        return
+    target = '{}:{}'.format(c.argv[1], c.argv[2])
+
+    if cs.slots[slot] != cs.myself:
+        server.addReply(c, '-ERR I\'m not the owner of hash slot '
+                           '{}\r\n'.format(slot))
+        return
+
+    if slot in server.migrations or \
+       cs.migrating_slots_to.get(slot, target) != target:
+        server.addReply(c, '-ERR Slot {} is already migrating\r\n'
+                           .format(slot))
+        return
+
+    try:
+        server.clusterStartMigration(slot, target)
+    except socket.error as e:
+        server.addReply(c, '-IOERR error migrating to target node: '
+                           '{}\r\n'.format(e))
+        return
+    server.addReply(c, shared.ok)
+
+
+#------------------------------ Introspection --------------------------------
+
+def _infoServer():
+    uptime = int(time.time() - server.stat_starttime)
+    return [
+        'python_version:{}'.format(platform.python_version()),
+        'python_implementation:{}'.format(platform.python_implementation()),
+        'os:{} {} {}'.format(platform.system(), platform.release(),
+                             platform.machine()),
+        'frontend:{}'.format(server.frontend),
+        'io_threads:{}'.format(server.io_threads),
+        'workers:{}'.format(server.workers),
+        'worker_id:{}'.format(server.worker_id),
+        'process_id:{}'.format(os.getpid()),
+        'tcp_port:{}'.format(server.port),
+        'uptime_in_seconds:{}'.format(uptime),
+        'uptime_in_days:{}'.format(uptime // 86400),
+        'cluster_enabled:{}'.format(int(server.cluster is not None)),
+    ]
+
+
+def _infoClients():
+    return [
+        'connected_clients:{}'.format(server.stat_numconnections),
+        'maxclients:{}'.format(server.maxclients),
+        'blocked_clients:{}'.format(server.stat_blocked_clients),
+    ]
+
+
+def _infoMemory():
+    rss, peak = memoryRss(), memoryPeak()
+    return [
+        'used_memory_rss:{}'.format(rss),
+        'used_memory_rss_human:{}'.format(bytesToHuman(rss)),
+        'used_memory_peak:{}'.format(peak),
+        'used_memory_peak_human:{}'.format(bytesToHuman(peak)),
+        'lazyfree_pending_objects:{}'.format(server.lazyfree.pending()),
+    ]
+
+
+def _infoPersistence():
+    return [
+        'rdb_changes_since_last_save:{}'.format(
+            server.dirty - server.dirty_lastsave),
+        'rdb_bgsave_in_progress:{}'.format(server.bgsaveinprogress),
+        'rdb_last_save_time:{}'.format(server.lastsave or 0),
+        'rdb_last_bgsave_status:{}'.format(
+            'ok' if server.lastbgsave_status else 'err'),
+    ]
+
+
+def _infoStats():
+    cycles = server.stat_eventloop_cycles
+    return [
+        'total_connections_received:{}'.format(
+            server.stat_numconnections_total),
+        'total_commands_processed:{}'.format(server.stat_numcommands),
+        'instantaneous_ops_per_sec:{}'.format(
+            int(server.getInstantaneousMetric('command'))),
+        'total_net_input_bytes:{}'.format(server.stat_net_input_bytes),
+        'total_net_output_bytes:{}'.format(server.stat_net_output_bytes),
+        'instantaneous_input_kbps:{:.2f}'.format(
+            server.getInstantaneousMetric('net_input') / 1024),
+        'instantaneous_output_kbps:{:.2f}'.format(
+            server.getInstantaneousMetric('net_output') / 1024),
+        'rejected_connections:{}'.format(server.stat_rejected_conn),
+        'sync_full:{}'.format(server.stat_sync_full),
+        'sync_partial_ok:{}'.format(server.stat_sync_partial_ok),
+        'latest_fork_usec:{}'.format(server.stat_fork_time),
+        'keyspace_hits:{}'.format(server.stat_keyspace_hits),
+        'keyspace_misses:{}'.format(server.stat_keyspace_misses),
+        'pubsub_channels:{}'.format(len(server.pubsub_channels)),
+        'pubsub_patterns:{}'.format(len(server.pubsub_patterns)),
+        'eventloop_cycles:{}'.format(cycles),
+        'eventloop_duration_sum_usec:{}'.format(
+            int(server.stat_eventloop_duration_sum * 1e6)),
+        'eventloop_duration_avg_usec:{}'.format(
+            int(server.stat_eventloop_duration_sum * 1e6 / cycles)
+            if cycles else 0),
+        'eventloop_duration_max_usec:{}'.format(
+            int(server.stat_eventloop_duration_max * 1e6)),
+        'instantaneous_eventloop_cycles_per_sec:{}'.format(
+            int(server.getInstantaneousMetric('el_cycles'))),
+    ]
+
+
+def _infoReplication():
+    lines = []
+
+    if server.masterhost is None:
+        lines.append('role:master')
+        lines.append('connected_slaves:{}'.format(server.slaves.length))
+        now = time.time()
+        for i, node in enumerate(server.slaves):
+            slave = node.val
+            if slave.replstate == SLAVE_STATE_ONLINE:
+                state = 'online'
+            elif slave.replstate == SLAVE_STATE_SEND_BULK:
+                state = 'send_bulk'
+            else:
+                state = 'wait_bgsave'
+            lag = int(now - slave.repl_ack_time) if slave.repl_ack_time else -1
+            lines.append('slave{}:ip={},port={},state={},offset={},lag={}'
+                         .format(i, slave.cobj.getpeername()[0],
+                                 slave.slave_listening_port, state,
+                                 slave.repl_ack_off, lag))
+    else:
+        connected = server.repl_state == REPL_STATE_CONNECTED
+        if server.master_lastinteraction:
+            lastio = int(time.time() - server.master_lastinteraction)
+        else:
+            lastio = -1
+        lines.extend([
+            'role:slave',
+            'master_host:{}'.format(server.masterhost),
+            'master_port:{}'.format(server.masterport),
+            'master_link_status:{}'.format('up' if connected else 'down'),
+            'master_last_io_seconds_ago:{}'.format(lastio),
+            'master_sync_in_progress:{}'.format(
+                int(server.repl_state == REPL_STATE_TRANSFER)),
+            'slave_repl_offset:{}'.format(server.master_repl_offset),
+            'slave_read_only:{}'.format(server.slave_read_only),
+        ])
+
+    backlog = server.repl_backlog
+    lines.extend([
+        'master_replid:{}'.format(server.replid),
+        'master_repl_offset:{}'.format(server.master_repl_offset),
+        'repl_backlog_active:{}'.format(int(backlog is not None)),
+        'repl_backlog_size:{}'.format(server.repl_backlog_size),
+        'repl_backlog_histlen:{}'.format(len(backlog) if backlog else 0),
+    ])
+    return lines
+
+
+def _infoCommandstats():
+    lines = []
+    for name in sorted(server.commands):
+        stats = server.commands[name].stats
+        if stats.calls:
+            lines.append('cmdstat_{}:calls={},usec={},usec_per_call={:.2f},'
+                         'max_usec={}'.format(name, stats.calls, stats.usec,
+                                              stats.usec / float(stats.calls),
+                                              stats.max_usec))
+    return lines
+
+
+def _infoKeyspace():
+    return ['db{}:keys={}'.format(i, len(dict_))
+            for i, dict_ in enumerate(server.dicts) if dict_]
+
+
+#: INFO sections in order, (name, function returning the lines, shown
+#: by default)
+INFO_SECTIONS = [
+    ('server', _infoServer, 1),
+    ('clients', _infoClients, 1),
+    ('memory', _infoMemory, 1),
+    ('persistence', _infoPersistence, 1),
+    ('stats', _infoStats, 1),
+    ('replication', _infoReplication, 1),
+    ('commandstats', _infoCommandstats, 0),
+    ('keyspace', _infoKeyspace, 1),
+]
+
+
+@server.command(-1, CMD_INLINE, cmd_name='info')
+def info_(c):
+    """Information and statistics about the server, in sections of
+        `field:value` lines.
+
+    ::
+        INFO [section]
+    """
+    section = c.argv[1].lower() if c.argc > 1 else 'default'
+
+    parts = []
+    for name, genInfo, default in INFO_SECTIONS:
+        if section in ('all', name) or section == 'default' and default:
+            parts.append('# {}\r\n{}\r\n'.format(
+                name.capitalize(), '\r\n'.join(genInfo())))
+    server.addReplyBulk(c, '\r\n'.join(parts))
+
+
+def _commandInfo(cmd):
+    """Return the COMMAND entry of cmd."""
+    flags = [name for flag, name in CMD_FLAG_NAMES if cmd.flags & flag]
+    if cmd.getkeys is not None:
+        flags.append('movablekeys')
+    return [cmd.name, cmd.arity, flags, cmd.firstkey, cmd.lastkey,
+            cmd.keystep]
+
+
+@server.command(-1, CMD_INLINE)
+def command(c):
+    """Describe the commands, an entry is [name, arity, flags, first
+        key, last key, key step], a negative last key counts from the
+        end of the arguments.
+
+    ::
+        COMMAND
+        COMMAND INFO command ... commandN
+        COMMAND COUNT
+        COMMAND GETKEYS command arg ... argN
+
+    Replys:
+        COMMAND: entries of all the commands.
+        INFO: entries of the commands, nil for the unknown ones.
+        GETKEYS: the key arguments of the command.
+    """
+    subcommand = c.argv[1].lower() if c.argc > 1 else None
+
+    if subcommand is None:
+        server.addReplyMultiBulk(c, [_commandInfo(server.commands[name])
+                                     for name in sorted(server.commands)])
+    elif subcommand == 'info':
+        rv = []
+        for name in c.argv[2:]:
+            found, cmd = server.lookup_command(name)
+            rv.append(_commandInfo(cmd) if found else None)
+        server.addReplyMultiBulk(c, rv)
+    elif subcommand == 'count' and c.argc == 2:
+        server.addReplyLongLong(c, len(server.commands))
+    elif subcommand == 'getkeys' and c.argc > 2:
+        argv = c.argv[2:]
+        found, cmd = server.lookup_command(argv[0])
+        if not found:
+            server.addReply(c, '-ERR Invalid command specified\r\n')
+        elif (cmd.arity > 0 and len(argv) != cmd.arity) or \
+                len(argv) < -cmd.arity:
+            server.addReply(c, '-ERR Invalid number of arguments '
+                               'specified for command\r\n')
+        else:
+            keys = server.getKeysFromCommand(cmd, argv)
+            if keys:
+                server.addReplyMultiBulk(c, keys)
+            else:
+                server.addReply(c, '-ERR The command has no key '
+                                   'arguments\r\n')
+    else:
+        server.addReply(c, '-ERR unknown COMMAND subcommand '
+                           'or wrong number of arguments\r\n')
+
+
+@server.command(-2, CMD_INLINE)
+def latency(c):
+    """Latency histograms of the commands, the cumulative count of
+        the calls faster than every power of two microseconds, and the
+        stalls recorded by the latency monitor.
+
+    ::
+        LATENCY HISTOGRAM [command ... commandN]
+        LATENCY LATEST
+        LATENCY HISTORY event
+        LATENCY RESET [event ... eventN]
+
+    Replys:
+        LATEST: [event, unix time, latest ms, max ms] of every event.
+        HISTORY: [unix time, ms] of the samples of the event.
+        RESET: number of events reset.
+    """
+    subcommand = c.argv[1].lower()
+    monitor = server.latency_monitor
+
+    if subcommand == 'latest' and c.argc == 2:
+        rv = []
+        for event in sorted(monitor.events):
+            series = monitor.events[event]
+            t, ms = series.samples[-1]
+            rv.append([event, t, ms, series.max])
+        server.addReplyMultiBulk(c, rv)
+    elif subcommand == 'history' and c.argc == 3:
+        series = monitor.events.get(c.argv[2])
+        server.addReplyMultiBulk(c, [list(sample) for sample in
+                                     series.samples] if series else [])
+    elif subcommand == 'reset':
+        server.addReplyLongLong(c, monitor.reset(c.argv[2:] or None))
+    elif subcommand == 'histogram':
+        names = [name.lower() for name in c.argv[2:]] or \
+            sorted(server.commands)
+        rv = []
+        for name in names:
+            found, cmd = server.lookup_command(name)
+            if not found or not cmd.stats.calls:
+                continue
+            histogram = []
+            for bound, count in cmd.stats.histogram.cumulative():
+                histogram.extend([bound, count])
+            rv.append([name, ['calls', cmd.stats.calls,
+                              'histogram_usec', histogram]])
+        server.addReplyMultiBulk(c, rv)
+    else:
+        server.addReply(c, '-ERR unknown LATENCY subcommand '
+                           'or wrong number of arguments\r\n')
+
+
+@server.command(-2, CMD_INLINE)
+def slowlog(c):
+    """Read or reset the slow log, entries are [id, unix time,
+        microseconds, argv, client address], newest first.
+
+    ::
+        SLOWLOG GET [count]
+        SLOWLOG LEN
+        SLOWLOG RESET
+    """
+    subcommand = c.argv[1].lower()
+
+    if subcommand == 'get' and c.argc in (2, 3):
+        count = 10
+        if c.argc == 3:
+            try:
+                count = int(c.argv[2])
+            except ValueError:
+                server.addReply(c, '-ERR value is not an integer or out '
+                                   'of range\r\n')
+                return
+        entries = server.slowlog.entries
+        if count < 0:
+            count = len(entries)
+        server.addReplyMultiBulk(c, [
+            [e.id, e.time, e.usec, e.argv, e.addr]
+            for e in itertools.islice(entries, count)
+        ])
+    elif subcommand == 'len' and c.argc == 2:
+        server.addReplyLongLong(c, len(server.slowlog.entries))
+    elif subcommand == 'reset' and c.argc == 2:
+        server.slowlog.reset()
+        server.addReply(c, shared.ok)
+    else:
+        server.addReply(c, '-ERR unknown SLOWLOG subcommand '
+                           'or wrong number of arguments\r\n')
+
+
+@server.command(1, CMD_INLINE)
+def monitor(c):
+    """Stream the commands processed by the server to the client, as
+        status replies `+<unix time> [<db> <client address>] "arg" ...`.
+
+    ::
+        MONITOR
+    """
+    if c.flag & CLIENT_MONITOR:
+        return
+    c.flag |= CLIENT_MONITOR
+    c.monitornode = server.monitors.addNodeTail(c)
+    server.addReply(c, shared.ok)
+
+
+#: Letters of the client flags listed by CLIENT LIST
+CLIENT_FLAG_NAMES = [
+    (CLIENT_SLAVE, 'S'), (CLIENT_MASTER, 'M'), (CLIENT_MULTI, 'x'),
+    (CLIENT_BLOCKED, 'b'), (CLIENT_DIRTY_CAS, 'd'), (CLIENT_MONITOR, 'O'),
+    (CLIENT_CLOSE_ASAP, 'A'),
+]
+
+
+def _clientInfo(client, now):
+    """Return the CLIENT LIST line of client."""
+    flags = ''.join(letter for flag, letter in CLIENT_FLAG_NAMES
+                    if client.flag & flag)
+    if client.pubsub_channels or client.pubsub_patterns:
+        flags += 'P'
+    return ('id={} addr={} name={} age={} idle={} flags={} db={} sub={} '
+            'psub={} multi={} qbuf={} oll={} omem={} cmd={}').format(
+        client.id, client.addr, client.name, int(now - client.ctime),
+        int(now - client.lastinteraction), flags or 'N', client.dictid,
+        len(client.pubsub_channels), len(client.pubsub_patterns),
+        len(client.mstate) if client.flag & CLIENT_MULTI else -1,
+        len(client.querybuf), client.reply.length, client.reply_bytes,
+        client.lastcmd or 'NULL')
+
+
+def _clientKillFilter(c, args):
+    """Return the clients matched by the filters of CLIENT KILL, None
+    if the filters are invalid.
+    """
+    if len(args) % 2:
+        return None
+    id_ = addr = type_ = None
+    skipme = 1
+    for option, val in zip(args[::2], args[1::2]):
+        option = option.lower()
+        if option == 'id':
+            try:
+                id_ = int(val)
+            except ValueError:
+                return None
+        elif option == 'addr':
+            addr = val
+        elif option == 'type':
+            type_ = val.lower()
+            if type_ not in ('normal', 'slave', 'pubsub', 'master',
+                             'monitor'):
+                return None
+        elif option == 'skipme':
+            if val.lower() not in ('yes', 'no'):
+                return None
+            skipme = int(val.lower() == 'yes')
+        else:
+            return None
+    return [client for client in (node.val for node in server.clients)
+            if (id_ is None or client.id == id_) and
+            (addr is None or client.addr == addr) and
+            (type_ is None or server.getClientType(client) == type_) and
+            not (skipme and client is c)]
+
+
+@server.command(-2, CMD_INLINE)
+def client(c):
+    """Inspect and close the connections.
+
+    ::
+        CLIENT LIST [TYPE type]
+        CLIENT KILL addr
+        CLIENT KILL [ID id] [ADDR addr] [TYPE type] [SKIPME yes/no]
+        CLIENT SETNAME name
+        CLIENT GETNAME
+        CLIENT ID
+
+    The type is normal, slave, pubsub, master or monitor.
+
+    Replys:
+        LIST: a line of `field=value` of every client, ordered by id.
+        KILL: status reply with addr, number of clients closed with
+        the filters.
+    """
+    subcommand = c.argv[1].lower()
+
+    if subcommand == 'list' and c.argc in (2, 4):
+        type_ = None
+        if c.argc == 4:
+            if c.argv[2].lower() != 'type':
+                server.addReply(c, shared.syntaxerr)
+                return
+            type_ = c.argv[3].lower()
+        now = time.time()
+        clients = sorted((node.val for node in server.clients),
+                         key=lambda client: client.id)
+        server.addReplyBulk(c, ''.join(
+            _clientInfo(client, now) + '\n' for client in clients
+            if type_ is None or server.getClientType(client) == type_))
+    elif subcommand == 'kill' and c.argc == 3:
+        for node in server.clients:
+            if node.val.addr == c.argv[2]:
+                server.addReply(c, shared.ok)
+                server.freeClientAsync(node.val)
+                return
+        server.addReply(c, '-ERR No such client\r\n')
+    elif subcommand == 'kill' and c.argc > 3:
+        clients = _clientKillFilter(c, c.argv[2:])
+        if clients is None:
+            server.addReply(c, shared.syntaxerr)
+            return
+        for killed in clients:
+            server.freeClientAsync(killed)
+        server.addReplyLongLong(c, len(clients))
+    elif subcommand == 'setname' and c.argc == 3:
+        name = c.argv[2]
+        if any(ch <= ' ' or ch > '~' for ch in name):
+            server.addReply(c, '-ERR Client names cannot contain spaces, '
+                               'newlines or special characters.\r\n')
+            return
+        c.name = name
+        server.addReply(c, shared.ok)
+    elif subcommand == 'getname' and c.argc == 2:
+        if c.name:
+            server.addReplyBulk(c, c.name)
+        else:
+            server.addReply(c, shared.nullbulk)
+    elif subcommand == 'id' and c.argc == 2:
+        server.addReplyLongLong(c, c.id)
+    else:
+        server.addReply(c, '-ERR unknown CLIENT subcommand '
+                           'or wrong number of arguments\r\n')
+
+
+@server.command(-1, CMD_INLINE)
+def hotkeys(c):
+    """The keys accessed the most by the commands sampled, hottest
+        first, with the estimated accesses and reply bytes, the counts
+        of the samples multiplied by hotkeys-sample-rate, and the
+        command accessing the key the most.
+
+    ::
+        HOTKEYS [count]
+        HOTKEYS RESET
+
+    Replys:
+        [db, key, accesses, reply bytes, command] of every hot key.
+    """
+    hk = server.hotkeys
+    if not hk.rate:
+        server.addReply(c, '-ERR hot keys sampling is disabled, set '
+                           'hotkeys-sample-rate\r\n')
+        return
+
+    if c.argc == 2 and c.argv[1].lower() == 'reset':
+        hk.reset()
+        server.addReply(c, shared.ok)
+        return
+
+    count = 10
+    if c.argc == 2:
+        try:
+            count = int(c.argv[1])
+        except ValueError:
+            server.addReply(c, '-ERR value is not an integer or out '
+                               'of range\r\n')
+            return
+    elif c.argc > 2:
+        server.addReply(c, shared.syntaxerr)
+        return
+
+    server.addReplyMultiBulk(c, [
+        [dictid, key, n * hk.rate, nbytes * hk.rate, command]
+        for dictid, key, n, nbytes, command in hk.items()[:max(count, 0)]
+    ])
+
+
+@server.command(-1, CMD_INLINE)
+def bigkeys(c):
+    """Scan the dbs for the biggest string, list and set of every db,
+        by batches between the commands.
+
+    ::
+        BIGKEYS START
+        BIGKEYS
+
+    Replys:
+        START: status reply, a scan in progress is restarted.
+        BIGKEYS: ['scanned', keys scanned, 'done', 0 or 1, 'keys',
+        [[db, type, key, size, unit], ...]] of the latest scan.
+    """
+    if c.argc == 2 and c.argv[1].lower() == 'start':
+        server.startBigKeysScan()
+        server.addReply(c, shared.ok)
+        return
+    if c.argc != 1:
+        server.addReply(c, shared.syntaxerr)
+        return
+
+    scan = server.bigkeys
+    if scan is None:
+        server.addReply(c, '-ERR no BIGKEYS scan, start one with '
+                           'BIGKEYS START\r\n')
+        return
+    server.addReplyMultiBulk(c, ['scanned', scan.scanned,
+                                 'done', int(scan.done),
+                                 'keys', scan.results()])
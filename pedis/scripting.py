@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+pedis.scripting
+~~~~~~~~~~~~~~~
+
+Server side scripts.
+
+A script is a restricted Python expression, it can use literals,
+operators, subscriptions, conditional expressions and the functions
+below, with `KEYS` and `ARGV` bound to the arguments of EVAL::
+
+    call(command, arg1, ..., argN)  execute command, return its reply
+    int, str, len, min, max
+
+For example, a check-and-set::
+
+    EVAL "call('set', KEYS[0], ARGV[1]) if call('get', KEYS[0]) == ARGV[0] else 0" 1 key old new
+
+Scripts are compiled once and cached by sha1, they are executed
+atomically in the eventloop, a script running longer than
+`script-time-limit` miliseconds is aborted, the commands it already
+executed are not rolled back.
+
+A script has no loops, it evaluates every node of its expression once
+at most, so its running time is bounded by its size and the sizes of
+the values. The only operation building a value much bigger than its
+operands, the repetition of a string or list by `*`, is limited to
+SCRIPT_MAX_REPEAT elements. The time limit is checked by every command
+call and every multiplication.
+"""
+
+import ast
+import time
+import hashlib
+from .server import server, PedisClient, CMD_WRITE, CLIENT_NATIVE
+from .linklist import LinkList
+from .utils import ReplyError
+from ._compat import integer_types, tobytes
+
+
+#: AST nodes a script can use
+ALLOWED_NODES = tuple(getattr(ast, name) for name in (
+    'Expression', 'BoolOp', 'And', 'Or', 'BinOp', 'Add', 'Sub', 'Mult',
+    'Div', 'FloorDiv', 'Mod', 'UnaryOp', 'Not', 'USub', 'UAdd', 'Compare',
+    'Eq', 'NotEq', 'Lt', 'LtE', 'Gt', 'GtE', 'In', 'NotIn', 'Is', 'IsNot',
+    'IfExp', 'Call', 'Name', 'Load', 'Num', 'Str', 'Bytes', 'Constant',
+    'NameConstant', 'Subscript', 'Index', 'Slice', 'List', 'Tuple',
+) if hasattr(ast, name))
+
+SCRIPT_BUILTINS = {
+    'int': int,
+    'str': str,
+    'len': len,
+    'min': min,
+    'max': max,
+    'True': True,
+    'False': False,
+    'None': None,
+}
+
+#: Names a script can refer to
+ALLOWED_NAMES = frozenset(['call', 'KEYS', 'ARGV'] + list(SCRIPT_BUILTINS))
+
+#: Max length of a string or list repeated by `*`
+SCRIPT_MAX_REPEAT = 1024 * 1024 * 8
+
+#: Commands can't be called by scripts
+DENIED_COMMANDS = frozenset([
+    'eval', 'evalsha', 'script', 'multi', 'exec', 'discard', 'watch',
+    'unwatch', 'blpop', 'brpop', 'brpoplpush', 'subscribe', 'unsubscribe',
+    'psubscribe', 'punsubscribe', 'shutdown', 'psync', 'sync', 'slaveof',
+    'replconf', 'wait', 'migrate', 'asking', 'cluster', 'monitor',
+])
+
+
+class ScriptError(Exception):
+    pass
+
+
+class _CheckedMult(ast.NodeTransformer):
+
+    """Replace `a * b` by `_mul(a, b)`, the multiplications are
+    checked by the script runtime.
+    """
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Mult):
+            return node
+        call = ast.Call(func=ast.Name(id='_mul', ctx=ast.Load()),
+                        args=[node.left, node.right], keywords=[])
+        # Python 2 has the star arguments in the Call node.
+        if 'starargs' in ast.Call._fields:
+            call.starargs = call.kwargs = None
+        return ast.copy_location(call, node)
+
+
+def sha1hex(body):
+    return hashlib.sha1(tobytes(body)).hexdigest()
+
+
+def compileScript(body):
+    """Compile the script body.
+
+    Raises:
+        ScriptError: body is not a valid script.
+    """
+    try:
+        tree = ast.parse(body, '<script>', 'eval')
+    except SyntaxError as e:
+        raise ScriptError('Error compiling script: {}'.format(e.msg))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, ALLOWED_NODES):
+            raise ScriptError('{} is not allowed in scripts'.format(
+                type(node).__name__))
+        if isinstance(node, ast.Name) and node.id not in ALLOWED_NAMES:
+            raise ScriptError("Name '{}' is not allowed in scripts".format(
+                node.id))
+        if isinstance(node, ast.Call) and not isinstance(node.func, ast.Name):
+            raise ScriptError('Only functions can be called in scripts')
+
+    tree = ast.fix_missing_locations(_CheckedMult().visit(tree))
+    return compile(tree, '<script>', 'eval')
+
+
+def createScriptClient():
+    """The fake client executing the commands called by scripts."""
+    client = PedisClient()
+    client.flag |= CLIENT_NATIVE
+    client.addr = 'lua'
+    client.reply = LinkList()
+    return client
+
+
+scriptclient = createScriptClient()
+
+
+def evalScript(c, code, keys, args):
+    """Run the compiled script for client c.
+
+    Returns:
+        the value of the script.
+
+    Raises:
+        ScriptError: the script failed or ran out of time.
+    """
+    sc = scriptclient
+    sc.dictid = c.dictid
+    deadline = time.time() + server.script_time_limit / 1000.0
+
+    def checkDeadline():
+        if time.time() > deadline:
+            raise ScriptError('Script killed after running more than '
+                              '{} miliseconds'.format(
+                                  server.script_time_limit))
+
+    def mul(a, b):
+        checkDeadline()
+        for seq, n in ((a, b), (b, a)):
+            if isinstance(seq, (str, list, tuple)) and \
+               isinstance(n, integer_types) and \
+               len(seq) * n > SCRIPT_MAX_REPEAT:
+                raise ScriptError('Repeated value longer than {} in '
+                                  'script'.format(SCRIPT_MAX_REPEAT))
+        return a * b
+
+    def call(name, *argv):
+        checkDeadline()
+
+        name = str(name).lower()
+        found, cmd = server.lookup_command(name)
+        if not found or name in DENIED_COMMANDS:
+            raise ScriptError('Unknown or not allowed command '
+                              'called from script: {}'.format(name))
+
+        if server.masterhost and server.slave_read_only and \
+           cmd.flags & CMD_WRITE:
+            raise ScriptError('Write commands not allowed from script '
+                              'on a read only replica: {}'.format(name))
+
+        sc.argv = [name] + [str(arg) for arg in argv]
+        sc.argc = len(sc.argv)
+        if (cmd.arity > 0 and sc.argc != cmd.arity) or \
+           (sc.argc < -cmd.arity):
+            raise ScriptError('Wrong number of args calling command '
+                              'from script: {}'.format(name))
+
+        server.call(sc, cmd)
+
+        rv = None
+        while sc.reply.length:
+            node = sc.reply.head
+            rv = node.val
+            sc.reply.delNode(node)
+        if isinstance(rv, ReplyError):
+            raise ScriptError('Error calling {} from script: {}'.format(
+                name, rv))
+        return rv
+
+    env = dict(SCRIPT_BUILTINS, call=call, _mul=mul, KEYS=keys, ARGV=args)
+    env['__builtins__'] = {}
+
+    try:
+        return eval(code, env)
+    except ScriptError:
+        raise
+    except Exception as e:
+        raise ScriptError('Error running script: {}'.format(e))
@@ -25,14 +25,30 @@ pedis.server
 """
 
 import os
+import re
+import sys
+import time
+import errno
+import signal
 import socket
+import binascii
 import logging
-import event
-from collections import namedtuple
+from . import event
+from itertools import islice
+from collections import namedtuple, deque
+from fnmatch import translate
 from multiprocessing import Process
-from linklist import LinkList
-from utils import shared
-from _compat import pickle
+from multiprocessing.pool import ThreadPool
+from .linklist import LinkList
+from .backlog import Backlog
+from .lazyfree import LazyFree, freeEffort
+from .cluster import CLUSTER_SLOTS, ClusterState, SlotDict, SlotMigration, \
+    keyHashSlot
+from .latency import CommandStats, SlowLog, LatencyMonitor
+from .hotkeys import HotKeys, BigKeysScan, replySize, HOTKEYS_DECAY_PERIOD
+from .utils import shared, multibulk, nativeReply, splitArgs, dumpValue, \
+    parseMemory, reprArg, raiseOpenFilesLimit
+from ._compat import pickle, tobytes, tostr, perf_counter
 
 
 DEFAULT_DBNUM = 16
@@ -40,8 +56,113 @@ DEFAULT_DBNUM = 16
 LIST_HEAD = 0
 LIST_TAIL = 1
 
-
-def serverCron():
+#: Command flags
+CMD_INLINE = 1
+CMD_BULK = 2
+#: The command itself is not propagated to replicas, the commands it
+#: calls are
+CMD_NOPROPAGATE = 4
+#: The command may modify the keyspace
+CMD_WRITE = 8
+#: The command only reads the keyspace
+CMD_READONLY = 16
+#: The command may grow the memory used
+CMD_DENYOOM = 32
+#: The command runs in constant or logarithmic time, the others are
+#: slow
+CMD_FAST = 64
+
+#: Names of the command flags reported by COMMAND
+CMD_FLAG_NAMES = [
+    (CMD_WRITE, 'write'), (CMD_READONLY, 'readonly'),
+    (CMD_DENYOOM, 'denyoom'), (CMD_FAST, 'fast'),
+]
+
+#: Keyspace notifications, published to `__keyspace@<db>__:<key>` and
+#: `__keyevent@<db>__:<command>`
+NOTIFY_KEYSPACE = 1
+NOTIFY_KEYEVENT = 2
+
+#: Client flags
+CLIENT_BLOCKED = 1
+CLIENT_CLOSED = 2
+CLIENT_MULTI = 4
+CLIENT_DIRTY_CAS = 8
+#: A command failed to be queued, EXEC aborts the transaction
+CLIENT_DIRTY_EXEC = 16
+#: Replies are kept as Python values instead of being sent
+CLIENT_NATIVE = 32
+#: A replica connected to this server
+CLIENT_SLAVE = 64
+#: The master this server replicates
+CLIENT_MASTER = 128
+#: The next command may access a slot importing to this node
+CLIENT_ASKING = 256
+#: Close the client before the eventloop sleeps, the replies are dropped
+CLIENT_CLOSE_ASAP = 512
+#: The commands processed are streamed to the client by MONITOR
+CLIENT_MONITOR = 1024
+
+#: Replica states, on the master side
+SLAVE_STATE_WAIT_BGSAVE_START = 1
+SLAVE_STATE_WAIT_BGSAVE_END = 2
+SLAVE_STATE_SEND_BULK = 3
+SLAVE_STATE_ONLINE = 4
+
+#: Replication link states, on the replica side
+REPL_STATE_NONE = 0
+REPL_STATE_CONNECT = 1
+REPL_STATE_TRANSFER = 2
+REPL_STATE_CONNECTED = 3
+
+#: Event loops serving the clients
+FRONTEND_PEDIS = 'pedis'
+FRONTEND_ASYNCIO = 'asyncio'
+FRONTEND_UVLOOP = 'uvloop'
+
+#: Samples of the instantaneous metrics, taken every serverCron
+STATS_METRIC_SAMPLES = 16
+
+IOBUF_LEN = 1024 * 16
+#: Max bytes written to a client per writable event, not to starve the
+#: other clients
+NET_MAX_WRITES_PER_EVENT = 1024 * 64
+INLINE_MAX_SIZE = 1024 * 64
+
+#: Files kept open besides the clients: the listening sockets, the
+#: snapshot files, the replication and metrics connections...
+CONFIG_MIN_RESERVED_FDS = 32
+
+#: select() can't wait on fds from FD_SETSIZE, the pedis eventloop
+#: serves less clients than this
+FD_SETSIZE = 1024
+
+#: Write without blocking on the blocking client sockets
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+#: Output buffer limits per client class, (hard, soft bytes, soft
+#: seconds). A client is closed when its pending replies reach the
+#: hard limit, or stay over the soft limit for soft seconds, 0
+#: disables a limit.
+CLIENT_OBUF_LIMITS = {
+    'normal': (0, 0, 0),
+    'slave': (256 * 1024 * 1024, 64 * 1024 * 1024, 60),
+    'pubsub': (32 * 1024 * 1024, 8 * 1024 * 1024, 60),
+    'monitor': (32 * 1024 * 1024, 8 * 1024 * 1024, 60),
+}
+
+#: Commands allowed for clients subscribed to channels or patterns
+PUBSUB_CONTEXT_COMMANDS = frozenset([
+    'subscribe', 'unsubscribe', 'psubscribe', 'punsubscribe', 'ping',
+])
+
+#: Commands executed immediately in the context of MULTI
+MULTI_CONTEXT_COMMANDS = frozenset([
+    'exec', 'discard', 'multi', 'watch',
+])
+
+
+def serverCron(id_, clientData):
     """Server side crond job."""
 
     loops = server.cronloops
@@ -55,27 +176,186 @@ def serverCron():
     if loops % 5 == 0:
         debug('. {} clients connected.'.format(server.stat_numconnections))
 
+    # Check if a background saving in progress terminated.
     if server.bgsaveinprogress:
-        pass
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            pid, status = server.bgsavechildpid, 1 << 8
+        if pid:
+            server.backgroundSaveDoneHandler(status)
+
+    server.replicationCron()
+
+    server.clientsCronHandleTimeout()
+
+    if server.hotkeys.rate and loops and loops % HOTKEYS_DECAY_PERIOD == 0:
+        server.hotkeys.decay()
+
+    server.trackInstantaneousMetric('command', server.stat_numcommands)
+    server.trackInstantaneousMetric('net_input', server.stat_net_input_bytes)
+    server.trackInstantaneousMetric('net_output',
+                                    server.stat_net_output_bytes)
+    server.trackInstantaneousMetric('el_cycles',
+                                    server.stat_eventloop_cycles)
 
     return 1000
 
 
+def _randomReplid():
+    return binascii.hexlify(os.urandom(20)).decode()
+
+
+def parseQueryBuffer(client):
+    """Cut the complete commands from client.querybuf to client.pending,
+    as (argv, nbytes, error), error is the reply of a request which
+    can't be executed. A malformed request sets client.protoerror, the
+    rest of querybuf is dropped.
+
+    Commands are either newline terminated inline commands, or
+    multibulk commands::
+
+        *<number of arguments>\r\n
+        $<number of bytes of argument 1>\r\n
+        <argument data>\r\n
+        ...
+    """
+    while client.querybuf and client.protoerror is None:
+        buf = client.querybuf
+        try:
+            if buf[0] == '*':
+                argv, nbytes, error = _parseMultibulk(buf)
+            else:
+                argv, nbytes, error = _parseInline(buf)
+        except ValueError as e:
+            client.protoerror = '-ERR {}\r\n'.format(e)
+            client.querybuf = ''
+            return
+
+        if nbytes == 0:
+            return
+        client.querybuf = buf[nbytes:]
+        if argv or error:
+            client.pending.append((argv, nbytes, error))
+
+
+def _parseInline(buf):
+    newline = buf.find('\n')
+    if newline == -1:
+        if len(buf) > INLINE_MAX_SIZE:
+            raise ValueError('too big inline request')
+        return None, 0, None
+
+    try:
+        return splitArgs(buf[:newline]), newline + 1, None
+    except ValueError:
+        return None, newline + 1, '-ERR unbalanced quotes in request\r\n'
+
+
+def _parseMultibulk(buf):
+    newline = buf.find('\r\n')
+    if newline == -1:
+        return None, 0, None
+
+    try:
+        multibulklen = int(buf[1:newline])
+        pos = newline + 2
+        argv = []
+        for i in range(multibulklen):
+            newline = buf.find('\r\n', pos)
+            if newline == -1:
+                return None, 0, None
+            if buf[pos] != '$':
+                raise ValueError("expected '$', got '{}'".format(buf[pos]))
+            bulklen = int(buf[pos + 1:newline])
+            pos = newline + 2
+            if len(buf) < pos + bulklen + 2:
+                return None, 0, None
+            argv.append(buf[pos:pos + bulklen])
+            pos += bulklen + 2
+    except ValueError as e:
+        raise ValueError('Protocol error: {}'.format(e))
+
+    return argv, pos, None
+
+
 class PedisClient(object):
 
     def __init__(self):
         self.cobj = None
-        self.dict_ = None
+        #: Unique id of the connection, 0 for the native clients
+        self.id = 0
+        #: `host:port` of the peer, empty for the native clients
+        self.addr = ''
+        #: Name set by CLIENT SETNAME
+        self.name = ''
+        #: Time the client connected, and of its latest command
+        self.ctime = 0
+        self.lastinteraction = 0
+        #: Name of the latest command called
+        self.lastcmd = ''
+        #: Node of this client in the server's clients list
+        self.clientnode = None
         self.dictid = None
         self.querybuf = None
         self.argc = 0
         self.argv = None
+        #: Commands parsed from querybuf, (argv, nbytes, error)
+        self.pending = deque()
+        #: Error reply of a malformed request, the client is closed
+        self.protoerror = None
         self.flag = 0
         self.reply = None
+        #: key -> node of this client in the key's blocked clients list
+        self.blockingkeys = {}
+        #: Where to push the element for BRPOPLPUSH
+        self.blockingtarget = None
+        #: Time event id of the blocking timeout
+        self.blocktimer = None
+        #: channel -> node of this client in the channel subscribers list
+        self.pubsub_channels = {}
+        #: pattern -> node of this client in the pattern subscribers list
+        self.pubsub_patterns = {}
+        #: Commands queued by MULTI, list of (cmd, argv)
+        self.mstate = []
+        #: (dictid, key) -> node of this client in the key's watchers list
+        self.watched_keys = {}
+        #: Replication state if this client is a replica
+        self.replstate = 0
+        #: Node of this client in the server's replicas list
+        self.slavenode = None
+        #: Replication stream buffered while the snapshot is created
+        self.replpending = []
+        #: Snapshot file sent to the replica, its size and sent bytes
+        self.repldbfd = None
+        self.repldbsize = 0
+        self.repldboff = 0
+        #: Listening port, acknowledged offset and time of the replica
+        self.slave_listening_port = 0
+        self.repl_ack_off = 0
+        self.repl_ack_time = 0
+        #: Replication offset after the last write of this client
+        self.woff = 0
+        #: Bytes of the replies not written yet, and when they went over
+        #: the soft output buffer limit
+        self.reply_bytes = 0
+        self.obuf_soft_limit_reached_time = 0
+        #: Node of this client in the server's monitors list
+        self.monitornode = None
+        #: WAIT: replicas to wait for, offset they should acknowledge and
+        #: node of this client in the server's waiting list
+        self.bwait_numreplicas = 0
+        self.bwait_offset = 0
+        self.bwait_node = None
 
     def __repr__(self):
         return '<PedisClient cobj={}>'.format(self.cobj)
 
+    @property
+    def dict_(self):
+        """The selected db, a flushed db may be replaced by a new one."""
+        return server.dicts[self.dictid]
+
 
 class PedisServer(object):
 
@@ -83,13 +363,14 @@ class PedisServer(object):
 
     el = event.eventloop
 
-    #: All connected clients ared placed in this list
-    clients = LinkList()
-
     stat_numconnections = 0
 
     commands = {}
 
+    #: Spellings of the command names -> command, the lower and upper
+    #: case names, other spellings are lowered at lookup
+    commands_lookup = {}
+
     #: Times of serverCron executed.
     cronloops = 0
 
@@ -104,32 +385,269 @@ class PedisServer(object):
 
     bgsaveinprogress = 0
 
+    bgsavechildpid = -1
+
+    #: Size in bytes of the replication backlog
+    repl_backlog_size = 1024 * 1024
+
+    #: Master to replicate, set by SLAVEOF or the slaveof directive
+    masterhost = None
+    masterport = None
+
+    #: Replicas reject writes from clients other than the master
+    slave_read_only = 1
+
+    #: Number of worker processes, 0 means serve in this process
+    workers = 0
+
+    #: Threads reading queries and writing replies, 1 means the main
+    #: thread does the io
+    io_threads = 1
+
+    #: Event loop serving the clients, the pedis eventloop, asyncio or
+    #: asyncio on uvloop
+    frontend = FRONTEND_PEDIS
+
+    #: Values of more elements than this are freed in background by
+    #: UNLINK and lazy freeing
+    lazyfree_threshold = 64
+
+    #: DEL frees like UNLINK
+    lazyfree_lazy_user_del = 1
+
+    #: Values deleted or overwritten by the server itself, not by DEL,
+    #: are freed lazily
+    lazyfree_lazy_server_del = 1
+
+    #: Index of this worker process, -1 if not a worker
+    worker_id = -1
+
+    #: Slots served by every node, None if the keyspace is not split
+    cluster = None
+
+    cluster_enabled = 0
+
+    #: Keys moved per batch by MIGRATE, and miliseconds to wait for the
+    #: target node to reply a batch
+    cluster_migrate_batch = 100
+    cluster_migrate_timeout = 1000
+
+    #: Max miliseconds a script can run
+    script_time_limit = 5000
+
+    #: Commands slower than this many microseconds are logged to the
+    #: slow log, a negative value disables it
+    slowlog_log_slower_than = 10000
+
+    #: Entries kept by the slow log
+    slowlog_max_len = 128
+
+    #: Stalls of at least this many miliseconds are recorded by the
+    #: latency monitor, 0 disables it
+    latency_monitor_threshold = 0
+
+    #: Port serving the metrics to Prometheus, 0 disables it
+    metrics_port = 0
+
+    #: Sample 1 in this many commands for HOTKEYS, 0 disables it
+    hotkeys_sample_rate = 0
+
+    #: Close the clients idle for more than this many seconds, 0
+    #: disables it
+    maxidletime = 0
+
+    #: Connections accepted at most, more are rejected
+    maxclients = 10000
+
+    #: Channels the keyspace notifications are published to, 0
+    #: disables them
+    notify_keyspace_events = 0
+
     def __init__(self, host='127.0.0.1', port=6379):
         self.host = host
         self.port = port
 
+        #: (node, start, end) of the cluster-node directives
+        self.cluster_nodes = []
+
+        self._initConfig()
+
+        if self.cluster_enabled:
+            self.cluster = ClusterState('{}:{}'.format(self.host, self.port))
+            for node, start, end in self.cluster_nodes:
+                self.cluster.addSlots(node, start, end)
+
+        #: slot -> migration of the slot in progress
+        self.migrations = {}
+
+        self.lazyfree = LazyFree()
+
+        #: Connected clients, ordered by their latest command, the
+        #: least recently active first
+        self.clients = LinkList()
+
+        #: Id of the next connected client
+        self.next_client_id = 1
+
+        #: Clients to read from and to write to by the io threads
+        self.clients_pending_read = []
+        self.clients_pending_write = []
+        self.io_pool = None
+
         self.dicts = self._initDb()
 
-        #: socket object
-        self.sobj = self._tcpServer()
+        #: key -> list of clients blocked on the key, per db
+        self.blockingkeys = [{} for i in range(self.dbnum)]
+
+        #: Clients unblocked which may have pending commands
+        self.unblocked_clients = LinkList()
 
-        self.el.createTimeEvent(1000, serverCron, None)
+        #: channel -> list of subscribed clients
+        self.pubsub_channels = {}
 
-        self._initConfig()
+        #: pattern -> (compiled pattern, list of subscribed clients)
+        self.pubsub_patterns = {}
+
+        #: key -> list of clients watching the key, per db
+        self.watched_keys = [{} for i in range(self.dbnum)]
+
+        #: sha1 -> compiled script
+        self.scripts = {}
+
+        #: Number of changes to the keyspace, a command increased it is
+        #: propagated to the replicas
+        self.dirty = 0
+
+        #: Commands to propagate after the current command, list of
+        #: (dictid, argv)
+        self.also_propagate = []
+
+        self.lastbgsave_status = 1
+
+        #: Id and offset of the replication stream
+        self.replid = _randomReplid()
+        self.master_repl_offset = 0
+
+        #: Latest replication stream, created with the first replica
+        self.repl_backlog = None
+
+        #: Connected replicas
+        self.slaves = LinkList()
+
+        #: Db selected in the replication stream
+        self.slaveseldb = -1
+
+        #: Clients blocked by WAIT
+        self.clients_waiting_acks = LinkList()
+
+        #: Ask the replicas for acknowledges before sleeping
+        self.get_ack_from_slaves = 0
+
+        #: Client of the master, db selected in the stream of the master
+        self.master = None
+        self.master_dictid = 0
+
+        #: Last time data was received from the master
+        self.master_lastinteraction = 0
+
+        self.repl_state = REPL_STATE_NONE
+        if self.masterhost:
+            self.repl_state = REPL_STATE_CONNECT
+
+        #: Socket, header and snapshot file of the ongoing sync
+        self.repl_transfer_s = None
+        self.repl_transfer_buf = ''
+        self.repl_transfer_replid = None
+        self.repl_transfer_offset = -1
+        self.repl_transfer_size = -1
+        self.repl_transfer_read = 0
+        self.repl_transfer_fd = None
+        self.repl_transfer_tmpfile = None
+
+        #: Stats reported by INFO
+        self.stat_starttime = time.time()
+        self.stat_numconnections_total = 0
+        self.stat_rejected_conn = 0
+        self.stat_sync_full = 0
+        self.stat_sync_partial_ok = 0
+        self.stat_numcommands = 0
+        self.stat_net_input_bytes = 0
+        self.stat_net_output_bytes = 0
+        self.stat_keyspace_hits = 0
+        self.stat_keyspace_misses = 0
+        self.stat_blocked_clients = 0
+
+        #: Eventloop cycles, from waking up to sleeping again, their
+        #: total and max seconds, and when the current one started
+        self.stat_eventloop_cycles = 0
+        self.stat_eventloop_duration_sum = 0
+        self.stat_eventloop_duration_max = 0
+        self.el_cycle_start = 0
+
+        #: metric -> [time, value of the last sample, rates per second]
+        self.inst_metrics = dict(
+            (metric, [time.time(), 0, deque(maxlen=STATS_METRIC_SAMPLES)])
+            for metric in ('command', 'net_input', 'net_output',
+                           'el_cycles'))
+
+        #: Changes to the keyspace when the dbs were saved, and when
+        #: the background saving started
+        self.dirty_lastsave = 0
+        self.dirty_before_bgsave = 0
+
+        #: Latest commands slower than slowlog_log_slower_than
+        self.slowlog = SlowLog(self.slowlog_max_len)
+
+        #: Stalls of the eventloop, the time events and the forks
+        self.latency_monitor = LatencyMonitor(self.latency_monitor_threshold)
+
+        #: Microseconds the latest fork took
+        self.stat_fork_time = 0
+
+        #: Smallest output buffer limit, the clients with less pending
+        #: replies are not checked
+        self.client_obuf_limit_min = min(
+            [limit for hard, soft, seconds in self.client_obuf_limits.values()
+             for limit in (hard, soft) if limit] or [0])
+
+        #: Clients to close before sleeping
+        self.clients_to_close = []
+
+        #: Clients streamed the commands by MONITOR
+        self.monitors = LinkList()
+
+        #: Keys of the sampled commands, and the latest BIGKEYS scan
+        self.hotkeys = HotKeys(self.hotkeys_sample_rate)
+        self.bigkeys = None
+
+        #: socket object, bound when the server runs
+        self.sobj = None
+
+        self.el.createTimeEvent(1000, serverCron, None)
+        self.el.setBeforeSleepProc(self.beforeSleep)
+        self.el.setAfterSleepProc(self.afterSleep)
+        self.el.setTimeProcDoneProc(self.timeProcDone)
 
     def __repr__(self):
         return '<PedisServer host={} port={}>'.format(self.host, self.port)
 
     def _initDb(self):
-        filepath = os.path.join(os.path.dirname(__file__), 'dump.pdb')
+        filepath = self._dbFilepath()
         if os.path.exists(filepath):
             with open(filepath, 'rb') as f:
-                return pickle.load(f)
+                return [self.createDict(dict_) for dict_ in pickle.load(f)]
         # Have no dump file, init empty db
-        return [{} for i in range(self.dbnum)]
+        return [self.createDict() for i in range(self.dbnum)]
+
+    def createDict(self, *args):
+        """Return a new db, a cluster node indexes its keys by slot."""
+        if self.cluster is not None:
+            return SlotDict(*args)
+        return dict(*args)
 
     def _initConfig(self):
         """Resolve the pedis.conf file and init server config."""
+        self.client_obuf_limits = dict(CLIENT_OBUF_LIMITS)
 
         filepath = os.environ.get(
             'PEDIS_CONFIG_FILE',
@@ -137,7 +655,7 @@ class PedisServer(object):
         )
 
         try:
-            f = open(filepath, 'rb')
+            f = open(filepath, 'r')
         except IOError:
             return
 
@@ -145,7 +663,7 @@ class PedisServer(object):
             if line.startswith('#') or line.startswith('\n'):
                 continue
 
-            key, val = line.strip().split(' ')
+            key, val = line.strip().split(' ', 1)
 
             if key == 'port':
                 self.port = int(val)
@@ -165,12 +683,98 @@ class PedisServer(object):
             elif key == 'dir':
                 pass
 
+            elif key == 'timeout':
+                self.maxidletime = int(val)
+
+            elif key == 'maxclients':
+                self.maxclients = int(val)
+
+            elif key == 'notify-keyspace-events':
+                self.notify_keyspace_events = \
+                    (NOTIFY_KEYSPACE if 'K' in val else 0) | \
+                    (NOTIFY_KEYEVENT if 'E' in val else 0)
+
+            elif key == 'script-time-limit':
+                self.script_time_limit = int(val)
+
+            elif key == 'slowlog-log-slower-than':
+                self.slowlog_log_slower_than = int(val)
+
+            elif key == 'slowlog-max-len':
+                self.slowlog_max_len = int(val)
+
+            elif key == 'latency-monitor-threshold':
+                self.latency_monitor_threshold = int(val)
+
+            elif key == 'metrics-port':
+                self.metrics_port = int(val)
+
+            elif key == 'hotkeys-sample-rate':
+                self.hotkeys_sample_rate = int(val)
+
+            elif key == 'client-output-buffer-limit':
+                class_, hard, soft, seconds = val.split()
+                self.client_obuf_limits[class_] = (
+                    parseMemory(hard), parseMemory(soft), int(seconds))
+
+            elif key == 'dbfilename':
+                self.dbfilename = val
+
+            elif key == 'slaveof':
+                host, port = val.split()
+                self.masterhost, self.masterport = host, int(port)
+
+            elif key == 'repl-backlog-size':
+                self.repl_backlog_size = int(val)
+
+            elif key == 'slave-read-only':
+                self.slave_read_only = 1 if val == 'yes' else 0
+
+            elif key == 'workers':
+                self.workers = int(val)
+
+            elif key == 'io-threads':
+                self.io_threads = int(val)
+
+            elif key == 'frontend':
+                self.frontend = val
+
+            elif key == 'lazyfree-threshold':
+                self.lazyfree_threshold = int(val)
+
+            elif key == 'lazyfree-lazy-user-del':
+                self.lazyfree_lazy_user_del = 1 if val == 'yes' else 0
+
+            elif key == 'lazyfree-lazy-server-del':
+                self.lazyfree_lazy_server_del = 1 if val == 'yes' else 0
+
+            elif key == 'cluster-enabled':
+                self.cluster_enabled = 1 if val == 'yes' else 0
+
+            elif key == 'cluster-node':
+                node, slots = val.split()
+                start, _, end = slots.partition('-')
+                self.cluster_nodes.append((node, int(start),
+                                           int(end or start)))
+
+            elif key == 'cluster-migrate-batch':
+                self.cluster_migrate_batch = int(val)
+
+            elif key == 'cluster-migrate-timeout':
+                self.cluster_migrate_timeout = int(val)
+
         f.close()
 
+    def _dbFilepath(self):
+        return os.path.join(os.path.dirname(__file__), self.dbfilename)
+
     def _tcpServer(self):
         """Create a tcp server. """
         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # The workers accept on the same port.
+        if self.workers:
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         s.bind((self.host, self.port))
         s.listen(32)
         return s
@@ -181,18 +785,303 @@ class PedisServer(object):
 
         :param sobj: server socket object.
         """
-        cobj, (host, port) = sobj.accept()
+        try:
+            cobj, (host, port) = sobj.accept()
+        except socket.error as e:
+            # Out of fds, the connection waits in the backlog.
+            wain('# Accepting client connection: {}'.format(e))
+            return
+        if server.clients.length >= server.maxclients:
+            server.rejectClient(cobj)
+            return
         server.stat_numconnections += 1
+        server.stat_numconnections_total += 1
         debug('. Accepted: {}:{}'.format(host, port))
         self.createClient(cobj)
 
-    def command(self, arity, flags, cmd_name=None):
+    def rejectClient(self, cobj):
+        """Reply an error to a connection over maxclients and close
+        it, the reply is dropped if it can't be written at once.
+        """
+        self.stat_rejected_conn += 1
+        try:
+            cobj.send(b'-ERR max number of clients reached\r\n',
+                      MSG_DONTWAIT)
+        except socket.error:
+            pass
+        cobj.close()
+
+    def adjustOpenFilesLimit(self):
+        """Raise the limit of open files for maxclients, maxclients is
+        lowered to what the limit and the eventloop allow.
+        """
+        maxclients = self.maxclients
+        limit = raiseOpenFilesLimit(maxclients + CONFIG_MIN_RESERVED_FDS)
+        if limit is not None:
+            maxclients = min(maxclients, limit - CONFIG_MIN_RESERVED_FDS)
+        # The asyncio frontends don't use select().
+        if self.frontend == FRONTEND_PEDIS:
+            maxclients = min(maxclients,
+                             FD_SETSIZE - CONFIG_MIN_RESERVED_FDS)
+        maxclients = max(maxclients, 1)
+        if maxclients < self.maxclients:
+            wain('# maxclients lowered from {} to {}, not enough fds '
+                 'for more clients'.format(self.maxclients, maxclients))
+            self.maxclients = maxclients
+
+    def command(self, arity, flags, cmd_name=None, keys=(0, 0, 0),
+                getkeys=None):
+        """Register a command proc.
+
+        :param arity: number of arguments including the command name,
+                      a negative arity -N means at least N arguments.
+        :param flags: command flags.
+        :param cmd_name: name of the command, default the proc name,
+                         it is looked up case insensitively.
+        :param keys: (firstkey, lastkey, keystep), positions of the key
+                     arguments, a negative lastkey counts from the end.
+        :param getkeys: function returning the keys of argv, for the
+                        commands whose keys are not at fixed positions.
+        """
         def decorator(f):
             name = cmd_name if cmd_name else f.__name__
-            self.commands[name] = cmd(f, arity, flags)
+            c = cmd(name, f, arity, flags, keys[0], keys[1], keys[2],
+                    getkeys, CommandStats())
+            self.commands[name] = c
+            self.commands_lookup[name] = c
+            self.commands_lookup[name.upper()] = c
             return f
         return decorator
 
+    def getKeysFromCommand(self, cmd, argv):
+        """Return the key arguments of the command."""
+        if cmd.getkeys is not None:
+            return cmd.getkeys(argv)
+        if cmd.firstkey == 0:
+            return []
+        lastkey = cmd.lastkey
+        if lastkey < 0:
+            lastkey += len(argv)
+        return argv[cmd.firstkey:lastkey + 1:cmd.keystep]
+
+    def clusterRedirect(self, client, cmd):
+        """Redirect the command if its keys are not served by this
+        node, the keys of a command must be in the same slot.
+
+        Returns:
+            1 if the command is redirected, an error is replied.
+        """
+        asking = client.flag & CLIENT_ASKING
+        if cmd.name != 'asking':
+            client.flag &= ~CLIENT_ASKING
+
+        keys = self.getKeysFromCommand(cmd, client.argv)
+        if not keys:
+            return 0
+
+        slot = keyHashSlot(keys[0])
+        for key in keys[1:]:
+            if keyHashSlot(key) != slot:
+                self.addReply(client, '-CROSSSLOT Keys in request don\'t '
+                                      'hash to the same slot\r\n')
+                return 1
+
+        cs = self.cluster
+        node = cs.slots[slot]
+        if node is None:
+            self.addReply(client, '-CLUSTERDOWN Hash slot not served\r\n')
+            return 1
+
+        if node == cs.myself:
+            # The keys not here are already migrated.
+            target = cs.migrating_slots_to.get(slot)
+            if target is not None and \
+               any(key not in client.dict_ for key in keys):
+                self.addReply(client, '-ASK {} {}\r\n'.format(slot, target))
+                return 1
+            # The keys sent to the target are read only until deleted.
+            migration = self.migrations.get(slot)
+            if migration is not None and cmd.flags & CMD_WRITE and \
+               migration.dictid == client.dictid and \
+               any(key in migration.inflight for key in keys):
+                self.addReply(client, '-TRYAGAIN Keys are being migrated, '
+                                      'try again later\r\n')
+                return 1
+            return 0
+
+        if asking and slot in cs.importing_slots_from:
+            return 0
+
+        self.addReply(client, '-MOVED {} {}\r\n'.format(slot, node))
+        return 1
+
+    def clusterStartMigration(self, slot, target):
+        """Start to migrate the keys of slot to the target node, by
+        batches of `cluster_migrate_batch` keys in a time event, the
+        clients are served between batches. The target serves the
+        slot when all the keys are migrated.
+
+        Raises:
+            socket.error: can't connect to the target.
+        """
+        host, port = target.rsplit(':', 1)
+        s = socket.create_connection(
+            (host, int(port)), timeout=self.cluster_migrate_timeout / 1000.0)
+
+        migration = SlotMigration(slot, target, s)
+        self.migrations[slot] = migration
+        self.cluster.migrating_slots_to[slot] = target
+
+        # The target accepts the slot before MIGRATE replies, the
+        # batches are not waited for.
+        try:
+            s.sendall(tobytes(multibulk(
+                ['cluster', 'setslot', str(slot), 'importing',
+                 self.cluster.myself])))
+            migration.pending = 1
+            while migration.pending:
+                data = s.recv(IOBUF_LEN)
+                if not data:
+                    raise socket.error('connection closed by target node')
+                self.clusterMigrationReadReplies(migration, tostr(data))
+        except (socket.error, ValueError) as e:
+            self.clusterStopMigration(migration)
+            raise socket.error('target node can\'t import: {}'.format(e))
+
+        s.setblocking(0)
+        self.el.createFileEvent(s, event.READABLE,
+                                self.clusterMigrationReadHandler, migration)
+        self.el.createTimeEvent(1, self.clusterMigrationCron, migration)
+        info('- Migrating slot {} to {}'.format(slot, target))
+
+    def clusterMigrationSend(self, migration, commands):
+        """Queue commands to the target node, they are written when the
+        connection is writable, and their replies are counted by
+        clusterMigrationReadHandler.
+        """
+        if not migration.writebuf:
+            self.el.createFileEvent(migration.sobj, event.WRITABLE,
+                                    self.clusterMigrationWriteHandler,
+                                    migration)
+        migration.writebuf += tobytes(
+            ''.join(multibulk(argv) for argv in commands))
+        migration.pending += len(commands)
+        migration.deadline = time.time() + \
+            self.cluster_migrate_timeout / 1000.0
+
+    def clusterMigrationReadReplies(self, migration, data):
+        """Count the replies of the target node in data.
+
+        Raises:
+            ValueError: the target replied an error.
+        """
+        migration.readbuf += data
+        while '\n' in migration.readbuf:
+            line, migration.readbuf = migration.readbuf.split('\n', 1)
+            if line.startswith('-'):
+                raise ValueError(line[1:].rstrip('\r'))
+            migration.pending -= 1
+
+    def clusterMigrationWriteHandler(self, s, migration):
+        try:
+            nwritten = s.send(migration.writebuf)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.clusterMigrationFailed(migration, e)
+            return
+        migration.writebuf = migration.writebuf[nwritten:]
+        if not migration.writebuf:
+            self.el.deleteFileEvent(s, event.WRITABLE)
+
+    def clusterMigrationReadHandler(self, s, migration):
+        try:
+            data = s.recv(IOBUF_LEN)
+            if not data:
+                raise socket.error('connection closed by target node')
+            self.clusterMigrationReadReplies(migration, tostr(data))
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.clusterMigrationFailed(migration, e)
+        except ValueError as e:
+            self.clusterMigrationFailed(migration, e)
+
+    def clusterMigrationCron(self, id_, migration):
+        """Delete the keys of the batch acked by the target, and send
+        the next batch of keys of the slot.
+        """
+        if self.migrations.get(migration.slot) is not migration:
+            # Failed
+            return event.NOMORE
+
+        if migration.pending:
+            if time.time() > migration.deadline:
+                self.clusterMigrationFailed(migration, 'timeout')
+                return event.NOMORE
+            return 1
+
+        for key in migration.inflight:
+            if self.dbDelete(migration.dictid, key,
+                             self.lazyfree_lazy_server_del):
+                self.signalModifiedKey(migration.dictid, key)
+                self.replicationFeedSlaves(migration.dictid, ['del', key])
+        migration.migrated += len(migration.inflight)
+        migration.inflight = set()
+
+        if migration.done:
+            cs = self.cluster
+            cs.slots[migration.slot] = migration.target
+            del(cs.migrating_slots_to[migration.slot])
+            self.clusterStopMigration(migration)
+            info('- Slot {} migrated to {}, {} keys'.format(
+                migration.slot, migration.target, migration.migrated))
+            return event.NOMORE
+
+        # Only the keys of the slot are visited, db by db.
+        keys = []
+        while migration.dictid < self.dbnum:
+            dict_ = self.dicts[migration.dictid]
+            keys = list(islice(dict_.slotKeys(migration.slot),
+                               self.cluster_migrate_batch))
+            if keys:
+                break
+            migration.dictid += 1
+
+        if not keys:
+            self.clusterMigrationSend(migration, [
+                ['cluster', 'setslot', str(migration.slot), 'node',
+                 migration.target]])
+            migration.done = 1
+            return 1
+
+        commands = []
+        if migration.dictid != migration.seldb:
+            commands.append(['select', str(migration.dictid)])
+            migration.seldb = migration.dictid
+        for key in keys:
+            commands.append(['asking'])
+            commands.append(['restore', key, dumpValue(dict_[key]),
+                             'replace'])
+        # The keys are written by no client until they are deleted.
+        migration.inflight = set(keys)
+        self.clusterMigrationSend(migration, commands)
+        return 1
+
+    def clusterMigrationFailed(self, migration, reason):
+        wain('# Migrating slot {} to {} failed: {}'.format(
+            migration.slot, migration.target, reason))
+        self.clusterStopMigration(migration)
+
+    def clusterStopMigration(self, migration):
+        """Close the connection of the migration, the slot stays
+        migrating if it is not done, MIGRATE again to resume.
+        """
+        self.el.deleteFileEvent(migration.sobj, event.READABLE)
+        self.el.deleteFileEvent(migration.sobj, event.WRITABLE)
+        migration.sobj.close()
+        del(self.migrations[migration.slot])
+
     @classmethod
     def createClient(self, cobj):
         """Create client.
@@ -201,13 +1090,20 @@ class PedisServer(object):
         """
         client = PedisClient()
         client.cobj = cobj
-        client.dict_ = server.dicts[0]
+        client.id = server.next_client_id
+        server.next_client_id += 1
+        client.addr = '{}:{}'.format(*cobj.getpeername()[:2])
+        client.ctime = client.lastinteraction = time.time()
         client.dictid = 0
+        client.querybuf = ''
         client.reply = LinkList()
-        self.el.createFileEvent(cobj,
-                                event.READABLE,
-                                self.readQueryFromClient, client)
-        self.clients.addNodeTail(client)
+        # The asyncio frontend reads from its own transports.
+        if server.frontend == FRONTEND_PEDIS:
+            self.el.createFileEvent(cobj,
+                                    event.READABLE,
+                                    self.readQueryFromClient, client)
+        client.clientnode = server.clients.addNodeTail(client)
+        return client
 
     @classmethod
     def sendReplyToClient(self, cobj, client):
@@ -216,34 +1112,1026 @@ class PedisServer(object):
         :param cobj: client connect object.
         :param client: pedis client object.
         """
-        while client.reply.length:
-            node = client.reply.head
-            cobj.sendall(node.val)
-            client.reply.delNode(node)
+        nwritten = server.writeToClient(client)
+        if nwritten == -1:
+            self.freeClient(client)
+            return
+        server.stat_net_output_bytes += nwritten
 
         if client.reply.length == 0:
             self.el.deleteFileEvent(cobj, event.WRITABLE)
 
     @classmethod
-    def freeClient(self, cobj):
+    def freeClient(self, client):
         """Free client.
 
-        :param cobj: client connect object.
+        :param client: pedis client object.
+        """
+        cobj = client.cobj
+        if client.flag & CLIENT_BLOCKED:
+            server.unblockClient(client)
+        server.pubsubUnsubscribeAllChannels(client, 0)
+        server.pubsubUnsubscribeAllPatterns(client, 0)
+        server.unwatchAllKeys(client)
+        if client.flag & CLIENT_MONITOR:
+            server.monitors.delNode(client.monitornode)
+        if client.flag & CLIENT_SLAVE:
+            server.slaves.delNode(client.slavenode)
+            if client.repldbfd is not None:
+                client.repldbfd.close()
+        if client.clientnode is not None:
+            server.clients.delNode(client.clientnode)
+            client.clientnode = None
+        # Native clients have no connection.
+        if cobj is not None:
+            self.el.deleteFileEvent(cobj, event.READABLE)
+            self.el.deleteFileEvent(cobj, event.WRITABLE)
+            cobj.close()
+            server.stat_numconnections -= 1
+        client.flag |= CLIENT_CLOSED
+        if client.flag & CLIENT_MASTER:
+            server.replicationHandleMasterDisconnection(client)
+
+    def blockForKeys(self, client, keys, timeout, target=None):
+        """Block the client until one of keys is pushed to or timeout.
+
+        The client stays registered to the eventloop, but the commands
+        it sends are left in the querybuf until it gets unblocked.
+
+        :param client: pedis client object.
+        :param keys: keys to wait for.
+        :param timeout: seconds to wait, 0 means wait forever.
+        :param target: destination key of BRPOPLPUSH.
+        """
+        blockingkeys = self.blockingkeys[client.dictid]
+        for key in keys:
+            if key in client.blockingkeys:
+                continue
+            if key not in blockingkeys:
+                blockingkeys[key] = LinkList()
+            client.blockingkeys[key] = blockingkeys[key].addNodeTail(client)
+
+        client.blockingtarget = target
+        if timeout > 0:
+            client.blocktimer = self.el.createTimeEvent(
+                timeout * 1000, self.blockTimeoutHandler, client)
+        client.flag |= CLIENT_BLOCKED
+        self.stat_blocked_clients += 1
+
+    def unblockClient(self, client):
+        """Remove the client from all the blocked lists it waits in.
+
+        :param client: pedis client object.
+        """
+        blockingkeys = self.blockingkeys[client.dictid]
+        for key, node in client.blockingkeys.items():
+            waiters = blockingkeys[key]
+            waiters.delNode(node)
+            if waiters.length == 0:
+                del(blockingkeys[key])
+        client.blockingkeys = {}
+        client.blockingtarget = None
+
+        if client.bwait_node is not None:
+            self.clients_waiting_acks.delNode(client.bwait_node)
+            client.bwait_node = None
+
+        if client.blocktimer is not None:
+            self.el.deleteTimeEvent(client.blocktimer)
+            client.blocktimer = None
+
+        client.flag &= ~CLIENT_BLOCKED
+        self.stat_blocked_clients -= 1
+        self.unblocked_clients.addNodeTail(client)
+
+    def blockTimeoutHandler(self, id_, client):
+        """Reply nil to the client blocked too long, or the replicas
+        acknowledged for WAIT.
+        """
+        client.blocktimer = None
+        waiting = client.bwait_node is not None
+        self.unblockClient(client)
+        if waiting:
+            self.addReplyLongLong(
+                client, self.replicationCountAcksByOffset(client.bwait_offset))
+        else:
+            self.addReply(client, shared.nullmultibulk)
+        return event.NOMORE
+
+    def blockForReplication(self, client, timeout, offset, numreplicas):
+        """Block the client until numreplicas replicas acknowledged
+        offset, or timeout.
+
+        :param timeout: miliseconds to wait, 0 means wait forever.
+        """
+        client.bwait_offset = offset
+        client.bwait_numreplicas = numreplicas
+        client.bwait_node = self.clients_waiting_acks.addNodeTail(client)
+        if timeout > 0:
+            client.blocktimer = self.el.createTimeEvent(
+                timeout, self.blockTimeoutHandler, client)
+        client.flag |= CLIENT_BLOCKED
+        self.stat_blocked_clients += 1
+        self.get_ack_from_slaves = 1
+
+    def startBigKeysScan(self):
+        """Scan the dbs for the biggest keys by batches in a time
+        event, a scan in progress is abandoned.
+        """
+        self.bigkeys = BigKeysScan(self.dicts)
+        self.el.createTimeEvent(1, self.bigKeysCron, self.bigkeys)
+
+    def bigKeysCron(self, id_, scan):
+        if scan is not self.bigkeys:
+            return event.NOMORE
+        scan.step(self.dicts)
+        return event.NOMORE if scan.done else 1
+
+    def getClientType(self, client):
+        """Return the class of the output buffer limits of client."""
+        if client.flag & CLIENT_MONITOR:
+            return 'monitor'
+        if client.flag & CLIENT_SLAVE:
+            return 'slave'
+        if client.flag & CLIENT_MASTER:
+            return 'master'
+        if client.pubsub_channels or client.pubsub_patterns:
+            return 'pubsub'
+        return 'normal'
+
+    def checkClientOutputBufferLimits(self, client):
+        """Close the client asynchronously if its pending replies are
+        over the limits of its class, the command adding the reply
+        goes on with the client.
+        """
+        hard, soft, seconds = self.client_obuf_limits.get(
+            self.getClientType(client), (0, 0, 0))
+        nbytes = client.reply_bytes
+
+        over = hard and nbytes >= hard
+        if soft and nbytes >= soft:
+            now = time.time()
+            if not client.obuf_soft_limit_reached_time:
+                client.obuf_soft_limit_reached_time = now
+            elif now - client.obuf_soft_limit_reached_time > seconds:
+                over = 1
+        else:
+            client.obuf_soft_limit_reached_time = 0
+
+        if over:
+            wain('# Client {} closed for overcoming of output buffer '
+                 'limits: {} bytes pending'.format(client.addr, nbytes))
+            self.freeClientAsync(client)
+
+    def freeClientAsync(self, client):
+        """Free the client before the eventloop sleeps."""
+        if client.flag & (CLIENT_CLOSE_ASAP | CLIENT_CLOSED):
+            return
+        client.flag |= CLIENT_CLOSE_ASAP
+        self.clients_to_close.append(client)
+
+    def freeClientsInAsyncFreeQueue(self):
+        clients, self.clients_to_close = self.clients_to_close, []
+        for client in clients:
+            if not client.flag & CLIENT_CLOSED:
+                self.freeClient(client)
+
+    def touchClient(self, client):
+        """Record that client sent a query, it moves to the tail of
+        the clients list.
+        """
+        client.lastinteraction = time.time()
+        if client.clientnode is not None:
+            self.clients.moveNodeTail(client.clientnode)
+
+    def clientsCronHandleTimeout(self):
+        """Close the clients idle for more than maxidletime, only the
+        idle clients at the head of the clients list are looked at.
+
+        The replicas, the master, and the blocked, subscribed and
+        monitor clients are not closed, they are moved to the tail
+        keeping their idle time, so they are looked at once until the
+        clients before them get idle.
+        """
+        if not self.maxidletime:
+            return
+        now = time.time()
+        for i in range(self.clients.length):
+            node = self.clients.head
+            client = node.val
+            if now - client.lastinteraction <= self.maxidletime:
+                break
+            if client.flag & (CLIENT_SLAVE | CLIENT_MASTER | CLIENT_BLOCKED |
+                              CLIENT_MONITOR) or \
+               client.pubsub_channels or client.pubsub_patterns:
+                self.clients.moveNodeTail(node)
+                continue
+            debug('. Closing idle client {}'.format(client.addr))
+            self.freeClient(client)
+
+    def feedMonitors(self, client, argv):
+        """Send the command of client to the monitors, the line is
+        formatted once and shared by all the monitors.
+        """
+        line = '+{:.6f} [{} {}] {}\r\n'.format(
+            time.time(), client.dictid, client.addr,
+            ' '.join(reprArg(arg) for arg in argv))
+        for node in self.monitors:
+            self.addReply(node.val, line)
+
+    def beforeSleep(self):
+        """Called before the eventloop waits for events."""
+        if self.clients_pending_read:
+            self.handleClientsWithPendingReads()
+
+        # Ask the replicas to acknowledge the offset for WAIT.
+        if self.get_ack_from_slaves:
+            self.replicationFeedSlaves(-1, ['replconf', 'getack', '*'])
+            self.get_ack_from_slaves = 0
+
+        # Process the commands that clients sent while blocked.
+        while self.unblocked_clients.length:
+            node = self.unblocked_clients.head
+            self.unblocked_clients.delNode(node)
+            client = node.val
+            if not client.flag & CLIENT_CLOSED:
+                self.processInputBuffer(client)
+
+        if self.clients_to_close:
+            self.freeClientsInAsyncFreeQueue()
+
+        if self.clients_pending_write:
+            self.handleClientsWithPendingWrites()
+
+        if self.el_cycle_start:
+            duration = time.time() - self.el_cycle_start
+            self.stat_eventloop_cycles += 1
+            self.stat_eventloop_duration_sum += duration
+            self.stat_eventloop_duration_max = max(
+                self.stat_eventloop_duration_max, duration)
+            self.latency_monitor.addSampleIfNeeded('eventloop',
+                                                   duration * 1000)
+
+    def afterSleep(self):
+        """Called when the eventloop wakes up."""
+        self.el_cycle_start = time.time()
+
+    def timeProcDone(self, te, seconds):
+        """Called when the proc of the time event te returned."""
+        self.latency_monitor.addSampleIfNeeded('time-event', seconds * 1000)
+
+    def ioMap(self, func, clients):
+        """Call func for every client by the io threads, or by the main
+        thread if there are too few clients to be worth it.
+
+        Returns:
+            list of the results.
+        """
+        if self.io_pool is None or len(clients) < self.io_threads * 2:
+            return [func(client) for client in clients]
+        return self.io_pool.map(func, clients)
+
+    def handleClientsWithPendingReads(self):
+        """Read and parse the queries of the readable clients in
+        parallel, then execute the commands in the main thread.
+        """
+        clients = self.clients_pending_read
+        self.clients_pending_read = []
+
+        for client, nread in zip(clients,
+                                 self.ioMap(self.readAndParseQuery, clients)):
+            if client.flag & CLIENT_CLOSED:
+                continue
+            if not nread:
+                self.freeClient(client)
+                debug('. Client closed connection')
+                continue
+            self.stat_net_input_bytes += nread
+            self.touchClient(client)
+            if client.flag & CLIENT_MASTER:
+                self.master_lastinteraction = time.time()
+            self.processInputBuffer(client)
+
+    def handleClientsWithPendingWrites(self):
+        """Write the replies of the clients in parallel."""
+        clients = [client for client in self.clients_pending_write
+                   if not client.flag & CLIENT_CLOSED]
+        self.clients_pending_write = []
+
+        for client, nwritten in zip(clients,
+                                    self.ioMap(self.writeToClient, clients)):
+            if nwritten == -1:
+                self.freeClient(client)
+                continue
+            self.stat_net_output_bytes += nwritten
+            if not client.reply.length:
+                continue
+            # The rest is written when the socket is writable, a paused
+            # asyncio transport queues the client again when resumed.
+            if self.frontend == FRONTEND_PEDIS:
+                self.el.createFileEvent(client.cobj, event.WRITABLE,
+                                        self.sendReplyToClient, client)
+            elif not client.cobj.paused:
+                self.clients_pending_write.append(client)
+
+    def writeToClient(self, client):
+        """Send the replies of the client without blocking, what the
+        socket can't take is kept in the replies. Only the client is
+        touched, io threads call it in parallel.
+
+        Returns:
+            number of bytes written, -1 if the connection is broken.
+        """
+        totwritten = 0
+        while client.reply.length and totwritten < NET_MAX_WRITES_PER_EVENT:
+            # Small replies are written together.
+            chunks, size, node = [], 0, client.reply.head
+            while node is not None and size < IOBUF_LEN:
+                chunks.append(node.val)
+                size += len(node.val)
+                node = node.next
+            data = ''.join(chunks)
+
+            try:
+                nwritten = client.cobj.send(tobytes(data), MSG_DONTWAIT)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                debug('. Error writing to client: {}'.format(e))
+                return -1
+            totwritten += nwritten
+            client.reply_bytes -= nwritten
+            # The socket buffer is full.
+            partial = nwritten < len(data)
+
+            # Drop the replies written, keep the rest of a partial one.
+            while nwritten:
+                node = client.reply.head
+                if nwritten < len(node.val):
+                    node.val = node.val[nwritten:]
+                    break
+                nwritten -= len(node.val)
+                client.reply.delNode(node)
+            if partial:
+                break
+        return totwritten
+
+    def watchKey(self, client, key):
+        """Watch key of the client's db for EXEC."""
+        if (client.dictid, key) in client.watched_keys:
+            return
+        watched_keys = self.watched_keys[client.dictid]
+        if key not in watched_keys:
+            watched_keys[key] = LinkList()
+        client.watched_keys[(client.dictid, key)] = \
+            watched_keys[key].addNodeTail(client)
+
+    def unwatchAllKeys(self, client):
+        """Unwatch all the keys watched by the client."""
+        for (dictid, key), node in client.watched_keys.items():
+            watchers = self.watched_keys[dictid][key]
+            watchers.delNode(node)
+            if watchers.length == 0:
+                del(self.watched_keys[dictid][key])
+        client.watched_keys = {}
+
+    def signalModifiedKey(self, dictid, key):
+        """Called by every command modifying key, the transactions of
+        the clients watching key will fail.
+        """
+        watchers = self.watched_keys[dictid].get(key)
+        if watchers:
+            for node in watchers:
+                node.val.flag |= CLIENT_DIRTY_CAS
+        self.dirty += 1
+
+    def signalFlushedDb(self, dictid):
+        """Called when a db is flushed, all the watched keys that
+        exist in the db are modified. dictid -1 means all dbs.
+        """
+        if dictid == -1:
+            dictids = range(self.dbnum)
+        else:
+            dictids = [dictid]
+
+        for i in dictids:
+            for key in self.watched_keys[i]:
+                if key in self.dicts[i]:
+                    self.signalModifiedKey(i, key)
+        self.dirty += 1
+
+    def pubsubSubscribeChannel(self, client, channel):
+        """Subscribe the client to channel."""
+        if channel not in client.pubsub_channels:
+            if channel not in self.pubsub_channels:
+                self.pubsub_channels[channel] = LinkList()
+            subscribers = self.pubsub_channels[channel]
+            client.pubsub_channels[channel] = subscribers.addNodeTail(client)
+        self.addReplyMultiBulk(client, ['subscribe', channel,
+                                        self.pubsubCount(client)])
+
+    def pubsubUnsubscribeChannel(self, client, channel, notify):
+        """Unsubscribe the client from channel.
+
+        :param notify: reply the unsubscription to the client.
+        """
+        node = client.pubsub_channels.pop(channel, None)
+        if node is not None:
+            subscribers = self.pubsub_channels[channel]
+            subscribers.delNode(node)
+            if subscribers.length == 0:
+                del(self.pubsub_channels[channel])
+        if notify:
+            self.addReplyMultiBulk(client, ['unsubscribe', channel,
+                                            self.pubsubCount(client)])
+
+    def pubsubUnsubscribeAllChannels(self, client, notify):
+        """Unsubscribe the client from all the channels."""
+        channels = list(client.pubsub_channels)
+        for channel in channels:
+            self.pubsubUnsubscribeChannel(client, channel, notify)
+        if notify and not channels:
+            self.addReplyMultiBulk(client, ['unsubscribe', None,
+                                            self.pubsubCount(client)])
+
+    def pubsubSubscribePattern(self, client, pattern):
+        """Subscribe the client to channels matching pattern."""
+        if pattern not in client.pubsub_patterns:
+            if pattern not in self.pubsub_patterns:
+                self.pubsub_patterns[pattern] = (
+                    re.compile(translate(pattern)), LinkList())
+            subscribers = self.pubsub_patterns[pattern][1]
+            client.pubsub_patterns[pattern] = subscribers.addNodeTail(client)
+        self.addReplyMultiBulk(client, ['psubscribe', pattern,
+                                        self.pubsubCount(client)])
+
+    def pubsubUnsubscribePattern(self, client, pattern, notify):
+        """Unsubscribe the client from pattern.
+
+        :param notify: reply the unsubscription to the client.
         """
-        self.el.deleteFileEvent(cobj, event.READABLE)
+        node = client.pubsub_patterns.pop(pattern, None)
+        if node is not None:
+            subscribers = self.pubsub_patterns[pattern][1]
+            subscribers.delNode(node)
+            if subscribers.length == 0:
+                del(self.pubsub_patterns[pattern])
+        if notify:
+            self.addReplyMultiBulk(client, ['punsubscribe', pattern,
+                                            self.pubsubCount(client)])
+
+    def pubsubUnsubscribeAllPatterns(self, client, notify):
+        """Unsubscribe the client from all the patterns."""
+        patterns = list(client.pubsub_patterns)
+        for pattern in patterns:
+            self.pubsubUnsubscribePattern(client, pattern, notify)
+        if notify and not patterns:
+            self.addReplyMultiBulk(client, ['punsubscribe', None,
+                                            self.pubsubCount(client)])
+
+    def pubsubCount(self, client):
+        """Return the number of channels and patterns subscribed."""
+        return len(client.pubsub_channels) + len(client.pubsub_patterns)
+
+    def pubsubPublishMessage(self, channel, message):
+        """Publish message to the subscribers of channel and of the
+        patterns matching channel. Every message frame is encoded once
+        and shared by all its receivers, the native receivers get the
+        Python values.
+
+        Returns:
+            number of clients received the message.
+        """
+        receivers = 0
+
+        subscribers = self.pubsub_channels.get(channel)
+        if subscribers:
+            items = ['message', channel, message]
+            frame = multibulk(items)
+            for node in subscribers:
+                self.addReplyFrame(node.val, frame, items)
+            receivers += subscribers.length
+
+        for pattern, (regex, subscribers) in self.pubsub_patterns.items():
+            if not regex.match(channel):
+                continue
+            items = ['pmessage', pattern, channel, message]
+            frame = multibulk(items)
+            for node in subscribers:
+                self.addReplyFrame(node.val, frame, items)
+            receivers += subscribers.length
+
+        return receivers
+
+    def notifyKeyspaceEvent(self, event, keys, dictid):
+        """Publish that the command event modified the keys of db
+        dictid.
+        """
+        for key in keys:
+            if self.notify_keyspace_events & NOTIFY_KEYSPACE:
+                self.pubsubPublishMessage(
+                    '__keyspace@{}__:{}'.format(dictid, key), event)
+            if self.notify_keyspace_events & NOTIFY_KEYEVENT:
+                self.pubsubPublishMessage(
+                    '__keyevent@{}__:{}'.format(dictid, event), key)
+
+    def saveDb(self, filename):
+        """Save the dbs on disk, the file is replaced atomically.
+
+        Returns:
+            1 on success, 0 on error.
+        """
+        filepath = os.path.join(os.path.dirname(__file__), filename)
+        tmpfile = '{}.{}.tmp'.format(filepath, os.getpid())
+        try:
+            with open(tmpfile, 'wb') as f:
+                pickle.dump(self.dicts, f)
+            os.rename(tmpfile, filepath)
+        except (IOError, OSError) as e:
+            wain('# Failed saving the DB: {}'.format(e))
+            return 0
+        info('- DB saved on disk')
+        self.lastsave = int(time.time())
+        self.dirty_lastsave = self.dirty
+        return 1
+
+    def saveDbBackground(self, filename):
+        """Fork a child process saving the dbs on disk, the parent
+        reaps it in serverCron.
+
+        Returns:
+            pid of the child, -1 on error.
+        """
+        if self.bgsaveinprogress:
+            return -1
+
+        start = time.time()
+        try:
+            pid = os.fork()
+        except OSError as e:
+            wain('# Can\'t save in background: fork: {}'.format(e))
+            return -1
+
+        if pid == 0:
+            # Child
+            if self.sobj is not None:
+                self.sobj.close()
+            os._exit(0 if self.saveDb(filename) else 1)
+
+        # Parent
+        elapsed = time.time() - start
+        self.stat_fork_time = int(elapsed * 1000000)
+        self.latency_monitor.addSampleIfNeeded('fork', elapsed * 1000)
+        info('- Background saving started by pid {}'.format(pid))
+        self.dirty_before_bgsave = self.dirty
+        self.bgsaveinprogress = 1
+        self.bgsavechildpid = pid
+        return pid
+
+    def backgroundSaveDoneHandler(self, status):
+        """Called when the background saving child exited."""
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            info('- Background saving terminated with success')
+            self.lastsave = int(time.time())
+            self.dirty_lastsave = self.dirty_before_bgsave
+            self.lastbgsave_status = 1
+        else:
+            wain('# Background saving error')
+            self.lastbgsave_status = 0
+        self.bgsaveinprogress = 0
+        self.bgsavechildpid = -1
+        self.updateSlavesWaitingBgsave(self.lastbgsave_status)
+
+    def loadDb(self, filepath):
+        """Replace the content of the dbs with the dump file."""
+        with open(filepath, 'rb') as f:
+            dicts = pickle.load(f)
+        self.emptyDb(-1, self.lazyfree_lazy_server_del)
+        for i in range(self.dbnum):
+            self.dicts[i].update(dicts[i])
+
+    def lookupKeyRead(self, client, key):
+        """Return the value of key in the db of client, None if it
+        does not exist. The lookup counts as a keyspace hit or miss.
+        """
+        val = client.dict_.get(key)
+        if val is None:
+            self.stat_keyspace_misses += 1
+        else:
+            self.stat_keyspace_hits += 1
+        return val
+
+    def dbDelete(self, dictid, key, lazy):
+        """Delete key from the db.
+
+        :param lazy: a large value is freed by the lazy free thread.
+
+        Returns:
+            1 if key is deleted, 0 if key does not exist.
+        """
+        val = self.dicts[dictid].pop(key, None)
+        if val is None:
+            return 0
+        if lazy:
+            self.freeObjectAsync(val)
+        return 1
+
+    def freeObjectAsync(self, val):
+        """Free val in the lazy free thread if it is large, the caller
+        must drop its references to val.
+        """
+        if freeEffort(val) > self.lazyfree_threshold:
+            self.lazyfree.free(val)
+
+    def emptyDb(self, dictid, lazy):
+        """Remove all the keys of db, -1 means all dbs.
+
+        :param lazy: replace the db with an empty one at once, and
+                     free the old one in the lazy free thread.
+        """
+        self.signalFlushedDb(dictid)
+        for i in (range(self.dbnum) if dictid == -1 else [dictid]):
+            if lazy and len(self.dicts[i]) > self.lazyfree_threshold:
+                old, self.dicts[i] = self.dicts[i], self.createDict()
+                self.lazyfree.free(old)
+                del(old)
+            else:
+                self.dicts[i].clear()
+
+    def alsoPropagate(self, dictid, argv):
+        """Propagate argv to the replicas after the current command."""
+        self.also_propagate.append((dictid, argv))
+
+    def replicationFeedSlaves(self, dictid, argv):
+        """Append the command to the replication stream, that is the
+        backlog and the replicas.
+
+        :param dictid: db the command was executed in, -1 if the
+                       command is not related to a db.
+        :param argv: the command.
+        """
+        if self.repl_backlog is None:
+            return
+
+        buf = ''
+        if dictid != -1 and dictid != self.slaveseldb:
+            buf = multibulk(['select', str(dictid)])
+            self.slaveseldb = dictid
+        buf += multibulk(argv)
+
+        self.repl_backlog.feed(buf)
+        self.master_repl_offset += len(buf)
+
+        for node in self.slaves:
+            slave = node.val
+            if slave.replstate == SLAVE_STATE_ONLINE:
+                self.addReply(slave, buf)
+            elif slave.replstate != SLAVE_STATE_WAIT_BGSAVE_START:
+                slave.replpending.append(buf)
+
+    def syncWithSlave(self, client, replid, offset):
+        """Start to replicate to the client.
+
+        If the client replicated this stream before and the backlog
+        still has the data since its offset, it continues from there
+        (partial resync), else it loads a snapshot first (full resync).
+
+        :param replid: replication id the replica has.
+        :param offset: replication offset the replica has.
+        """
+        client.flag |= CLIENT_SLAVE
+        client.slavenode = self.slaves.addNodeTail(client)
+        if self.repl_backlog is None:
+            self.repl_backlog = Backlog(self.repl_backlog_size)
+            self.slaveseldb = -1
+
+        if replid == self.replid and \
+           self.master_repl_offset - len(self.repl_backlog) <= offset and \
+           offset <= self.master_repl_offset:
+            client.replstate = SLAVE_STATE_ONLINE
+            self.stat_sync_partial_ok += 1
+            self.addReply(client, '+CONTINUE\r\n')
+            if offset < self.master_repl_offset:
+                self.addReply(client, self.repl_backlog.read(
+                    self.master_repl_offset - offset))
+            info('- Partial resynchronization accepted, sending {} bytes '
+                 'of backlog'.format(self.master_repl_offset - offset))
+            return
+
+        info('- Full resynchronization requested by replica')
+        self.stat_sync_full += 1
+        client.replstate = SLAVE_STATE_WAIT_BGSAVE_START
+        if not self.bgsaveinprogress:
+            self.startBgsaveForReplication()
+
+    def startBgsaveForReplication(self):
+        """Start a snapshot for the replicas waiting for it."""
+        waiting = [node.val for node in self.slaves
+                   if node.val.replstate == SLAVE_STATE_WAIT_BGSAVE_START]
+
+        if self.saveDbBackground(self.dbfilename) == -1:
+            for slave in waiting:
+                self.freeClient(slave)
+            return
+
+        # The stream after the fork starts with a SELECT.
+        self.slaveseldb = -1
+        for slave in waiting:
+            slave.replstate = SLAVE_STATE_WAIT_BGSAVE_END
+            slave.replpending = []
+            self.addReply(slave, '+FULLRESYNC {} {}\r\n'.format(
+                self.replid, self.master_repl_offset))
+
+    def updateSlavesWaitingBgsave(self, ok):
+        """Called when a background saving terminated, send the
+        snapshot to the replicas waiting for it.
+
+        :param ok: the saving succeeded.
+        """
+        startbgsave = 0
+        for slave in [node.val for node in self.slaves]:
+            if slave.replstate == SLAVE_STATE_WAIT_BGSAVE_START:
+                startbgsave = 1
+            elif slave.replstate == SLAVE_STATE_WAIT_BGSAVE_END:
+                if not ok:
+                    wain('# SYNC failed, BGSAVE child returned an error')
+                    self.freeClient(slave)
+                    continue
+                slave.repldbfd = open(self._dbFilepath(), 'rb')
+                slave.repldbsize = os.fstat(slave.repldbfd.fileno()).st_size
+                slave.repldboff = 0
+                slave.replstate = SLAVE_STATE_SEND_BULK
+                # The bulk length follows +FULLRESYNC in the replies,
+                # sendBulkToSlave writes them before the snapshot.
+                self.addReply(slave, '${}\r\n'.format(slave.repldbsize))
+                self.el.deleteFileEvent(slave.cobj, event.WRITABLE)
+                self.el.createFileEvent(slave.cobj, event.WRITABLE,
+                                        self.sendBulkToSlave, slave)
+
+        if startbgsave:
+            self.startBgsaveForReplication()
+
+    def sendBulkToSlave(self, cobj, slave):
+        """Send the snapshot to the replica by chunks without blocking,
+        the replication stream buffered meanwhile follows it. What the
+        socket can't take is sent from repldboff on the next event.
+        """
+        if slave.reply.length:
+            data = tobytes(slave.reply.head.val)
+        else:
+            slave.repldbfd.seek(slave.repldboff)
+            data = slave.repldbfd.read(IOBUF_LEN)
+        try:
+            nwritten = cobj.send(data, MSG_DONTWAIT) if data else 0
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            wain('# Write error sending DB to replica: {}'.format(e))
+            self.freeClient(slave)
+            return
+
+        if slave.reply.length:
+            slave.reply_bytes -= nwritten
+            node = slave.reply.head
+            if nwritten < len(data):
+                node.val = node.val[nwritten:]
+            else:
+                slave.reply.delNode(node)
+            return
+
+        slave.repldboff += nwritten
+        if data and slave.repldboff < slave.repldbsize:
+            return
+
+        slave.repldbfd.close()
+        slave.repldbfd = None
         self.el.deleteFileEvent(cobj, event.WRITABLE)
-        cobj.close()
-        server.stat_numconnections -= 1
+        slave.replstate = SLAVE_STATE_ONLINE
+        for buf in slave.replpending:
+            self.addReply(slave, buf)
+        slave.replpending = []
+        info('- Synchronization with replica succeeded')
+
+    def replicationSetMaster(self, host, port):
+        """Replicate the master at host:port."""
+        self.replicationDropMaster()
+        # Chained replication is not supported.
+        for slave in [node.val for node in self.slaves]:
+            self.freeClient(slave)
+        self.repl_backlog = None
+        self.masterhost, self.masterport = host, port
+        self.repl_state = REPL_STATE_CONNECT
+
+    def replicationUnsetMaster(self):
+        """Stop replicating and start a new replication history."""
+        if self.masterhost is None:
+            return
+        self.replicationDropMaster()
+        self.masterhost = self.masterport = None
+        self.repl_state = REPL_STATE_NONE
+        self.replid = _randomReplid()
+        self.repl_backlog = None
+        info('- MASTER MODE enabled')
+
+    def replicationDropMaster(self):
+        """Close the connection with the master, if any."""
+        if self.master is not None:
+            self.freeClient(self.master)
+        self.replicationAbortSyncTransfer()
+
+    def replicationHandleMasterDisconnection(self, client):
+        """Called when the master client is freed, the replication id
+        and offset are kept to continue from there on reconnection.
+        """
+        wain('# Connection with MASTER lost')
+        self.master = None
+        self.master_dictid = client.dictid
+        self.repl_state = REPL_STATE_CONNECT
+
+    def replicationAbortSyncTransfer(self):
+        if self.repl_transfer_s is None:
+            return
+        self.el.deleteFileEvent(self.repl_transfer_s, event.READABLE)
+        self.repl_transfer_s.close()
+        self.repl_transfer_s = None
+        if self.repl_transfer_fd is not None:
+            self.repl_transfer_fd.close()
+            self.repl_transfer_fd = None
+            os.unlink(self.repl_transfer_tmpfile)
+        self.repl_state = REPL_STATE_CONNECT
+
+    def replicationSendAck(self):
+        """Send the processed offset to the master."""
+        try:
+            self.master.cobj.sendall(tobytes(multibulk(
+                ['replconf', 'ack', str(self.master_repl_offset)])))
+        except socket.error as e:
+            wain('# Error sending ACK to MASTER: {}'.format(e))
+
+    def replicationAckFromSlave(self, client, offset):
+        """Called when the replica acknowledged offset, the clients
+        waiting for it are unblocked.
+        """
+        client.repl_ack_time = time.time()
+        if offset <= client.repl_ack_off:
+            return
+        client.repl_ack_off = offset
+
+        for node in list(self.clients_waiting_acks):
+            waiter = node.val
+            acks = self.replicationCountAcksByOffset(waiter.bwait_offset)
+            if acks >= waiter.bwait_numreplicas:
+                self.unblockClient(waiter)
+                self.addReplyLongLong(waiter, acks)
+
+    def replicationCountAcksByOffset(self, offset):
+        """Return the number of replicas acknowledged offset."""
+        return sum(1 for node in self.slaves
+                   if node.val.replstate == SLAVE_STATE_ONLINE and
+                   node.val.repl_ack_off >= offset)
+
+    def replicationCron(self):
+        """Called by serverCron every second."""
+        if self.repl_state == REPL_STATE_CONNECT:
+            self.connectWithMaster()
+
+        # Replicas acknowledge the offset every second, this is how
+        # the master knows their lag.
+        if self.repl_state == REPL_STATE_CONNECTED:
+            self.replicationSendAck()
+
+        # Replicas asked for a snapshot while a BGSAVE was in progress.
+        if not self.bgsaveinprogress:
+            for node in self.slaves:
+                if node.val.replstate == SLAVE_STATE_WAIT_BGSAVE_START:
+                    self.startBgsaveForReplication()
+                    break
+
+    def connectWithMaster(self):
+        """Connect to the master and ask for the stream since the
+        replication id and offset of this server.
+        """
+        info('- Connecting to MASTER {}:{}'.format(self.masterhost,
+                                                  self.masterport))
+        try:
+            s = socket.create_connection((self.masterhost, self.masterport),
+                                         timeout=1)
+            s.settimeout(None)
+            s.sendall(tobytes(
+                'replconf listening-port {}\r\n'.format(self.port)))
+            s.sendall(tobytes('psync {} {}\r\n'.format(
+                self.replid, self.master_repl_offset)))
+        except socket.error as e:
+            wain('# Unable to connect to MASTER: {}'.format(e))
+            return
+
+        self.repl_transfer_s = s
+        self.repl_transfer_buf = ''
+        self.repl_transfer_replid = None
+        self.repl_transfer_size = -1
+        self.repl_transfer_read = 0
+        self.el.createFileEvent(s, event.READABLE, self.readSyncHandler, None)
+        self.repl_state = REPL_STATE_TRANSFER
+
+    def readSyncHandler(self, s, clientData):
+        """Read the reply of PSYNC, and the snapshot for a full resync::
+
+            +CONTINUE\r\n<stream>
+            +FULLRESYNC <replid> <offset>\r\n$<size>\r\n<snapshot><stream>
+        """
+        try:
+            data = tostr(s.recv(IOBUF_LEN))
+        except socket.error:
+            data = ''
+        if not data:
+            wain('# Lost connection with MASTER during sync')
+            self.replicationAbortSyncTransfer()
+            return
+        self.master_lastinteraction = time.time()
+
+        if self.repl_transfer_size == -1:
+            buf = self.repl_transfer_buf + data
+            while self.repl_transfer_size == -1:
+                newline = buf.find('\n')
+                if newline == -1:
+                    self.repl_transfer_buf = buf
+                    return
+                line = buf[:newline].rstrip('\r')
+                buf = buf[newline + 1:]
+
+                if line == '+OK':
+                    # Reply of REPLCONF
+                    continue
+                elif line == '+CONTINUE':
+                    info('- Partial resynchronization with MASTER accepted')
+                    self.replicationCreateMasterClient(buf)
+                    return
+                elif line.startswith('+FULLRESYNC '):
+                    _, replid, offset = line.split()
+                    self.repl_transfer_replid = replid
+                    self.repl_transfer_offset = int(offset)
+                elif line.startswith('$') and self.repl_transfer_replid:
+                    self.repl_transfer_size = int(line[1:])
+                    self.repl_transfer_tmpfile = '{}.{}.sync'.format(
+                        self._dbFilepath(), os.getpid())
+                    self.repl_transfer_fd = open(
+                        self.repl_transfer_tmpfile, 'wb')
+                elif line:
+                    wain('# Unexpected reply from MASTER: {}'.format(line))
+                    self.replicationAbortSyncTransfer()
+                    return
+            self.repl_transfer_buf = ''
+            data = buf
+
+        need = self.repl_transfer_size - self.repl_transfer_read
+        self.repl_transfer_fd.write(tobytes(data[:need]))
+        self.repl_transfer_read += len(data[:need])
+        if self.repl_transfer_read < self.repl_transfer_size:
+            return
+
+        self.repl_transfer_fd.close()
+        self.repl_transfer_fd = None
+        os.rename(self.repl_transfer_tmpfile, self._dbFilepath())
+        self.loadDb(self._dbFilepath())
+        self.replid = self.repl_transfer_replid
+        self.master_repl_offset = self.repl_transfer_offset
+        self.master_dictid = 0
+        info('- MASTER <-> REPLICA sync: Finished with success')
+        self.replicationCreateMasterClient(data[need:])
+
+    def replicationCreateMasterClient(self, querybuf):
+        """Turn the sync connection into the client of the master, the
+        commands it sends are executed like others.
+
+        :param querybuf: stream already read.
+        """
+        s = self.repl_transfer_s
+        self.el.deleteFileEvent(s, event.READABLE)
+        self.repl_transfer_s = None
+
+        client = self.createClient(s)
+        client.flag |= CLIENT_MASTER
+        client.dictid = self.master_dictid
+        client.querybuf = querybuf
+        self.stat_numconnections += 1
+        self.master = client
+        self.repl_state = REPL_STATE_CONNECTED
+        parseQueryBuffer(client)
+        self.processInputBuffer(client)
 
     @classmethod
     def lookup_command(self, cmd):
-        """Look up given cmd.
+        """Look up given cmd, case insensitively.
 
         Returns:
             (found, cmd)
         """
         try:
-            return (1, self.commands[cmd])
+            return (1, self.commands_lookup[cmd])
+        except KeyError:
+            pass
+        try:
+            return (1, self.commands[cmd.lower()])
         except KeyError:
             return (0, None)
 
@@ -253,21 +2141,113 @@ class PedisServer(object):
 
         :param client: pedis client object.
         """
-        if client.argv[0] == 'quit':
-            self.freeClient(client.cobj)
-            return
-
         found, cmd = self.lookup_command(client.argv[0])
 
         if not found:
+            if client.argv[0].lower() == 'quit':
+                self.freeClient(client)
+                return
+            self.flagTransaction(client)
             self.addReply(client, '-ERR unknown command\r\n')
             return
 
-        if client.argc != cmd.arity:
+        # Only pub/sub commands are allowed in the context of pub/sub.
+        if (client.pubsub_channels or client.pubsub_patterns) and \
+           cmd.name not in PUBSUB_CONTEXT_COMMANDS:
+            self.addReply(client, '-ERR only (P)SUBSCRIBE / (P)UNSUBSCRIBE '
+                                  '/ PING / QUIT allowed in this context\r\n')
+            return
+
+        if (cmd.arity > 0 and client.argc != cmd.arity) or \
+           (client.argc < -cmd.arity):
+            self.flagTransaction(client)
             self.addReply(client, '-ERR wrong number of arguments\r\n')
             return
 
+        # The keys served by other nodes are redirected to them.
+        if server.cluster is not None and \
+           not client.flag & CLIENT_MASTER and \
+           server.clusterRedirect(client, cmd):
+            self.flagTransaction(client)
+            return
+
+        # Only the master writes to a read only replica.
+        if server.masterhost and server.slave_read_only and \
+           cmd.flags & CMD_WRITE and not client.flag & CLIENT_MASTER:
+            self.flagTransaction(client)
+            self.addReply(client, '-READONLY You can\'t write against a '
+                                  'read only replica.\r\n')
+            return
+
+        if client.flag & CLIENT_MULTI and \
+           cmd.name not in MULTI_CONTEXT_COMMANDS:
+            client.mstate.append((cmd, client.argv))
+            self.addReply(client, shared.queued)
+            return
+
+        self.call(client, cmd)
+
+    @classmethod
+    def flagTransaction(self, client):
+        """Make the EXEC of client fail, a command of its transaction
+        was refused.
+        """
+        if client.flag & CLIENT_MULTI:
+            client.flag |= CLIENT_DIRTY_EXEC
+
+    @classmethod
+    def call(self, client, cmd):
+        """Execute the command proc with client's argv, and propagate
+        it to the replicas if it changed the keyspace.
+
+        :param client: pedis client object.
+        :param cmd: command to execute.
+        """
+        sampled = 0
+        if server.hotkeys.rate and cmd.firstkey:
+            sampled = server.hotkeys.sample()
+            tail = client.reply.tail
+
+        if server.monitors.length:
+            server.feedMonitors(client, client.argv)
+
+        client.lastcmd = cmd.name
+        dirty = server.dirty
+        start = perf_counter()
         cmd.proc(client)
+        usec = int((perf_counter() - start) * 1000000)
+        cmd.stats.record(usec)
+        if 0 <= server.slowlog_log_slower_than <= usec:
+            server.slowlog.push(client.argv, usec, client.addr)
+        dirty = server.dirty - dirty
+
+        if sampled:
+            server.hotkeys.record(
+                client.dictid, server.getKeysFromCommand(cmd, client.argv),
+                cmd.name, replySize(client.reply, tail))
+        server.stat_numcommands += 1
+
+        if dirty and server.notify_keyspace_events and \
+           not cmd.flags & CMD_NOPROPAGATE:
+            server.notifyKeyspaceEvent(
+                cmd.name, server.getKeysFromCommand(cmd, client.argv),
+                client.dictid)
+
+        # The master client propagates nothing, chained replication is
+        # not supported.
+        if client.flag & CLIENT_MASTER:
+            server.also_propagate = []
+            return
+
+        if dirty and not cmd.flags & CMD_NOPROPAGATE:
+            server.replicationFeedSlaves(client.dictid, client.argv)
+
+        also_propagate, server.also_propagate = server.also_propagate, []
+        for dictid, argv in also_propagate:
+            server.replicationFeedSlaves(dictid, argv)
+
+        if dirty:
+            client.woff = server.master_repl_offset
 
     @classmethod
     def readQueryFromClient(self, cobj, client):
@@ -276,17 +2256,66 @@ class PedisServer(object):
         :param cobj: client connect object.
         :param client: pedis client object.
         """
-        data = cobj.recv(1024)
+        # With io threads, the read is done in beforeSleep.
+        if server.io_threads > 1:
+            server.clients_pending_read.append(client)
+            return
 
-        if len(data) == 0:
-            self.freeClient(cobj)
+        nread = server.readAndParseQuery(client)
+        if not nread:
+            self.freeClient(client)
             debug('. Client closed connection')
             return
+        server.stat_net_input_bytes += nread
+        server.touchClient(client)
 
-        query = data.split()
-        client.argc = len(query)
-        client.argv = query
-        self.processCommand(client)
+        if client.flag & CLIENT_MASTER:
+            server.master_lastinteraction = time.time()
+        self.processInputBuffer(client)
+
+    def readAndParseQuery(self, client):
+        """Read from the client and parse the complete commands, only
+        the client is touched, io threads call it in parallel.
+
+        Returns:
+            number of bytes read, 0 if the connection is closed.
+        """
+        try:
+            data = client.cobj.recv(IOBUF_LEN)
+        except socket.error:
+            data = b''
+
+        if data:
+            client.querybuf += tostr(data)
+            parseQueryBuffer(client)
+        return len(data)
+
+    @classmethod
+    def processInputBuffer(self, client):
+        """Execute the commands parsed from querybuf.
+
+        :param client: pedis client object.
+        """
+        while client.pending:
+            # Commands of a blocked client wait until it is unblocked.
+            if client.flag & (CLIENT_BLOCKED | CLIENT_CLOSED):
+                return
+
+            argv, nbytes, error = client.pending.popleft()
+            if client.flag & CLIENT_MASTER:
+                server.master_repl_offset += nbytes
+            if error is not None:
+                self.addReply(client, error)
+                continue
+
+            client.argc = len(argv)
+            client.argv = argv
+            self.processCommand(client)
+
+        if client.protoerror is not None and \
+           not client.flag & CLIENT_CLOSED:
+            self.addReply(client, client.protoerror)
+            self.freeClient(client)
 
     @classmethod
     def addReply(self, client, what):
@@ -295,24 +2324,254 @@ class PedisServer(object):
         :param client: pedis client object.
         :param what: content to send to the client.
         """
-        self.el.createFileEvent(client.cobj,
-                                event.WRITABLE,
-                                self.sendReplyToClient, client)
+        # Replies to the master are discarded.
+        if client.flag & (CLIENT_CLOSED | CLIENT_MASTER | CLIENT_CLOSE_ASAP):
+            return
+        if client.flag & CLIENT_NATIVE:
+            client.reply.addNodeTail(nativeReply(what))
+            return
+        if client.reply.length == 0:
+            # With io threads or the asyncio frontend, the replies are
+            # written in beforeSleep.
+            if server.io_threads > 1 or server.frontend != FRONTEND_PEDIS:
+                server.clients_pending_write.append(client)
+            else:
+                self.el.createFileEvent(client.cobj,
+                                        event.WRITABLE,
+                                        self.sendReplyToClient, client)
         client.reply.addNodeTail(what)
+        client.reply_bytes += len(what)
+        if server.client_obuf_limit_min and \
+           client.reply_bytes >= server.client_obuf_limit_min:
+            server.checkClientOutputBufferLimits(client)
+
+    @classmethod
+    def addReplyFrame(self, client, frame, items):
+        """Add a multibulk reply encoded once for many clients.
+
+        :param frame: items encoded by multibulk.
+        :param items: values sent to the native clients.
+        """
+        if client.flag & CLIENT_NATIVE:
+            client.reply.addNodeTail(list(items))
+            return
+        self.addReply(client, frame)
+
+    @classmethod
+    def addReplyBulk(self, client, val):
+        """Add a bulk reply.
+
+        :param client: pedis client object.
+        :param val: string value to send.
+        """
+        if client.flag & CLIENT_NATIVE:
+            client.reply.addNodeTail(val)
+            return
+        self.addReply(client, '${}\r\n{}\r\n'.format(len(val), val))
+
+    @classmethod
+    def addReplyLongLong(self, client, n):
+        """Add an integer reply.
+
+        :param client: pedis client object.
+        :param n: integer to send.
+        """
+        if client.flag & CLIENT_NATIVE:
+            client.reply.addNodeTail(n)
+            return
+        self.addReply(client, '{}\r\n'.format(n))
+
+    @classmethod
+    def addReplyMultiBulk(self, client, items):
+        """Add a multibulk reply, encoded as a single reply node.
+
+        :param client: pedis client object.
+        :param items: values to send, `None` is sent as a nil bulk.
+        """
+        if client.flag & CLIENT_NATIVE:
+            client.reply.addNodeTail(list(items))
+            return
+        self.addReply(client, multibulk(items))
+
+    def trackInstantaneousMetric(self, metric, current):
+        """Sample the rate per second of a counter, called by
+        serverCron.
+
+        :param current: current value of the counter.
+        """
+        m = self.inst_metrics[metric]
+        now = time.time()
+        if now > m[0]:
+            m[2].append((current - m[1]) / (now - m[0]))
+        m[0], m[1] = now, current
+
+    def getInstantaneousMetric(self, metric):
+        """Return the average rate per second of the samples."""
+        samples = self.inst_metrics[metric][2]
+        if not samples:
+            return 0
+        return sum(samples) / len(samples)
 
     def run(self):
         """Run server to accept connection."""
+        self.adjustOpenFilesLimit()
+
+        if self.frontend != FRONTEND_PEDIS:
+            self.runAsyncio()
+            return
+
+        if self.workers:
+            self.runWorkers()
+            return
+
+        self._initIOThreads()
+
+        self.sobj = self._tcpServer()
         self.el.createFileEvent(self.sobj,
                                 event.READABLE,
                                 self.accept, None)
+        if self.metrics_port:
+            self._initMetrics(self.metrics_port)
         info('- The server is now ready to accept connections.')
         self.el.main()
 
+    def runAsyncio(self):
+        """Serve the clients with an asyncio eventloop, see `pedis.aio`.
+
+        The replies are written by the loop thread, the io threads and
+        the workers are not used. Replication needs the pedis eventloop.
+        """
+        try:
+            from .aio import AsyncioFrontend, newEventLoop
+        except ImportError as e:
+            critical('* The {} frontend is not available: {}'.format(
+                self.frontend, e))
+            sys.exit(1)
+
+        if self.workers or self.io_threads > 1:
+            wain('# Workers and io threads are not supported with the '
+                 '{} frontend, they are ignored'.format(self.frontend))
+            self.workers = 0
+            self.io_threads = 1
+
+        if self.masterhost is not None:
+            wain('# Replication is not supported with the {} frontend, '
+                 'slaveof is ignored'.format(self.frontend))
+            self.masterhost = self.masterport = None
+            self.repl_state = REPL_STATE_NONE
+
+        if self.metrics_port:
+            wain('# The metrics are not served with the {} frontend, '
+                 'metrics-port is ignored'.format(self.frontend))
+
+        self.sobj = self._tcpServer()
+        frontend = AsyncioFrontend(newEventLoop(self.frontend))
+        info('- The server is now ready to accept connections '
+             'on {}.'.format(frontend))
+        frontend.run()
+
+    def runWorkers(self):
+        """Serve with `workers` processes, every worker has its own
+        eventloop and dbs, and serves an even range of the hash slots.
+
+        The workers accept on the shared port, the kernel balances the
+        connections among them. Worker i also accepts on port + 1 + i,
+        the address it is named by in the -MOVED redirects.
+        """
+        if self.masterhost is not None:
+            wain('# Replication is not supported with workers, '
+                 'slaveof is ignored')
+            self.masterhost = self.masterport = None
+            self.repl_state = REPL_STATE_NONE
+
+        # The workers are terminated when this process exits.
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+        procs = []
+        for i in range(self.workers):
+            proc = Process(target=self.runWorker, args=(i,))
+            proc.daemon = True
+            proc.start()
+            procs.append(proc)
+        info('- {} workers started'.format(self.workers))
+
+        for proc in procs:
+            proc.join()
+
+    def runWorker(self, worker_id):
+        """Run worker_id in the worker process."""
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        self.worker_id = worker_id
+        self.cluster = ClusterState(self.workerNode(worker_id))
+        for i in range(self.workers):
+            self.cluster.addSlots(self.workerNode(i),
+                                  i * CLUSTER_SLOTS // self.workers,
+                                  (i + 1) * CLUSTER_SLOTS // self.workers - 1)
+
+        # Every worker persists its own slots.
+        root, ext = os.path.splitext(self.dbfilename)
+        self.dbfilename = '{}-{}{}'.format(root, worker_id, ext)
+        if os.path.exists(self._dbFilepath()):
+            self.loadDb(self._dbFilepath())
+        # The dump loaded before the workers started holds the whole
+        # keyspace, keep the keys of the slots served here.
+        for d in self.dicts:
+            for key in [key for key in d if self.cluster.slots[
+                    keyHashSlot(key)] != self.cluster.myself]:
+                del d[key]
+        self.dicts = [self.createDict(dict_) for dict_ in self.dicts]
+
+        self._initIOThreads()
+
+        self.sobj = self._tcpServer()
+
+        #: socket object of the private address of the worker
+        self.worker_sobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.worker_sobj.setsockopt(socket.SOL_SOCKET,
+                                    socket.SO_REUSEADDR, 1)
+        self.worker_sobj.bind((self.host, self.port + 1 + worker_id))
+        self.worker_sobj.listen(32)
+        self.el.createFileEvent(self.worker_sobj,
+                                event.READABLE,
+                                self.accept, None)
+
+        self.el.createFileEvent(self.sobj,
+                                event.READABLE,
+                                self.accept, None)
+        if self.metrics_port:
+            self._initMetrics(self.metrics_port + worker_id)
+        info('- Worker {} is now ready to accept connections on port {} '
+             'and {}.'.format(worker_id, self.port, self.port + 1 + worker_id))
+        self.el.main()
+
+    def _initMetrics(self, port):
+        """Serve the metrics on port, see `pedis.metrics`."""
+        from .metrics import startMetricsServer
+        if startMetricsServer(port) is not None:
+            info('- Serving the metrics on port {}.'.format(port))
+
+    def _initIOThreads(self):
+        """Start the io threads, threads don't survive fork, they are
+        started in the process serving the clients.
+        """
+        if self.io_threads > 1:
+            self.io_pool = ThreadPool(self.io_threads)
+            info('- {} io threads started'.format(self.io_threads))
+
+    def workerNode(self, worker_id):
+        """Name of worker_id in the cluster, its private address."""
+        return '{}:{}'.format(self.host, self.port + 1 + worker_id)
+
 
+#: name: command name
 #: proc: command process function
-#: arity: number of arguments
+#: arity: number of arguments, negative means at least -arity arguments
 #: flags: command flags
-cmd = namedtuple('cmd', ['proc', 'arity', 'flags'])
+#: firstkey, lastkey, keystep: positions of the key arguments
+#: getkeys: function returning the key arguments, or None
+#: stats: calls and latencies, pedis.latency.CommandStats
+cmd = namedtuple('cmd', ['name', 'proc', 'arity', 'flags', 'firstkey',
+                         'lastkey', 'keystep', 'getkeys', 'stats'])
 server = PedisServer()
 logging.basicConfig(level=server.verbosity,
                     filename=server.logfile, format='%(message)s')
@@ -6,13 +6,38 @@ pedis.utils
 
 """
 
+import os
+import re
+import sys
+import shlex
+from ._compat import integer_types
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class ReplyError(Exception):
+    """Error reply of a command, returned to the native clients."""
+
+
+class StatusReply(str):
+    """Status reply of a command, returned to the native clients, a
+    str telling the status replies from the bulk strings.
+    """
+
 
 class SharedObjects(object):
     crlf = '\r\n'
     ok = '+OK\r\n'
     err = '-ERR\r\n'
     nil = 'nil\r\n'
+    nullbulk = '$-1\r\n'
+    nullmultibulk = '*-1\r\n'
     pong = '+PONG\r\n'
+    queued = '+QUEUED\r\n'
+    syntaxerr = '-ERR syntax error\r\n'
     one = '1\r\n'
     zero = '0\r\n'
     select0 = 'select 0\r\n'
@@ -27,6 +52,218 @@ class SharedObjects(object):
     select8 = 'select 9\r\n'
     wrongtypeerr = ("-ERR Operation against a key"
                     "holding the wrong kind of val\r\n")
+    execaborterr = ("-EXECABORT Transaction discarded because of "
+                    "previous errors.\r\n")
 
 
 shared = SharedObjects()
+
+#: Python values of the shared replies, for the native clients
+nativeShared = {
+    shared.ok: StatusReply('OK'),
+    shared.pong: StatusReply('PONG'),
+    shared.queued: StatusReply('QUEUED'),
+    shared.one: 1,
+    shared.zero: 0,
+    shared.nil: None,
+    shared.nullbulk: None,
+    shared.nullmultibulk: None,
+}
+
+
+def nativeReply(what):
+    """Decode a status, error or shared reply to Python value."""
+    if what in nativeShared:
+        return nativeShared[what]
+    if what.startswith('-'):
+        return ReplyError(what[1:].rstrip('\r\n'))
+    if what.startswith('+'):
+        return StatusReply(what[1:].rstrip('\r\n'))
+    raise ValueError('Not a native reply: {!r}'.format(what))
+
+
+def splitArgs(line):
+    """Split an inline command line to arguments, arguments can be
+    quoted to contain spaces.
+
+    Raises:
+        ValueError: unbalanced quotes.
+    """
+    if '"' not in line and "'" not in line:
+        return line.split()
+    return shlex.split(line)
+
+
+def multibulk(items):
+    """Encode items as a multibulk reply, `None` is encoded as a nil
+    bulk, integers as integer replies and lists as nested multibulks.
+    """
+    rv = ['*{}\r\n'.format(len(items))]
+    for item in items:
+        if item is None:
+            rv.append(shared.nullbulk)
+        elif isinstance(item, integer_types):
+            rv.append(':{}\r\n'.format(item))
+        elif isinstance(item, (list, tuple)):
+            rv.append(multibulk(item))
+        else:
+            rv.append('${}\r\n{}\r\n'.format(len(item), item))
+    return ''.join(rv)
+
+
+def bytesToHuman(n):
+    """Format a number of bytes for humans.
+
+    >>> bytesToHuman(1000)
+    '1000B'
+    >>> bytesToHuman(3 * 1024 * 1024 // 2)
+    '1.50M'
+    """
+    for unit in ('B', 'K', 'M', 'G'):
+        if n < 1024 or unit == 'G':
+            break
+        n /= 1024.0
+    if unit == 'B':
+        return '{}B'.format(n)
+    return '{:.2f}{}'.format(n, unit)
+
+
+def parseMemory(val):
+    """Parse a number of bytes of the config, with an optional unit.
+
+    >>> parseMemory('32mb')
+    33554432
+    >>> parseMemory('1gb') == 1024 ** 3
+    True
+    >>> parseMemory('100')
+    100
+    """
+    val = val.lower()
+    for unit, mul in (('kb', 1024), ('mb', 1024 ** 2), ('gb', 1024 ** 3),
+                      ('k', 1000), ('m', 1000 ** 2), ('g', 1000 ** 3)):
+        if val.endswith(unit):
+            return int(val[:-len(unit)]) * mul
+    return int(val)
+
+
+#: Escapes of the characters quoted by reprArg
+_REPR_ESCAPES = {'\\': '\\\\', '"': '\\"', '\n': '\\n', '\r': '\\r',
+                 '\t': '\\t', '\a': '\\a', '\b': '\\b'}
+
+#: Characters of the arguments which can't be quoted as is
+_REPR_UNSAFE = re.compile(r'[^ !#-\[\]-~]')
+
+
+def reprArg(arg):
+    """Quote an argument, the unprintable characters are escaped.
+
+    >>> print(reprArg('say "hi"\\n'))
+    "say \\"hi\\"\\n"
+    >>> print(reprArg('\\x00'))
+    "\\x00"
+    """
+    if _REPR_UNSAFE.search(arg) is None:
+        return '"' + arg + '"'
+
+    rv = ['"']
+    for ch in arg:
+        if ch in _REPR_ESCAPES:
+            rv.append(_REPR_ESCAPES[ch])
+        elif ' ' <= ch <= '~':
+            rv.append(ch)
+        else:
+            rv.append('\\x{:02x}'.format(ord(ch)))
+    rv.append('"')
+    return ''.join(rv)
+
+
+def memoryRss():
+    """Resident set size of the process in bytes, 0 if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def memoryPeak():
+    """Peak resident set size of the process in bytes, 0 if unknown."""
+    if resource is None:
+        return 0
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on the others.
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def raiseOpenFilesLimit(wanted):
+    """Raise the soft limit of open files to wanted, or as close to it
+    as the hard limit allows.
+
+    Returns:
+        the soft limit, up to wanted, None if it is unknown.
+    """
+    if resource is None:
+        return None
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return wanted
+    if hard == resource.RLIM_INFINITY or hard >= wanted:
+        attempts = [(wanted, hard)]
+    else:
+        # Raising the hard limit needs privileges.
+        attempts = [(wanted, wanted), (hard, hard)]
+    for limits in attempts:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, limits)
+        except (ValueError, OSError):
+            continue
+        return limits[0]
+    return soft
+
+
+#: Type prefixes of the serialized values
+_VALUE_TYPES = {str: 's', list: 'l', set: 'S'}
+
+
+def dumpValue(val):
+    """Serialize a value for DUMP and RESTORE, a str is kept as is, the
+    elements of a list or set are encoded as `<length>:<element>`.
+
+    >>> dumpValue(['a', 'bc'])
+    'l1:a2:bc'
+    """
+    prefix = _VALUE_TYPES[type(val)]
+    if prefix == 's':
+        return prefix + val
+    return prefix + ''.join('{}:{}'.format(len(x), x) for x in val)
+
+
+def loadValue(payload):
+    """Deserialize a value serialized by dumpValue.
+
+    >>> loadValue('l1:a2:bc')
+    ['a', 'bc']
+    >>> loadValue('sabc')
+    'abc'
+
+    Raises:
+        ValueError: payload is not a serialized value.
+    """
+    prefix, data = payload[:1], payload[1:]
+    if prefix == 's':
+        return data
+
+    if prefix not in ('l', 'S'):
+        raise ValueError('Bad value type')
+
+    items = []
+    pos = 0
+    while pos < len(data):
+        colon = data.index(':', pos)
+        length = int(data[pos:colon])
+        items.append(data[colon + 1:colon + 1 + length])
+        pos = colon + 1 + length
+    if pos != len(data):
+        raise ValueError('Bad value length')
+
+    return items if prefix == 'l' else set(items)
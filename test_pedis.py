@@ -6,14 +6,26 @@ pedis.test_pedis
 some tests.
 """
 
+import os
+import sys
+import json
+import time
+import shutil
 import socket
-from nose.tools import ok_
+import hashlib
+import tempfile
+import subprocess
+from unittest import SkipTest
+from nose.tools import ok_, eq_, assert_raises
+from pedis import Embedded, ReplyError
+from pedis.server import server
 
 
 s = None
 
 
 def setUp():
+    global s
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
 
@@ -21,5 +33,1125 @@ def tearDown():
     s.close()
 
 
+def _freePort(count=1):
+    """Return a port free with the count - 1 ports after it."""
+    while True:
+        sobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sobj.bind(('127.0.0.1', 0))
+        port = sobj.getsockname()[1]
+        sobj.close()
+        if all(_canBind(port + i) for i in range(1, count)):
+            return port
+
+
+def _canBind(port):
+    sobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sobj.bind(('127.0.0.1', port))
+    except socket.error:
+        return False
+    finally:
+        sobj.close()
+    return True
+
+
+def _startServer(tmpdir, *directives):
+    """Start a server process with its db in tmpdir, returns the
+    process and its port.
+    """
+    # The workers listen on the ports after the shared one.
+    workers = [int(line.split()[1]) for line in directives
+               if line.startswith('workers ')]
+    port = _freePort(1 + sum(workers))
+    conf = os.path.join(tmpdir, '{}.conf'.format(port))
+    with open(conf, 'w') as f:
+        f.write('port {}\n'.format(port))
+        f.write('loglevel critical\n')
+        f.write('dbfilename {}\n'.format(
+            os.path.join(tmpdir, '{}.pdb'.format(port))))
+        for line in directives:
+            f.write(line.format(port=port) + '\n')
+
+    env = dict(os.environ, PEDIS_CONFIG_FILE=conf)
+    proc = subprocess.Popen([sys.executable, '-m', 'pedis'], env=env,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            return proc, port
+        except socket.error:
+            if proc.poll() is not None or time.time() > deadline:
+                proc.kill()
+                raise RuntimeError('Failed to start the server')
+            time.sleep(0.05)
+
+
+def _stopServer(proc, tmpdir):
+    proc.kill()
+    proc.wait()
+    shutil.rmtree(tmpdir)
+
+
+def _replyEnd(buf, pos=0):
+    """Return the end of the reply starting at pos in buf, -1 if it is
+    not complete.
+    """
+    end = buf.find('\r\n', pos)
+    if end == -1:
+        return -1
+    line, end = buf[pos:end], end + 2
+    if line[0] == '$' and int(line[1:]) >= 0:
+        end += int(line[1:]) + 2
+        return end if end <= len(buf) else -1
+    if line[0] == '*':
+        for i in range(max(int(line[1:]), 0)):
+            end = _replyEnd(buf, end)
+            if end == -1:
+                return -1
+    return end
+
+
+def _readReplies(sobj, count=1):
+    """Return the next count raw replies read from sobj."""
+    buf, end = '', 0
+    while count:
+        pos = _replyEnd(buf, end) if len(buf) > end else -1
+        if pos != -1:
+            end, count = pos, count - 1
+            continue
+        data = sobj.recv(4096)
+        if not data:
+            raise IOError('Server closed the connection')
+        buf += data.decode('latin-1')
+    return buf
+
+
+def _inline(sobj, line):
+    """Send an inline command line and return its raw reply."""
+    sobj.sendall((line + '\r\n').encode('latin-1'))
+    return _readReplies(sobj)
+
+
+def _query(*argv):
+    """Return the multibulk query of a command."""
+    query = ['*{}\r\n'.format(len(argv))]
+    for arg in argv:
+        query.append('${}\r\n{}\r\n'.format(len(arg), arg))
+    return ''.join(query)
+
+
+def _command(sobj, *argv):
+    """Send a command and return its raw reply."""
+    sobj.sendall(_query(*argv).encode('latin-1'))
+    return _readReplies(sobj)
+
+
+def _waitFor(func, timeout=10):
+    deadline = time.time() + timeout
+    while not func():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
 def test_add():
     print(s)
+
+
+def test_multi_key_commands():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        eq_(_command(c, 'mset', 'test:a', '1', 'test:b', '2'), '+OK\r\n')
+        eq_(_command(c, 'mget', 'test:a', 'test:b', 'test:nokey'),
+            '*3\r\n$1\r\n1\r\n$1\r\n2\r\n$-1\r\n')
+        # MSETNX sets nothing if one of the keys exists.
+        eq_(_command(c, 'msetnx', 'test:a', 'x', 'test:c', '3'), '0\r\n')
+        eq_(_command(c, 'exists', 'test:c'), '0\r\n')
+        eq_(_command(c, 'msetnx', 'test:c', '3', 'test:d', '4'), '1\r\n')
+        eq_(_command(c, 'exists', 'test:a', 'test:nokey', 'test:c'), '2\r\n')
+        ok_(_command(c, 'mset', 'test:a', '1', 'test:b').startswith('-ERR'))
+        eq_(_command(c, 'del', 'test:a', 'test:b', 'test:c', 'test:d',
+                     'test:nokey'), '4\r\n')
+        c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_blocking_pops():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        first = socket.create_connection(('127.0.0.1', port))
+        second = socket.create_connection(('127.0.0.1', port))
+        c = socket.create_connection(('127.0.0.1', port))
+        for sobj in (first, second, c):
+            sobj.settimeout(5)
+        # The commands sent after BLPOP wait for the client unblocked.
+        first.sendall(b'blpop test:q 0\r\nping\r\n')
+        time.sleep(0.1)
+        second.sendall(b'blpop test:q 0\r\n')
+        time.sleep(0.1)
+
+        # The blocked clients are served in FIFO order.
+        _command(c, 'rpush', 'test:q', 'x')
+        eq_(_readReplies(first, 2),
+            '*2\r\n$6\r\ntest:q\r\n$1\r\nx\r\n+PONG\r\n')
+        _command(c, 'rpush', 'test:q', 'y')
+        eq_(_readReplies(second), '*2\r\n$6\r\ntest:q\r\n$1\r\ny\r\n')
+        eq_(_command(c, 'exists', 'test:q'), '0\r\n')
+
+        start = time.time()
+        eq_(_command(first, 'brpop', 'test:empty', '1'), '*-1\r\n')
+        ok_(time.time() - start >= 0.9)
+
+        first.sendall(b'brpoplpush test:src test:dst 0\r\n')
+        time.sleep(0.1)
+        _command(c, 'lpush', 'test:src', 'v')
+        eq_(_readReplies(first), '$1\r\nv\r\n')
+        eq_(_command(c, 'blpop', 'test:dst', '0'),
+            '*2\r\n$8\r\ntest:dst\r\n$1\r\nv\r\n')
+        for sobj in (first, second, c):
+            sobj.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_pubsub():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        sub = socket.create_connection(('127.0.0.1', port))
+        pub = socket.create_connection(('127.0.0.1', port))
+        for sobj in (sub, pub):
+            sobj.settimeout(5)
+        sub.sendall(b'subscribe test:news test:sport\r\n')
+        eq_(_readReplies(sub, 2),
+            '*3\r\n$9\r\nsubscribe\r\n$9\r\ntest:news\r\n:1\r\n'
+            '*3\r\n$9\r\nsubscribe\r\n$10\r\ntest:sport\r\n:2\r\n')
+        eq_(_command(sub, 'psubscribe', 'test:n*'),
+            '*3\r\n$10\r\npsubscribe\r\n$7\r\ntest:n*\r\n:3\r\n')
+        ok_(_command(sub, 'get', 'test:k').startswith('-ERR'))
+
+        # A channel and a pattern subscription, the message is received
+        # twice.
+        eq_(_command(pub, 'publish', 'test:news', 'hi'), '2\r\n')
+        eq_(_command(pub, 'publish', 'test:other', 'x'), '0\r\n')
+        eq_(_readReplies(sub, 2),
+            '*3\r\n$7\r\nmessage\r\n$9\r\ntest:news\r\n$2\r\nhi\r\n'
+            '*4\r\n$8\r\npmessage\r\n$7\r\ntest:n*\r\n$9\r\ntest:news\r\n'
+            '$2\r\nhi\r\n')
+
+        sub.sendall(b'unsubscribe\r\n')
+        replies = _readReplies(sub, 2).split('*3\r\n')[1:]
+        eq_(sorted(reply.split('\r\n')[3] for reply in replies),
+            ['test:news', 'test:sport'])
+        eq_([reply.split('\r\n')[4] for reply in replies], [':2', ':1'])
+        eq_(_command(sub, 'punsubscribe'),
+            '*3\r\n$12\r\npunsubscribe\r\n$7\r\ntest:n*\r\n:0\r\n')
+        eq_(_command(pub, 'publish', 'test:news', 'bye'), '0\r\n')
+        eq_(_command(sub, 'ping'), '+PONG\r\n')
+        sub.close()
+        pub.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_multi_watch():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        db = socket.create_connection(('127.0.0.1', port))
+        other = socket.create_connection(('127.0.0.1', port))
+        _command(db, 'set', 'test:w', '1')
+
+        # A watched key modified by another client aborts EXEC.
+        eq_(_command(db, 'watch', 'test:w'), '+OK\r\n')
+        eq_(_command(db, 'multi'), '+OK\r\n')
+        eq_(_command(db, 'incr', 'test:w'), '+QUEUED\r\n')
+        _command(other, 'set', 'test:w', '5')
+        eq_(_command(db, 'exec'), '*-1\r\n')
+
+        _command(db, 'watch', 'test:w')
+        _command(db, 'multi')
+        _command(db, 'incr', 'test:w')
+        _command(db, 'mget', 'test:w')
+        eq_(_command(db, 'exec'), '*2\r\n6\r\n*1\r\n$1\r\n6\r\n')
+        # EXEC unwatches the keys.
+        _command(other, 'set', 'test:w', '1')
+        _command(db, 'multi')
+        _command(db, 'mget', 'test:w')
+        eq_(_command(db, 'exec'), '*1\r\n*1\r\n$1\r\n1\r\n')
+
+        eq_(_command(db, 'unwatch'), '+OK\r\n')
+        _command(db, 'watch', 'test:w')
+        _command(db, 'unwatch')
+        _command(other, 'set', 'test:w', '2')
+        _command(db, 'multi')
+        _command(db, 'mget', 'test:w')
+        eq_(_command(db, 'exec'), '*1\r\n*1\r\n$1\r\n2\r\n')
+
+        _command(db, 'multi')
+        ok_(_command(db, 'multi').startswith('-ERR'))
+        _command(db, 'set', 'test:d', '1')
+        eq_(_command(db, 'discard'), '+OK\r\n')
+        eq_(_command(db, 'exists', 'test:d'), '0\r\n')
+        ok_(_command(db, 'exec').startswith('-ERR'))
+
+        # A command refused while queued aborts the transaction.
+        _command(db, 'multi')
+        ok_(_command(db, 'nosuchcommand').startswith('-ERR'))
+        ok_(_command(db, 'set', 'test:d').startswith('-ERR'))
+        eq_(_command(db, 'set', 'test:d', '1'), '+QUEUED\r\n')
+        ok_(_command(db, 'exec').startswith('-EXECABORT'))
+        eq_(_command(db, 'exists', 'test:d'), '0\r\n')
+        ok_(_command(db, 'exec').startswith('-ERR'))
+        db.close()
+        other.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_exec_reply_bytes():
+    lsobj = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    lsobj.bind(('127.0.0.1', 0))
+    lsobj.listen(1)
+    peer = socket.create_connection(lsobj.getsockname())
+    c = server.createClient(lsobj.accept()[0])
+    try:
+        for argv in (['multi'], ['set', 'test:x', '1'], ['get', 'test:x'],
+                     ['exec']):
+            c.argv, c.argc = argv, len(argv)
+            server.processCommand(c)
+        # The frame merging the replies of EXEC is counted whole.
+        eq_(c.reply_bytes, sum(len(node.val) for node in c.reply))
+    finally:
+        server.freeClient(c)
+        peer.close()
+        lsobj.close()
+
+
+def test_scripts():
+    script = "call('incr', KEYS[0]) if int(ARGV[0]) > 0 else 0"
+    sha = hashlib.sha1(script.encode('latin-1')).hexdigest()
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        eq_(_inline(c, 'script load "{}"'.format(script)),
+            '$40\r\n{}\r\n'.format(sha))
+        eq_(_command(c, 'evalsha', sha, '1', 'test:sc', '1'), '1\r\n')
+        eq_(_inline(c, 'eval "{}" 1 test:sc 1'.format(script)), '2\r\n')
+        eq_(_command(c, 'script', 'exists', sha, '0' * 40),
+            '*2\r\n:1\r\n:0\r\n')
+        ok_(_command(c, 'evalsha', '0' * 40, '0').startswith('-NOSCRIPT'))
+
+        for script in ("__import__('os')", "().__class__",
+                       "[x for x in ARGV]", "lambda: 1"):
+            ok_(_inline(c, 'eval "{}" 0'.format(script)).startswith('-ERR'))
+
+        # A status reply stays one, a repetition is limited.
+        eq_(_inline(c, """eval "call('set', KEYS[0], ARGV[0])" 1 test:sc v"""),
+            '+OK\r\n')
+        eq_(_inline(c, """eval "call('mget', KEYS[0])[0] * 2" 1 test:sc"""),
+            '$2\r\nvv\r\n')
+        ok_(_inline(c, """eval "len('x' * 1000000000)" 0""").startswith(
+            '-ERR'))
+
+        eq_(_command(c, 'script', 'flush'), '+OK\r\n')
+        eq_(_command(c, 'script', 'exists', sha), '*1\r\n:0\r\n')
+        c.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+    proc, port = _startServer(tmpdir, 'script-time-limit 0')
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        ok_(_inline(c, """eval "call('ping')" 0""").startswith('-ERR'))
+        ok_(_inline(c, """eval "'x' * 2" 0""").startswith('-ERR'))
+        c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_replication_loopback():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    master, mport = _startServer(tmpdir)
+    slave, sport = _startServer(tmpdir, 'slave-read-only no')
+    try:
+        m = socket.create_connection(('127.0.0.1', mport))
+        r = socket.create_connection(('127.0.0.1', sport))
+        eq_(_command(m, 'set', 'before', 'sync'), '+OK\r\n')
+        eq_(_command(r, 'slaveof', '127.0.0.1', str(mport)), '+OK\r\n')
+        ok_(_waitFor(lambda: _command(r, 'get', 'before') ==
+                     '$4\r\nsync\r\n'))
+        # the stream after the snapshot
+        _command(m, 'del', 'before')
+        _command(m, 'set', 'after', 'stream')
+        ok_(_waitFor(lambda: _command(r, 'get', 'after') ==
+                     '$6\r\nstream\r\n'))
+        eq_(_command(r, 'get', 'before'), 'nil\r\n')
+
+        # The replica reconnected to the same master continues from its
+        # offset, the key written on the replica is not dropped by a
+        # full resync.
+        _command(r, 'set', 'local', 'key')
+        eq_(_command(r, 'slaveof', 'localhost', str(mport)), '+OK\r\n')
+        _command(m, 'set', 'offline', 'write')
+        ok_(_waitFor(lambda: _command(r, 'get', 'offline') ==
+                     '$5\r\nwrite\r\n'))
+        eq_(_command(r, 'get', 'local'), '$3\r\nkey\r\n')
+        stats = _command(m, 'info', 'stats')
+        ok_('sync_full:1\r\n' in stats)
+        ok_('sync_partial_ok:1\r\n' in stats)
+        m.close()
+        r.close()
+    finally:
+        master.kill()
+        slave.kill()
+        master.wait()
+        slave.wait()
+        shutil.rmtree(tmpdir)
+
+
+def test_replication_slow_replica():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    master, mport = _startServer(tmpdir)
+    try:
+        m = socket.create_connection(('127.0.0.1', mport))
+        m.settimeout(5)
+        for i in range(64):
+            _command(m, 'set', 'big:{}'.format(i), 'x' * (512 * 1024))
+        # A replica which doesn't read the snapshot doesn't block the
+        # master.
+        r = socket.create_connection(('127.0.0.1', mport))
+        r.sendall(b'psync ? -1\r\n')
+        for i in range(40):
+            eq_(_command(m, 'ping'), '+PONG\r\n')
+            time.sleep(0.1)
+
+        r.settimeout(5)
+        buf = b''
+        while buf.count(b'\r\n') < 2:
+            buf += r.recv(4096)
+        line, size, buf = buf.split(b'\r\n', 2)
+        ok_(line.startswith(b'+FULLRESYNC '))
+        size = int(size[1:])
+        while len(buf) < size:
+            buf += r.recv(1024 * 1024)
+        with open(os.path.join(tmpdir, '{}.pdb'.format(mport)), 'rb') as f:
+            eq_(buf, f.read())
+        ok_(size > 32 * 1024 * 1024)
+        m.close()
+        r.close()
+    finally:
+        _stopServer(master, tmpdir)
+
+
+def test_read_only_replica_and_wait():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    master, mport = _startServer(tmpdir)
+    slave, sport = _startServer(tmpdir)
+    try:
+        m = socket.create_connection(('127.0.0.1', mport))
+        r = socket.create_connection(('127.0.0.1', sport))
+        m.settimeout(5)
+        _command(r, 'slaveof', '127.0.0.1', str(mport))
+        ok_(_waitFor(lambda: 'state=online' in
+                     _command(m, 'info', 'replication')))
+        ok_(_command(r, 'set', 'test:k', 'v').startswith('-READONLY'))
+        _command(r, 'multi')
+        ok_(_command(r, 'set', 'test:k', 'v').startswith('-READONLY'))
+        ok_(_command(r, 'exec').startswith('-EXECABORT'))
+
+        _command(m, 'set', 'test:k', 'v')
+        eq_(_command(m, 'wait', '1', '2000'), '1\r\n')
+        # Only one replica acks, WAIT replies when it times out.
+        start = time.time()
+        eq_(_command(m, 'wait', '2', '300'), '1\r\n')
+        ok_(time.time() - start >= 0.25)
+        eq_(_command(r, 'get', 'test:k'), '$1\r\nv\r\n')
+
+        # The offset acked by the replica and its lag.
+        info = _command(m, 'info', 'replication')
+        offset = info.split('master_repl_offset:')[1].split('\r\n')[0]
+        ok_(_waitFor(lambda: 'offset={},lag='.format(offset) in
+                     _command(m, 'info', 'replication')))
+        m.close()
+        r.close()
+    finally:
+        master.kill()
+        slave.kill()
+        master.wait()
+        slave.wait()
+        shutil.rmtree(tmpdir)
+
+
+def _info(sobj, *section):
+    """Return the INFO reply as a dict of section name to its lines."""
+    reply = _command(sobj, 'info', *section)
+    sections = {}
+    for line in reply.split('\r\n')[1:]:
+        if line.startswith('# '):
+            lines = sections[line] = []
+        elif line:
+            lines.append(line)
+    return sections
+
+
+def _infoField(sobj, section, field):
+    for line in _info(sobj, section)['# ' + section.capitalize()]:
+        if line.startswith(field + ':'):
+            return line.split(':', 1)[1]
+
+
+def test_info():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        names = ['server', 'clients', 'memory', 'persistence', 'stats',
+                 'replication', 'keyspace']
+        eq_(sorted(_info(c)), sorted('# ' + n.capitalize() for n in names))
+        eq_(sorted(_info(c, 'all')),
+            sorted(list(_info(c)) + ['# Commandstats']))
+        fields = {'server': 'tcp_port:{}'.format(port),
+                  'clients': 'connected_clients:1',
+                  'memory': 'used_memory_rss:',
+                  'persistence': 'rdb_bgsave_in_progress:0',
+                  'stats': 'keyspace_hits:',
+                  'replication': 'role:master'}
+        for name in names:
+            info = _info(c, name)
+            eq_(list(info), ['# ' + name.capitalize()])
+            if name in fields:
+                ok_(any(line.startswith(fields[name])
+                        for line in info['# ' + name.capitalize()]))
+
+        # Only the non empty dbs are listed.
+        eq_(_info(c, 'keyspace'), {'# Keyspace': []})
+        eq_(_command(c, 'set', 'test:a', '1'), '+OK\r\n')
+        eq_(_command(c, 'set', 'test:b', '2'), '+OK\r\n')
+        eq_(_command(c, 'select', '9'), '+OK\r\n')
+        eq_(_command(c, 'rpush', 'test:l', 'x'), '+OK\r\n')
+        eq_(_info(c, 'keyspace'), {'# Keyspace': ['db0:keys=2',
+                                                  'db9:keys=1']})
+        eq_(_command(c, 'select', '0'), '+OK\r\n')
+
+        # Each key read by a lookup is a hit or a miss, the keys of
+        # WATCH and written keys are not.
+        eq_(_infoField(c, 'stats', 'keyspace_hits'), '0')
+        eq_(_infoField(c, 'stats', 'keyspace_misses'), '0')
+        eq_(_command(c, 'get', 'test:a'), '$1\r\n1\r\n')
+        eq_(_command(c, 'mget', 'test:a', 'test:b', 'test:none'),
+            '*3\r\n$1\r\n1\r\n$1\r\n2\r\n$-1\r\n')
+        eq_(_command(c, 'exists', 'test:none'), '0\r\n')
+        eq_(_command(c, 'sismember', 'test:none', 'x'), '0\r\n')
+        eq_(_command(c, 'watch', 'test:a', 'test:none'), '+OK\r\n')
+        eq_(_command(c, 'unwatch'), '+OK\r\n')
+        eq_(_command(c, 'set', 'test:c', '3'), '+OK\r\n')
+        eq_(_infoField(c, 'stats', 'keyspace_hits'), '3')
+        eq_(_infoField(c, 'stats', 'keyspace_misses'), '3')
+
+        # Every spelling of a command name is found.
+        eq_(_inline(c, 'INFO keyspace').count('db0:keys=3'), 1)
+        eq_(_command(c, 'sCaRd', 'test:none'), '0\r\n')
+        eq_(_infoField(c, 'stats', 'keyspace_misses'), '4')
+        c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def _canConnect(port):
+    try:
+        socket.create_connection(('127.0.0.1', port)).close()
+    except socket.error:
+        return False
+    return True
+
+
+def test_workers():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir, 'workers 2')
+    try:
+        # Worker 0 serves the slots 0-8191, worker 1 the others, on
+        # their private ports. 'b' hashes to the slot 3300 and 'a' to
+        # the slot 15495.
+        ok_(_waitFor(lambda: _canConnect(port + 1) and _canConnect(port + 2)))
+        keys = {0: ('b', 3300), 1: ('a', 15495)}
+        for i in (0, 1):
+            c = socket.create_connection(('127.0.0.1', port + 1 + i))
+            eq_(_command(c, 'set', keys[i][0], str(i)), '+OK\r\n')
+            eq_(_command(c, 'get', keys[1 - i][0]),
+                '-MOVED {} 127.0.0.1:{}\r\n'.format(keys[1 - i][1],
+                                                    port + 2 - i))
+            c.close()
+
+        # The shared port is served by any worker, a client follows
+        # -MOVED to the right one.
+        c = socket.create_connection(('127.0.0.1', port))
+        for i in (0, 1):
+            reply = _command(c, 'get', keys[i][0])
+            if reply.startswith('-MOVED'):
+                host, nodeport = reply.split()[2].split(':')
+                other = socket.create_connection((host, int(nodeport)))
+                reply = _command(other, 'get', keys[i][0])
+                other.close()
+            eq_(reply, '$1\r\n{}\r\n'.format(i))
+        c.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(tmpdir)
+
+
+def test_workers_load_dump():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    dbfilename = os.path.join(tmpdir, '{}.pdb'.format(port))
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        _command(c, 'mset', 'a', '1', 'b', '2')
+        eq_(_command(c, 'save'), '+OK\r\n')
+        c.close()
+    finally:
+        proc.kill()
+        proc.wait()
+
+    # Every worker keeps the keys of its slots from the dump.
+    proc, port = _startServer(tmpdir, 'workers 2',
+                              'dbfilename {}'.format(dbfilename))
+    try:
+        ok_(_waitFor(lambda: _canConnect(port + 1) and _canConnect(port + 2)))
+        for i, key in ((0, 'b'), (1, 'a')):
+            c = socket.create_connection(('127.0.0.1', port + 1 + i))
+            eq_(_command(c, 'keys', '*'),
+                '*1\r\n${}\r\n{}\r\n'.format(len(key), key))
+            c.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+        shutil.rmtree(tmpdir)
+
+
+def _keySlot(sobj, key):
+    return int(_command(sobj, 'cluster', 'keyslot', key))
+
+
+def test_cluster_redirects():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir, 'cluster-enabled yes',
+                              'cluster-node 127.0.0.1:{port} 0-8191',
+                              'cluster-node 127.0.0.1:1 8192-12287')
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+
+        def keyIn(start, end):
+            i = 0
+            while not start <= _keySlot(c, 'test:{}'.format(i)) <= end:
+                i += 1
+            return 'test:{}'.format(i)
+
+        mine = keyIn(0, 8191)
+        other = keyIn(8192, 12287)
+        down = keyIn(12288, 16383)
+        slot = _keySlot(c, mine)
+        # Keys in the slot of mine
+        tagged = '{' + mine + '}'
+
+        eq_(_command(c, 'set', mine, '1'), '+OK\r\n')
+        _command(c, 'set', tagged + '.2', '2')
+        eq_(_command(c, 'get', other), '-MOVED {} 127.0.0.1:1\r\n'.format(
+            _keySlot(c, other)))
+        ok_(_command(c, 'get', down).startswith('-CLUSTERDOWN'))
+        ok_(_command(c, 'mget', mine, other).startswith('-CROSSSLOT'))
+        eq_(_command(c, 'mget', mine, tagged + '.2'),
+            '*2\r\n$1\r\n1\r\n$1\r\n2\r\n')
+
+        eq_(_command(c, 'cluster', 'countkeysinslot', str(slot)), '2\r\n')
+        eq_(_command(c, 'cluster', 'getkeysinslot', str(slot), '5'),
+            _command(c, 'cluster', 'getkeysinslot', str(slot), '2'))
+        ok_(_command(c, 'cluster', 'getkeysinslot', str(slot), '1')
+            .startswith('*1\r\n'))
+
+        # While the slot is migrating, the keys not here are asked to
+        # the target.
+        _command(c, 'cluster', 'setslot', str(slot), 'migrating',
+                 '127.0.0.1:1')
+        eq_(_command(c, 'get', mine), '$1\r\n1\r\n')
+        eq_(_command(c, 'get', tagged + '.new'),
+            '-ASK {} 127.0.0.1:1\r\n'.format(slot))
+        _command(c, 'cluster', 'setslot', str(slot), 'stable')
+        eq_(_command(c, 'get', tagged + '.new'), 'nil\r\n')
+
+        # An importing slot serves the command after ASKING only.
+        other_slot = str(_keySlot(c, other))
+        _command(c, 'cluster', 'setslot', other_slot, 'importing',
+                 '127.0.0.1:1')
+        eq_(_command(c, 'asking'), '+OK\r\n')
+        eq_(_command(c, 'get', other), 'nil\r\n')
+        ok_(_command(c, 'get', other).startswith('-MOVED'))
+        c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_cluster_migrate_loopback():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    source, sport = _startServer(tmpdir, 'cluster-enabled yes',
+                                 'cluster-node 127.0.0.1:{port} 0-16383',
+                                 'cluster-migrate-batch 50')
+    target, tport = _startServer(tmpdir, 'cluster-enabled yes',
+                                 'cluster-node 127.0.0.1:{} 0-16383'
+                                 .format(sport))
+    try:
+        a = socket.create_connection(('127.0.0.1', sport))
+        b = socket.create_connection(('127.0.0.1', tport))
+        slot = _keySlot(a, 'user')
+        for i in range(120):
+            _command(a, 'set', '{{user}}:{}'.format(i), str(i))
+        _command(a, 'set', 'other', 'stays')
+        eq_(_command(a, 'cluster', 'countkeysinslot', str(slot)), '120\r\n')
+
+        # The keys are moved by batches of 50, the slot is served by
+        # the target once they are all acked.
+        eq_(_command(a, 'migrate', '127.0.0.1', str(tport), str(slot)),
+            '+OK\r\n')
+        ok_(_waitFor(lambda: _command(
+            b, 'cluster', 'countkeysinslot', str(slot)) == '120\r\n'))
+        ok_(_waitFor(lambda: _command(a, 'get', '{user}:7').startswith(
+            '-MOVED {} 127.0.0.1:{}'.format(slot, tport))))
+        eq_(_command(a, 'cluster', 'countkeysinslot', str(slot)), '0\r\n')
+        eq_(_command(a, 'get', 'other'), '$5\r\nstays\r\n')
+        eq_(_command(b, 'get', '{user}:7'), '$1\r\n7\r\n')
+        a.close()
+        b.close()
+    finally:
+        source.kill()
+        target.kill()
+        source.wait()
+        target.wait()
+        shutil.rmtree(tmpdir)
+
+
+def test_io_threads_many_clients():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir, 'io-threads 4')
+    try:
+        # Enough clients for the reads and writes to go to the threads.
+        clients = [socket.create_connection(('127.0.0.1', port))
+                   for i in range(16)]
+        for i, c in enumerate(clients):
+            c.settimeout(5)
+            c.sendall(''.join(
+                _query('set', 'test:{}:{}'.format(i, j), str(j)) +
+                _query('get', 'test:{}:{}'.format(i, j))
+                for j in range(100)).encode('latin-1'))
+        for c in clients:
+            eq_(_readReplies(c, 200), ''.join(
+                '+OK\r\n${}\r\n{}\r\n'.format(len(str(j)), j)
+                for j in range(100)))
+            c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_io_threads_slow_reader():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir, 'io-threads 4')
+    try:
+        fast = socket.create_connection(('127.0.0.1', port))
+        _command(fast, 'set', 'big', 'x' * (1024 * 1024))
+        # The replies of a client which doesn't read are kept by the
+        # server, the other clients are still served.
+        slow = socket.create_connection(('127.0.0.1', port))
+        slow.sendall((_query('get', 'big') * 32).encode('latin-1'))
+        time.sleep(0.2)
+        fast.settimeout(5)
+        eq_(_command(fast, 'ping'), '+PONG\r\n')
+
+        size = 32 * (len('$1048576\r\n') + 1024 * 1024 + 2)
+        slow.settimeout(5)
+        nread = 0
+        while nread < size:
+            nread += len(slow.recv(1024 * 1024))
+        eq_(nread, size)
+        fast.close()
+        slow.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_output_buffer_limit_every_mode():
+    modes = ['io-threads 1', 'io-threads 4']
+    if sys.version_info[0] >= 3:
+        modes.append('frontend asyncio')
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    try:
+        for mode in modes:
+            proc, port = _startServer(
+                tmpdir, mode, 'client-output-buffer-limit monitor 1mb 0 0')
+            try:
+                monitor = socket.create_connection(('127.0.0.1', port))
+                monitor.sendall(b'monitor\r\n')
+                time.sleep(0.1)
+                c = socket.create_connection(('127.0.0.1', port))
+                c.settimeout(5)
+                # The monitor doesn't read the commands fed to it.
+                for i in range(64):
+                    _command(c, 'set', 'big', 'x' * (256 * 1024))
+                ok_(_waitFor(lambda: 'connected_clients:1\r\n' in
+                             _command(c, 'info', 'clients')), mode)
+                monitor.close()
+                c.close()
+            finally:
+                proc.kill()
+                proc.wait()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_lazy_free():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir)
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        other = socket.create_connection(('127.0.0.1', port))
+        for i in range(100):
+            _command(c, 'rpush', 'test:big', str(i))
+        _command(c, 'set', 'test:small', 'v')
+        eq_(_command(c, 'unlink', 'test:big', 'test:small', 'test:nokey'),
+            '2\r\n')
+        eq_(_command(c, 'exists', 'test:big'), '0\r\n')
+        eq_(_command(c, 'get', 'test:small'), 'nil\r\n')
+
+        # The db is replaced by an empty one, for every client which
+        # selected it.
+        _command(c, 'select', '9')
+        _command(other, 'select', '9')
+        args = ['test:{}'.format(i) for i in range(200)]
+        _command(c, 'mset', *args)
+        eq_(_command(c, 'flushdb', 'async'), '+OK\r\n')
+        eq_(_command(c, 'dbsize'), '0\r\n')
+        eq_(_command(other, 'dbsize'), '0\r\n')
+        _command(other, 'set', 'test:after', 'flush')
+        eq_(_command(c, 'get', 'test:after'), '$5\r\nflush\r\n')
+        ok_(_command(c, 'flushall', 'now').startswith('-ERR'))
+        eq_(_command(c, 'flushall', 'async'), '+OK\r\n')
+        eq_(_command(other, 'dbsize'), '0\r\n')
+        c.close()
+        other.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_asyncio_frontend():
+    if sys.version_info[0] < 3:
+        raise SkipTest('asyncio needs Python 3')
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    proc, port = _startServer(tmpdir, 'frontend asyncio')
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        c.settimeout(5)
+        c.sendall((_query('set', 'test:k', 'v') + _query('get', 'test:k') +
+                   'ping\r\n').encode('latin-1'))
+        eq_(_readReplies(c, 3), '+OK\r\n$1\r\nv\r\n+PONG\r\n')
+
+        # The time events run on the asyncio loop.
+        start = time.time()
+        eq_(_command(c, 'blpop', 'test:q', '1'), '*-1\r\n')
+        ok_(time.time() - start >= 0.9)
+
+        sub = socket.create_connection(('127.0.0.1', port))
+        sub.settimeout(5)
+        _command(sub, 'subscribe', 'test:ch')
+        eq_(_command(c, 'publish', 'test:ch', 'hi'), '1\r\n')
+        eq_(_readReplies(sub),
+            '*3\r\n$7\r\nmessage\r\n$7\r\ntest:ch\r\n$2\r\nhi\r\n')
+        c.close()
+        sub.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_embedded_strings():
+    db = Embedded()
+    eq_(db.execute('SET', 'test:k', 'v'), 'OK')
+    eq_(db.execute('GET', 'test:k'), 'v')
+    eq_(db.execute('MGET', 'test:k', 'test:nokey'), ['v', None])
+    eq_(db.execute('DEL', 'test:k'), 1)
+    ok_(db.execute('GET', 'test:k') is None)
+
+
+def test_embedded_args_converted():
+    db = Embedded()
+    db.execute('SET', b'test:n', 41)
+    eq_(db.execute('INCR', 'test:n'), 42)
+    db.execute('DEL', 'test:n')
+
+
+def test_embedded_error():
+    db = Embedded()
+    assert_raises(ReplyError, db.execute, 'NOSUCHCOMMAND')
+    assert_raises(ReplyError, db.execute, 'GET')
+
+
+def test_embedded_transaction():
+    db = Embedded()
+    eq_(db.execute('MULTI'), 'OK')
+    eq_(db.execute('SET', 'test:t', '1'), 'QUEUED')
+    eq_(db.execute('EXEC'), ['OK'])
+    db.execute('DEL', 'test:t')
+    # A command refused while queued aborts the transaction.
+    db.execute('MULTI')
+    assert_raises(ReplyError, db.execute, 'NOSUCHCOMMAND')
+    assert_raises(ReplyError, db.execute, 'EXEC')
+
+
+def test_embedded_blocking_pop_does_not_block():
+    db = Embedded()
+    ok_(db.execute('BLPOP', 'test:empty', 0) is None)
+
+
+def test_benchmark_start_server():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    try:
+        # The started server and its dir are gone when it returns.
+        env = dict(os.environ, TMPDIR=tmpdir)
+        out = subprocess.check_output(
+            [sys.executable, '-m', 'pedis.benchmark', '--start-server',
+             '-p', str(_freePort()), '-n', '100', '-c', '10', '--json'],
+            env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+        report = json.loads(out.decode('utf-8'))
+        eq_([result['test'] for result in report['results']],
+            ['ping', 'set', 'get', 'incr', 'lpush', 'lpop', 'sadd',
+             'lrange'])
+        for result in report['results']:
+            eq_((result['requests'], result['errors']), (100, 0))
+        eq_(os.listdir(tmpdir), [])
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_microbench_small_sizes():
+    from pedis.microbench import BENCHMARKS, _replyClient, _dropReplies
+    out = subprocess.check_output(
+        [sys.executable, '-m', 'pedis.microbench', '--size', '100',
+         '--keys', '100', '--fds', '16', '--repeat', '1'],
+        cwd=os.path.dirname(os.path.abspath(__file__)))
+    eq_([line.split()[0] for line in out.decode('utf-8').splitlines()],
+        [name for name, f in BENCHMARKS])
+
+    # The pending reply bytes go with the replies dropped.
+    client = _replyClient()
+    server.addReply(client, '+OK\r\n')
+    _dropReplies(client)
+    eq_(client.reply_bytes, 0)
+
+
+def test_commandstats():
+    db = Embedded()
+    calls = db.execute('LATENCY', 'HISTOGRAM', 'ping')
+    calls = calls[0][1][1] if calls else 0
+    db.execute('PING')
+    name, (_, ncalls, _, histogram) = db.execute('LATENCY', 'HISTOGRAM',
+                                                 'ping')[0]
+    eq_(ncalls, calls + 1)
+    eq_(histogram[-1], ncalls)
+    ok_('cmdstat_ping:calls=' in db.execute('INFO', 'commandstats'))
+
+
+def test_slowlog():
+    db = Embedded()
+    threshold, server.slowlog_log_slower_than = \
+        server.slowlog_log_slower_than, 0
+    try:
+        db.execute('SLOWLOG', 'RESET')
+        db.execute('ECHO', 'x' * 200)
+        entries = db.execute('SLOWLOG', 'GET', 1)
+    finally:
+        server.slowlog_log_slower_than = threshold
+    eq_(entries[0][3][0], 'echo')
+    ok_(entries[0][3][1].endswith('(72 more bytes)'))
+
+
+def test_latency_monitor():
+    db = Embedded()
+    server.latency_monitor.addSample('test-event', 5)
+    event, _, latest, max_ = db.execute('LATENCY', 'LATEST')[-1]
+    eq_((event, latest, max_), ('test-event', 5, 5))
+    eq_(db.execute('LATENCY', 'HISTORY', 'test-event')[0][1], 5)
+    eq_(db.execute('LATENCY', 'RESET', 'test-event'), 1)
+
+
+def test_metrics():
+    from pedis.metrics import generateMetrics
+    Embedded().execute('PING')
+    text = generateMetrics()
+    ok_('pedis_commands_total{cmd="ping"}' in text)
+    ok_('pedis_command_latency_seconds_bucket{cmd="ping",le="+Inf"}' in text)
+
+
+def test_metrics_http():
+    tmpdir = tempfile.mkdtemp(prefix='pedis-test-')
+    mport = _freePort()
+    proc, port = _startServer(tmpdir, 'metrics-port {}'.format(mport))
+    try:
+        c = socket.create_connection(('127.0.0.1', port))
+        _command(c, 'ping')
+        scraper = socket.create_connection(('127.0.0.1', mport))
+        scraper.sendall(b'GET /metrics HTTP/1.0\r\n\r\n')
+        response = b''
+        while True:
+            data = scraper.recv(4096)
+            if not data:
+                break
+            response += data
+        response = response.decode('latin-1')
+        ok_(response.startswith('HTTP/1.0 200 OK\r\n'))
+        ok_('pedis_commands_total{cmd="ping"} 1' in response)
+        scraper.close()
+        c.close()
+    finally:
+        _stopServer(proc, tmpdir)
+
+
+def test_hotkeys():
+    from pedis.hotkeys import HotKeys
+    db = Embedded()
+    hotkeys, server.hotkeys = server.hotkeys, HotKeys(rate=1)
+    try:
+        for i in range(3):
+            db.execute('GET', 'test:hot')
+        db.execute('EXISTS', 'test:hot')
+        db.execute('GET', 'test:cold')
+        top = db.execute('HOTKEYS', 1)
+    finally:
+        server.hotkeys = hotkeys
+    eq_(top, [[0, 'test:hot', 4, 0, 'get']])
+
+
+def test_bigkeys():
+    db = Embedded()
+    db.execute('RPUSH', 'test:biglist', 'a')
+    db.execute('RPUSH', 'test:biglist', 'b')
+    server.startBigKeysScan()
+    while not server.bigkeys.done:
+        server.bigKeysCron(None, server.bigkeys)
+    rv = db.execute('BIGKEYS')
+    ok_([0, 'list', 'test:biglist', 2, 'items'] in rv[5])
+    db.execute('DEL', 'test:biglist')
+
+
+def test_bigkeys_db_changed():
+    from pedis.hotkeys import BigKeysScan
+    dicts = [{'test:l': [1, 2]}, {'test:s': 'abc'}]
+    scan = BigKeysScan(dicts)
+    scan.step(dicts, 1)
+    # The iteration goes on when the db changes size or is replaced
+    # between two batches.
+    for i in range(10):
+        dicts[0]['test:{}'.format(i)] = 'x'
+    scan.step(dicts, 1)
+    dicts[0] = {}
+    while not scan.done:
+        scan.step(dicts, 1)
+    eq_(scan.scanned, 3)
+    rv = scan.results()
+    eq_((rv[0], rv[-1]), ([0, 'list', 'test:l', 2, 'items'],
+                          [1, 'string', 'test:s', 3, 'bytes']))
+
+
+def test_monitor():
+    mon = Embedded()
+    eq_(mon.execute('MONITOR'), 'OK')
+    Embedded().execute('SET', 'test:m', 'a b')
+    mon.execute('DEL', 'test:m')
+    mon.close()
+    ok_(mon.messages[0].endswith('[0 embedded] "set" "test:m" "a b"'))
+
+
+def test_client_list_kill_timeout():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    peer = socket.create_connection(listener.getsockname())
+    client = server.createClient(listener.accept()[0])
+    listener.close()
+
+    db = Embedded()
+    eq_(db.execute('CLIENT', 'SETNAME', 'tester'), 'OK')
+    eq_(db.execute('CLIENT', 'GETNAME'), 'tester')
+    ok_('id={} addr={} '.format(client.id, client.addr) in
+        db.execute('CLIENT', 'LIST'))
+    eq_(db.execute('CLIENT', 'KILL', 'ID', client.id, 'TYPE', 'pubsub'), 0)
+    eq_(db.execute('CLIENT', 'KILL', 'ADDR', client.addr), 1)
+    server.freeClientsInAsyncFreeQueue()
+    ok_(client.addr not in db.execute('CLIENT', 'LIST'))
+    assert_raises(ReplyError, db.execute, 'CLIENT', 'KILL', client.addr)
+
+    client = server.createClient(peer)
+    client.lastinteraction -= 10
+    server.maxidletime = 5
+    try:
+        server.clientsCronHandleTimeout()
+    finally:
+        server.maxidletime = 0
+    ok_(client.clientnode is None)
+
+
+def test_maxclients():
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    peer = socket.create_connection(listener.getsockname())
+    maxclients, rejected = server.maxclients, server.stat_rejected_conn
+    server.maxclients = server.clients.length
+    try:
+        server.accept(listener, None)
+    finally:
+        server.maxclients = maxclients
+        listener.close()
+    eq_(peer.recv(64), b'-ERR max number of clients reached\r\n')
+    eq_(server.stat_rejected_conn, rejected + 1)
+    peer.close()
+
+
+def test_command_table():
+    db = Embedded()
+    eq_(db.execute('COMMAND', 'COUNT'), len(server.commands))
+    eq_(db.execute('COMMAND', 'INFO', 'GET', 'nosuchcommand'),
+        [['get', 2, ['readonly', 'fast'], 1, 1, 1], None])
+    eq_(db.execute('COMMAND', 'GETKEYS', 'MSET', 'a', '1', 'b', '2'),
+        ['a', 'b'])
+    ok_(server.lookup_command('sMeMbErS')[0])
+
+    db.execute('DEL', 'test:s1', 'test:s2', 'test:s3')
+    db.execute('SADD', 'test:s1', 'a')
+    db.execute('SADD', 'test:s1', 'b')
+    db.execute('SADD', 'test:s2', 'b')
+    eq_(db.execute('SINTER', 'test:s1', 'test:s2'), ['b'])
+    eq_(db.execute('SINTERSTORE', 'test:s3', 'test:s1', 'test:s2'), 1)
+    eq_(db.execute('SMEMBERS', 'test:s3'), ['b'])
+    eq_(db.execute('SCARD', 'test:s1'), 2)
+    eq_(db.execute('RENAME', 'test:s3', 'test:s4'), 'OK')
+    eq_(db.execute('MOVE', 'test:s4', 1), 1)
+    eq_(Embedded(1).execute('DEL', 'test:s4'), 1)
+    db.execute('DEL', 'test:s1', 'test:s2')
+
+
+def test_keyspace_notifications():
+    sub = Embedded()
+    sub.execute('PSUBSCRIBE', '__key*@0__:*')
+    server.notify_keyspace_events = 3
+    try:
+        Embedded().execute('SET', 'test:n', 'v')
+    finally:
+        server.notify_keyspace_events = 0
+    sub.execute('PUNSUBSCRIBE')
+    eq_([m[2:] for m in sub.messages],
+        [['__keyspace@0__:test:n', 'set'], ['__keyevent@0__:set', 'test:n']])